@@ -1,4 +1,5 @@
 import io
+import asyncio
 import logging
 import mimetypes
 import os
@@ -6,9 +7,13 @@ import aiofiles
 import aiohttp
 import openai
 import json
+import uuid
+from contextlib import contextmanager
 from io import BytesIO
 from azure.identity.aio import DefaultAzureCredential
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
 from azure.storage.blob.aio import BlobServiceClient
@@ -17,6 +22,7 @@ from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from quart import (
     Blueprint,
     Quart,
+    Response,
     abort,
     current_app,
     jsonify,
@@ -35,12 +41,19 @@ from model.retrieveChatApproach import RetrieveChatApproach
 from model.translateApproach import translate
 from model.proofreadingApproach import proofreading
 from model.gptChatApproach import gptChat
+from core import endpointrouter, ratelimiter, searchcache
+from core.telemetry import stage
+from core.tokenusage import collect_usage
 from service.cosmosdbService import CosmosdbService
 from service.cognitiveSearchService import CognitiveSearchService
 from service.openaiService import OpenaiService
-from service.blobStorageService import BlobStorageService
+from service.blobStorageService import BlobStorageService, AZURE_STORAGE_PRIVATE_CONTAINER
 from service.formRecognizerService import FormRecognizerService
-from service.redisService import RedisService
+from service.redisService import RedisService, REDIS_SWEEP_INTERVAL
+from service.chatListViewService import ChatListViewService, CHAT_FEED_INTERVAL
+from service.chatArchiveService import ChatArchiveService, CHAT_ARCHIVE_INTERVAL
+from service.chatDetailsService import ChatDetailsService
+from service.tokenUsageService import TokenUsageService, TOKEN_USAGE_RETENTION_DAYS, TOKEN_USAGE_MAX_TOP
 
 
 load_dotenv()
@@ -84,12 +97,47 @@ CONFIG_COSMOSDB_SERVICE = "CosmosdbService"
 CONFIG_SEARCH_SERVICE = "CognitiveSearchService"
 CONFIG_OPENAI_SERVICE = "OpenaiService"
 CONFIG_BLOBSTORAGE_SERVICE = "BlobStorageService"
+CONFIG_PRIVATE_BLOBSTORAGE_SERVICE = "PrivateBlobStorageService"
 CONFIG_FORMRECOGNIZER_SERVICE = "FormRecognizerService"
 CONFIG_REDIS_SERVICE = "RedisService"
+CONFIG_CHAT_LIST_VIEW_SERVICE = "ChatListViewService"
+CONFIG_CHAT_ARCHIVE_SERVICE = "ChatArchiveService"
+CONFIG_CHAT_DETAILS_SERVICE = "ChatDetailsService"
+CONFIG_TOKEN_USAGE_SERVICE = "TokenUsageService"
+CONFIG_BACKGROUND_STOP = "background_stop"
 
 bp = Blueprint("routes", __name__, static_folder='static')
 
 
+def request_etag(request_json):
+    # GET で返した _etag をそのまま送れるようにする（etag も受け付ける）
+    return request_json.get("_etag") or request_json.get("etag")
+
+
+def is_admin():
+    """
+    Whether the signed-in user (App Service authentication) has the admin authority of /api/authentication.
+    """
+    user_id = request.headers.get("X-MS-CLIENT-PRINCIPAL-NAME")
+    if not user_id:
+        return False
+    cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
+    return any(item.get("authentication", {}).get("admin") == "yes"
+               for item in cosmosdbService.get_user_info(user_id))
+
+
+@contextmanager
+def token_usage(user_name="", chat_id=""):
+    """
+    Collects the token usage of the OpenAI calls in the block, recorded after the response (also on errors).
+    """
+    with collect_usage(user_name, chat_id) as usage:
+        try:
+            yield usage
+        finally:
+            current_app.add_background_task(current_app.config[CONFIG_TOKEN_USAGE_SERVICE].record, usage)
+
+
 @bp.route("/")
 async def index():
     return await bp.send_static_file("index.html")
@@ -160,7 +208,8 @@ async def ask():
         # Workaround for: https://github.com/openai/openai-python/issues/371
         async with aiohttp.ClientSession() as s:
             openai.aiosession.set(s)
-            r = await impl.run(request_json["question"], request_json.get("overrides") or {})
+            with token_usage(request_json.get("user_name", "")):
+                r = await impl.run(request_json["question"], request_json.get("overrides") or {})
         return jsonify(r)
     except Exception as e:
         logging.exception("Exception in /ask")
@@ -182,14 +231,19 @@ async def qachat():
             return jsonify({"error": "unknown approach"}), 400
         async with aiohttp.ClientSession() as s:
             openai.aiosession.set(s)
-            r = await impl.run(request_json["history"], request_json.get("overrides") or {}, openai_model)
+            with token_usage(chat_id=chat_id):
+                r = await impl.run(request_json["history"], request_json.get("overrides") or {}, openai_model)
         history: list[dict[str, str]] = request_json["history"]
-        if len(history) == 1:
-            chat_name = history[-1]["user"][0:10] if len(
-                history[-1]["user"]) > 10 else history[-1]["user"]
-            cosmosdbService.update_chat(chat_id, chat_name, openai_model)
-        cosmosdbService.add_chat_content(chat_id=chat_id, chat_type="qa", index=len(
-            history), question=history[-1]["user"], answer=r)
+        with stage("persistence"):
+            if len(history) == 1:
+                chat_name = history[-1]["user"][0:10] if len(
+                    history[-1]["user"]) > 10 else history[-1]["user"]
+                chatInfo = cosmosdbService.update_chat(chat_id, chat_name, openai_model)
+                current_app.config[CONFIG_CHAT_LIST_VIEW_SERVICE].refresh(chatInfo)
+            chatDetailsService: ChatDetailsService = current_app.config[CONFIG_CHAT_DETAILS_SERVICE]
+            details = await asyncio.to_thread(chatDetailsService.save, chat_id, r["thoughts"], r["data_points"])
+            cosmosdbService.add_chat_content(chat_id=chat_id, chat_type="qa", index=len(
+                history), question=history[-1]["user"], answer=r, details=details)
         return jsonify(r), 200
     except Exception as e:
         logging.exception("Exception in /qaanswer")
@@ -201,31 +255,97 @@ async def RetrieveChat():
     request_data = await request.form
     request_files = await request.files
     cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
+    # stream=true の場合、save_chat はアプリケーションコンテキストの外で呼ばれる
+    chatListViewService: ChatListViewService = current_app.config[CONFIG_CHAT_LIST_VIEW_SERVICE]
+    tokenUsageService: TokenUsageService = current_app.config[CONFIG_TOKEN_USAGE_SERVICE]
     retrieveChatApproach = RetrieveChatApproach()
     try:
         history: list[dict[str, str]] = json.loads(request_data["history"])
         chatId = request_data["chatid"]
         openaiModel = request_data["openaimodel"]
-        # ファイルが存在する時。
-        if len(request_files) > 0:
-            retrieveChatApproach.uploadFile(chatId, request_files)
-        # URLチェック
-        urls = retrieveChatApproach.checkURL(history[-1]["user"])
-        if (len(urls) > 0):
-            retrieveChatApproach.uploadURL(chatId, urls)
-        res = retrieveChatApproach.chat(chatId, history, openaiModel)
-        if len(history) == 1:
-            chat_name = history[-1]["user"][0:10] if len(
-                history[-1]["user"]) > 10 else history[-1]["user"]
-            cosmosdbService.update_chat(chatId, chat_name, openaiModel)
-        cosmosdbService.add_chat_content(chat_id=chatId, chat_type="retrieve", index=len(
-            history), question=history[-1]["user"], answer=res)
+        # ファイル・URL のエンベディング
+        with token_usage(chat_id=chatId):
+            # ファイルが存在する時。
+            if len(request_files) > 0:
+                await retrieveChatApproach.uploadFile(chatId, request_files)
+            # URLチェック
+            urls = retrieveChatApproach.checkURL(history[-1]["user"])
+            if (len(urls) > 0):
+                await retrieveChatApproach.uploadURL(chatId, urls)
+        def save_chat(res):
+            with stage("persistence"):
+                if len(history) == 1:
+                    chat_name = history[-1]["user"][0:10] if len(
+                        history[-1]["user"]) > 10 else history[-1]["user"]
+                    chatInfo = cosmosdbService.update_chat(chatId, chat_name, openaiModel)
+                    chatListViewService.refresh(chatInfo)
+                cosmosdbService.add_chat_content(chat_id=chatId, chat_type="retrieve", index=len(
+                    history), question=history[-1]["user"], answer=res)
+
+        # stream=true の場合は回答を NDJSON で逐次返す
+        if request_data.get("stream") == "true":
+            def finish(usage, answer):
+                try:
+                    tokenUsageService.record(usage)
+                    if answer:
+                        save_chat({"answer": answer})
+                except Exception:
+                    logging.exception("Exception in /retrievechat persistence")
+
+            async def stream_answer():
+                answer = ""
+                with collect_usage(chat_id=chatId) as usage:
+                    try:
+                        async for delta in retrieveChatApproach.chatStream(chatId, history, openaiModel):
+                            answer += delta
+                            yield json.dumps({"delta": delta}, ensure_ascii=False) + "\n"
+                    except Exception as e:
+                        # 応答は開始済みのため、エラーは最後の行で返す
+                        logging.exception("Exception in /retrievechat stream")
+                        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+                    finally:
+                        # 失敗・切断した場合もそれまでの回答を保存する（切断によるキャンセルで中断しない）
+                        await asyncio.shield(asyncio.to_thread(finish, usage, answer))
+            return Response(stream_answer(), mimetype="application/x-ndjson")
+
+        with token_usage(chat_id=chatId):
+            res = await retrieveChatApproach.chat(chatId, history, openaiModel)
+        await asyncio.to_thread(save_chat, res)
         return jsonify(res), 200
     except Exception as e:
         logging.exception("Exception in /retrievechat")
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/api/retrievechat/stats", methods=["GET"])
+async def retrieveChatStats():
+    try:
+        redisService: RedisService = current_app.config[CONFIG_REDIS_SERVICE]
+        res = redisService.get_stats()
+        chat_id = request.args.get('chat_id')
+        if chat_id:
+            res["chat_id"] = chat_id
+            res["memory_bytes"] = redisService.chat_memory(chat_id)
+        return jsonify(res), 200
+    except Exception as e:
+        logging.exception("Exception in /api/retrievechat/stats")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/api/cache/stats", methods=["GET"])
+async def cacheStats():
+    try:
+        cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
+        res = cosmosdbService.cache.stats()
+        # 検索結果のキャッシュ（ワーカー毎）
+        res["search"] = await asyncio.to_thread(searchcache.cache.stats)
+        res["pid"] = os.getpid()
+        return jsonify(res), 200
+    except Exception as e:
+        logging.exception("Exception in /api/cache/stats")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/gptanswer", methods=["POST"])
 async def GptAnswer():
     if not request.is_json:
@@ -237,13 +357,16 @@ async def GptAnswer():
         chatId = request_json["chatid"]
         openaiModel = request_json["openaimodel"]
         # 質問回答
-        res = gptChat(chatId, history, openaiModel)
-        cosmosdbService.add_chat_content(chat_id=chatId, chat_type="gpt", index=len(
-            history), question=history[-1]["user"], answer=res)
-        if len(history) == 1:
-            chat_name = history[-1]["user"][0:10] if len(
-                history[-1]["user"]) > 10 else history[-1]["user"]
-            cosmosdbService.update_chat(chatId, chat_name, openaiModel)
+        with token_usage(chat_id=chatId):
+            res = await gptChat(chatId, history, openaiModel)
+        with stage("persistence"):
+            cosmosdbService.add_chat_content(chat_id=chatId, chat_type="gpt", index=len(
+                history), question=history[-1]["user"], answer=res)
+            if len(history) == 1:
+                chat_name = history[-1]["user"][0:10] if len(
+                    history[-1]["user"]) > 10 else history[-1]["user"]
+                chatInfo = cosmosdbService.update_chat(chatId, chat_name, openaiModel)
+                current_app.config[CONFIG_CHAT_LIST_VIEW_SERVICE].refresh(chatInfo)
         return jsonify(res), 200
     except Exception as e:
         logging.exception("Exception in /gptanswer")
@@ -257,7 +380,8 @@ async def translateText():
     request_json = await request.get_json()
     try:
         translatetext = request_json["translatetext"]
-        res = translate(translatetext)
+        with token_usage(request_json.get("user_name", "")):
+            res = await translate(translatetext)
         return jsonify(res), 200
     except Exception as e:
         logging.exception("Exception in /retrievechat")
@@ -271,7 +395,8 @@ async def proofreadingText():
     request_json = await request.get_json()
     try:
         proofreadingtext = request_json["proofreadingtext"]
-        res = proofreading(proofreadingtext)
+        with token_usage(request_json.get("user_name", "")):
+            res = await proofreading(proofreadingtext)
         return jsonify(res), 200
     except Exception as e:
         logging.exception("Exception in /retrievechat")
@@ -286,14 +411,90 @@ async def chatContent():
     try:
         chat_id = request_json["chat_id"]
         chat_type = request_json["chat_type"]
+        # page_size を指定した場合は continuation_token 付きのページを返す
+        page_size = request_json.get("page_size")
+        continuation_token = request_json.get("continuation_token")
+        detail = request_json.get("detail", True)
         cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
-        res = cosmosdbService.get_chat_content(chat_id)
+        res = cosmosdbService.get_chat_content(
+            chat_id, page_size, continuation_token, detail)
+        items = res["items"] if isinstance(res, dict) else res
+        # 最初のページが空の場合のみ、アーカイブされていれば会話内容を戻す
+        # （会話を追加する前に戻すため、アーカイブされたチャットに会話内容が残ることはない）
+        if not continuation_token and not items:
+            chatArchiveService: ChatArchiveService = current_app.config[CONFIG_CHAT_ARCHIVE_SERVICE]
+            if await asyncio.to_thread(chatArchiveService.rehydrate, chat_id):
+                res = cosmosdbService.get_chat_content(
+                    chat_id, page_size, continuation_token, detail)
         return jsonify(res), 200
     except Exception as e:
         logging.exception("Exception in /chatcontent")
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/api/chatcontent/details", methods=["GET"])
+async def chatContentDetails():
+    # 分析パネルを開いた時に thoughts / data_points を取得する
+    try:
+        chat_id = request.args.get('chat_id')
+        content_id = request.args.get('content_id')
+        cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
+        item = cosmosdbService.get_chat_content_item(chat_id, content_id)
+        if not item.get("details"):
+            return jsonify({"thoughts": item["thoughts"], "data_points": item["data_points"]}), 200
+        chatDetailsService: ChatDetailsService = current_app.config[CONFIG_CHAT_DETAILS_SERVICE]
+        res = await asyncio.to_thread(chatDetailsService.load, item["details"])
+        return jsonify(res), 200
+    except Exception as e:
+        logging.exception("Exception in /api/chatcontent/details")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/api/chatarchive/stats", methods=["GET"])
+async def chatArchiveStats():
+    try:
+        chatArchiveService: ChatArchiveService = current_app.config[CONFIG_CHAT_ARCHIVE_SERVICE]
+        return jsonify(chatArchiveService.get_stats()), 200
+    except Exception as e:
+        logging.exception("Exception in /api/chatarchive/stats")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/api/openai/limits", methods=["GET"])
+async def openaiLimits():
+    # デプロイ毎の同時実行数・待ち・残りトークン（ワーカー毎）とエンドポイント毎の状態
+    try:
+        res = ratelimiter.get_stats()
+        return jsonify({"pid": os.getpid(), "deployments": res, "endpoints": endpointrouter.router.get_stats()}), 200
+    except Exception as e:
+        logging.exception("Exception in /api/openai/limits")
+        return jsonify({"error": str(e)}), 500
+
+
+@bp.route("/api/tokenusage", methods=["GET"])
+async def tokenUsage():
+    # 管理者向け：モデル毎のトークン数と料金。chat_id / user_name を指定しない場合は全体と上位ユーザー
+    try:
+        if not is_admin():
+            return jsonify({"error": "管理者権限がありません。"}), 403
+        try:
+            days = max(1, min(int(request.args.get('days', 1)), TOKEN_USAGE_RETENTION_DAYS))
+            top = max(1, min(int(request.args.get('top', 10)), TOKEN_USAGE_MAX_TOP))
+        except ValueError:
+            return jsonify({"error": "days and top must be integers"}), 400
+        tokenUsageService: TokenUsageService = current_app.config[CONFIG_TOKEN_USAGE_SERVICE]
+        res = tokenUsageService.get_usage(
+            day=request.args.get('day'),
+            days=days,
+            user=request.args.get('user_name'),
+            chat_id=request.args.get('chat_id'),
+            top=top)
+        return jsonify(res), 200
+    except Exception as e:
+        logging.exception("Exception in /api/tokenusage")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/api/chatlist", methods=["POST"])
 async def chatLists():
     if not request.is_json:
@@ -301,9 +502,14 @@ async def chatLists():
     request_json = await request.get_json()
     user_name = request_json["user_name"]
     chat_type = request_json["chat_type"]
+    # page_size を指定した場合は continuation_token 付きのページを返す
+    page_size = request_json.get("page_size")
+    continuation_token = request_json.get("continuation_token")
     try:
-        cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
-        res = cosmosdbService.get_chat_list(user_name, chat_type)
+        # 変更フィードから作成した Redis の一覧を返す（未作成の場合は Cosmos）
+        chatListViewService: ChatListViewService = current_app.config[CONFIG_CHAT_LIST_VIEW_SERVICE]
+        res = chatListViewService.get_chat_list(
+            user_name, chat_type, page_size, continuation_token)
         return jsonify(res), 200
     except Exception as e:
         logging.exception("Exception in /chatlist")
@@ -313,6 +519,7 @@ async def chatLists():
 @bp.route("/api/chat", methods=["POST", "PUT", "GET", "DELETE"])
 async def chat():
     cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
+    chatListViewService: ChatListViewService = current_app.config[CONFIG_CHAT_LIST_VIEW_SERVICE]
     if request.method == 'GET':
         try:
             chat_id = request.args.get('chat_id')
@@ -333,18 +540,36 @@ async def chat():
             if request.method == 'POST':
                 chatObj = cosmosdbService.create_chat(
                     user_name, chat_name, chat_type)
+                # 変更フィードを待たずに一覧へ反映する
+                chatListViewService.refresh(chatObj.json)
                 return jsonify(chatObj), 200
             elif request.method == "PUT":
-                cosmosdbService.update_chat_name(chat_id, chat_name)
-                return jsonify(""), 200
+                # GET /api/chat の _etag を指定した場合は、他で更新されていれば 412 を返す
+                chatInfo = cosmosdbService.update_chat_name(
+                    chat_id, chat_name, request_etag(request_json))
+                chatListViewService.refresh(chatInfo)
+                # 続けて更新できるよう、更新後の _etag を返す
+                return jsonify({"_etag": chatInfo.get("_etag")}), 200
             elif request.method == "DELETE":
-                cosmosdbService.delete_chat_and_content(chat_id)
+                # 一覧からはすぐに外し、会話内容はバックグラウンドで削除する
+                chatInfo = cosmosdbService.mark_chat_deleted(chat_id)
+                chatListViewService.refresh(chatInfo)
+                current_app.add_background_task(
+                    current_app.config[CONFIG_CHAT_ARCHIVE_SERVICE].delete_archive, chatInfo)
+                current_app.add_background_task(
+                    current_app.config[CONFIG_CHAT_DETAILS_SERVICE].delete_chat, chat_id)
+                current_app.add_background_task(
+                    cosmosdbService.purge_chat, chat_id)
                 if (chat_type == "retrieve"):
                     redisService: RedisService = current_app.config[CONFIG_REDIS_SERVICE]
-                    redisService.delete_by_chatid(chat_id)
+                    released = redisService.delete_by_chatid(chat_id)
+                    # どのチャットからも参照されなくなった元ファイルを削除する
+                    current_app.add_background_task(delete_source_blobs, released)
                 return jsonify(""), 200
             else:
                 raise ValueError("Unknow the option")
+        except CosmosAccessConditionFailedError:
+            return jsonify({"error": "チャットは他で更新されています。"}), 412
         except Exception as e:
             logging.exception("Exception in /chat")
             return jsonify({"error": str(e)}), 500
@@ -359,8 +584,10 @@ async def enterprise_file():
             folder_id = request.args.get('folder_id')
             tag = request.args.get('tag')
             created_user = request.args.get('created_user')
+            page_size = request.args.get('page_size')
+            continuation_token = request.args.get('continuation_token')
             res = cosmosdbService.get_file_infos(
-                file_name, folder_id, tag, created_user)
+                file_name, folder_id, tag, created_user, page_size, continuation_token)
             return jsonify(res), 200
         except Exception as e:
             logging.exception("Exception in /fileinfolist")
@@ -418,6 +645,11 @@ async def downloadEnterpriseFile():
         file_id = request.args.get('file_id')
         if not file_name or not file_id:
             return jsonify({"error": "file_name and file_id are required"}), 400
+        # 企業ファイル（uuid1 の file_id）以外の Blob は返さない
+        try:
+            uuid.UUID(file_id)
+        except ValueError:
+            return jsonify({"error": "invalid file_id"}), 400
         data = blobStorageService.get_blob(file_id)
         return await send_file(BytesIO(data.readall()), as_attachment=True, attachment_filename=file_name)
     except Exception as e:
@@ -432,7 +664,10 @@ async def user_login_info():
     if request.method == 'GET':
         try:
             user_id = request.args.get('user_id')
-            user_login_info = cosmosdbService.get_user_login_info(user_id)
+            page_size = request.args.get('page_size')
+            continuation_token = request.args.get('continuation_token')
+            user_login_info = cosmosdbService.get_user_login_info(
+                user_id, page_size, continuation_token)
             return jsonify(user_login_info), 200
         except Exception as e:
             logging.exception("Exception in get/userlogininfo")
@@ -442,13 +677,26 @@ async def user_login_info():
             return jsonify({"error": "request must be json"}), 415
         request_json = await request.get_json()
         try:
-            res = cosmosdbService.insert_user_login_info(request_json)
-            return jsonify(res), 200
+            # ログイン履歴は RU に余裕がある時にバックグラウンドで書き込む
+            current_app.add_background_task(
+                cosmosdbService.insert_user_login_info, request_json)
+            return jsonify(None), 200
         except Exception as e:
             logging.exception("Exception in post/userlogininfo")
             return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/api/enterprisefile/facets", methods=["GET"])
+async def enterprise_file_facets():
+    try:
+        cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
+        res = cosmosdbService.get_file_facets()
+        return jsonify(res), 200
+    except Exception as e:
+        logging.exception("Exception in /api/enterprisefile/facets")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/api/folder", methods=["POST", "GET"])
 async def folder():
     cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
@@ -509,8 +757,10 @@ async def authentication():
             if not request.is_json:
                 return jsonify({"error": "request must be json"}), 415
             request_json = await request.get_json()
-            cosmosdbService.update_user_info(request_json)
-            return jsonify({"success": True}), 200
+            # GET /api/authentication の _etag を指定した場合は、他で更新されていれば 412 を返す
+            item = cosmosdbService.update_user_info(
+                request_json, request_etag(request_json))
+            return jsonify({"success": True, "_etag": item.get("_etag")}), 200
 
         elif request.method == 'DELETE':
             if request.args.get('user_info_id'):
@@ -519,6 +769,8 @@ async def authentication():
                 return jsonify({'success': True}), 200
             else:
                 return jsonify({"error": "miss reauest parameter"}), 415
+    except CosmosAccessConditionFailedError:
+        return jsonify({"error": "ユーザー情報は他で更新されています。"}), 412
     except Exception as e:
         logging.exception("Exception in post/folder")
         return jsonify({"error": str(e)}), 500
@@ -599,8 +851,126 @@ async def setup_clients():
     current_app.config[CONFIG_OPENAI_SERVICE] = OpenaiService()
     current_app.config[CONFIG_SEARCH_SERVICE] = CognitiveSearchService()
     current_app.config[CONFIG_BLOBSTORAGE_SERVICE] = BlobStorageService()
+    current_app.config[CONFIG_PRIVATE_BLOBSTORAGE_SERVICE] = BlobStorageService(AZURE_STORAGE_PRIVATE_CONTAINER)
     current_app.config[CONFIG_FORMRECOGNIZER_SERVICE] = FormRecognizerService()
     current_app.config[CONFIG_REDIS_SERVICE] = RedisService()
+    # キャッシュの無効化を他のワーカー・ノードから受け取る
+    current_app.config[CONFIG_COSMOSDB_SERVICE].cache.subscribe(
+        current_app.config[CONFIG_REDIS_SERVICE].client)
+    current_app.config[CONFIG_CHAT_LIST_VIEW_SERVICE] = ChatListViewService(
+        current_app.config[CONFIG_COSMOSDB_SERVICE], current_app.config[CONFIG_REDIS_SERVICE].client)
+    current_app.config[CONFIG_CHAT_DETAILS_SERVICE] = ChatDetailsService(
+        current_app.config[CONFIG_PRIVATE_BLOBSTORAGE_SERVICE])
+    current_app.config[CONFIG_CHAT_ARCHIVE_SERVICE] = ChatArchiveService(
+        current_app.config[CONFIG_COSMOSDB_SERVICE], current_app.config[CONFIG_PRIVATE_BLOBSTORAGE_SERVICE],
+        current_app.config[CONFIG_REDIS_SERVICE].client)
+    current_app.config[CONFIG_TOKEN_USAGE_SERVICE] = TokenUsageService(
+        current_app.config[CONFIG_COSMOSDB_SERVICE], current_app.config[CONFIG_REDIS_SERVICE].client)
+    # エンドポイントの障害・応答時間を他のワーカーと共有する
+    endpointrouter.router.connect(current_app.config[CONFIG_REDIS_SERVICE].client)
+    # OPENAI_TPM_LIMITS のトークンと対話の待ちを全ワーカーで共有する
+    ratelimiter.connect(current_app.config[CONFIG_REDIS_SERVICE].client)
+    # 検索インデックスの世代を他のワーカーと共有し、古い検索結果のキャッシュを使わない
+    searchcache.cache.connect(current_app.config[CONFIG_REDIS_SERVICE].client)
+    current_app.config[CONFIG_BACKGROUND_STOP] = asyncio.Event()
+    current_app.add_background_task(sweep_redis)
+    current_app.add_background_task(sync_openai_endpoints)
+    current_app.add_background_task(follow_chat_feed)
+    current_app.add_background_task(archive_chats)
+    current_app.add_background_task(purge_deleted_chats)
+
+
+async def sweep_redis():
+    # メモリが上限に近づいたら、最近使われていないチャットのベクトルを削除する
+    redisService: RedisService = current_app.config[CONFIG_REDIS_SERVICE]
+    stop: asyncio.Event = current_app.config[CONFIG_BACKGROUND_STOP]
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=REDIS_SWEEP_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        if stop.is_set():
+            break
+        try:
+            await asyncio.to_thread(redisService.sweep)
+        except Exception:
+            logging.exception("Exception in redis sweeper")
+
+
+async def purge_deleted_chats():
+    # 削除途中で停止したチャットの再削除は全件を検索するため、一つのワーカーのみ行う
+    redisService: RedisService = current_app.config[CONFIG_REDIS_SERVICE]
+    cosmosdbService: CosmosdbService = current_app.config[CONFIG_COSMOSDB_SERVICE]
+    try:
+        if await asyncio.to_thread(redisService.acquire_purge_lock):
+            await asyncio.to_thread(cosmosdbService.purge_deleted_chats)
+    except Exception:
+        logging.exception("Exception in purging deleted chats")
+
+
+async def sync_openai_endpoints():
+    stop: asyncio.Event = current_app.config[CONFIG_BACKGROUND_STOP]
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=endpointrouter.OPENAI_ENDPOINT_SYNC_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        if stop.is_set():
+            break
+        try:
+            await asyncio.to_thread(endpointrouter.router.sync)
+        except Exception:
+            logging.exception("Exception in OpenAI endpoint sync")
+
+
+async def follow_chat_feed():
+    # チャットの変更を Redis のチャット一覧に反映する
+    chatListViewService: ChatListViewService = current_app.config[CONFIG_CHAT_LIST_VIEW_SERVICE]
+    stop: asyncio.Event = current_app.config[CONFIG_BACKGROUND_STOP]
+    while not stop.is_set():
+        try:
+            await asyncio.to_thread(chatListViewService.process_change_feed)
+        except Exception:
+            logging.exception("Exception in chat change feed")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=CHAT_FEED_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def delete_source_blobs(source_hashes):
+    blobStorageService: BlobStorageService = current_app.config[CONFIG_PRIVATE_BLOBSTORAGE_SERVICE]
+    redisService: RedisService = current_app.config[CONFIG_REDIS_SERVICE]
+    for source_hash in source_hashes:
+        try:
+            await asyncio.to_thread(blobStorageService.delete_data, redisService.source_blob_name(source_hash))
+        except ResourceNotFoundError:
+            # URL のソースには Blob がない
+            pass
+        except Exception:
+            logging.exception(f"Failed to delete the source blob {source_hash}")
+
+
+async def archive_chats():
+    # 使われていないチャットの会話内容を Blob に移す
+    chatArchiveService: ChatArchiveService = current_app.config[CONFIG_CHAT_ARCHIVE_SERVICE]
+    stop: asyncio.Event = current_app.config[CONFIG_BACKGROUND_STOP]
+    while not stop.is_set():
+        try:
+            await asyncio.to_thread(chatArchiveService.archive_idle_chats)
+        except Exception:
+            logging.exception("Exception in chat archiver")
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=CHAT_ARCHIVE_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+@bp.after_app_serving
+async def stop_background_tasks():
+    current_app.config[CONFIG_BACKGROUND_STOP].set()
+    current_app.config[CONFIG_COSMOSDB_SERVICE].cache.unsubscribe()
+    searchcache.cache.generations.unsubscribe()
 
 
 def create_app():
@@ -1,12 +1,13 @@
 from typing import Any
 
-import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 
 from approaches.approach import ChatApproach
 from core.messagebuilder import MessageBuilder
 from core.modelhelper import get_token_limit
+from core import searchcache
+from core.telemetry import chat_completion, embedding, stage
 from text import nonewlines
 from constants.constants import OPENAI_MODEL
 
@@ -90,7 +91,8 @@ If you cannot generate a search query, return just the number 0.
             model_info["maxtoken"] - len(user_q)
         )
 
-        chat_completion = await openai.ChatCompletion.acreate(
+        query_completion = await chat_completion(
+            "query_rewrite",
             deployment_id=model_info["deployment"],
             model=model_info["model"],
             messages=messages,
@@ -98,7 +100,7 @@ If you cannot generate a search query, return just the number 0.
             max_tokens=32,
             n=1)
 
-        query_text = chat_completion.choices[0].message.content
+        query_text = query_completion.choices[0].message.content
         if query_text.strip() == "0":
             # Use the last user input if we failed to generate a better query
             query_text = history[-1]["user"]
@@ -107,7 +109,7 @@ If you cannot generate a search query, return just the number 0.
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+            query_vector = await embedding(self.embedding_deployment, query_text)
         else:
             query_vector = None
 
@@ -115,31 +117,33 @@ If you cannot generate a search query, return just the number 0.
         if not has_text:
             query_text = None
 
-        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                                filter=filter,
-                                                #   query_type=QueryType.SEMANTIC,
-                                                query_type=QueryType.SIMPLE,
-                                                query_language="en-us",
-                                                query_speller="lexicon",
-                                                semantic_configuration_name="default",
-                                                top=top,
-                                                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                                vector=query_vector,
-                                                top_k=50 if query_vector else None,
-                                                vector_fields="embedding" if query_vector else None)
-        else:
-            r = await self.search_client.search(query_text,
-                                                filter=filter,
-                                                top=top,
-                                                vector=query_vector,
-                                                top_k=50 if query_vector else None,
-                                                vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+        with stage("search", **{"search.top": top, "search.semantic_ranker": bool(overrides.get("semantic_ranker"))}) as span:
+            # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
+            if overrides.get("semantic_ranker") and has_text:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             #   query_type=QueryType.SEMANTIC,
+                                             query_type=QueryType.SIMPLE,
+                                             query_language="en-us",
+                                             query_speller="lexicon",
+                                             semantic_configuration_name="default",
+                                             top=top,
+                                             query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            else:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             top=top,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            if use_semantic_captions:
+                results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            else:
+                results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
+            span.set_attribute("search.documents", len(results))
         content = "\n".join(results)
 
         follow_up_questions_prompt = self.follow_up_questions_prompt_content if overrides.get(
@@ -167,7 +171,8 @@ If you cannot generate a search query, return just the number 0.
             history[-1]["user"] + "\n\nSources:\n" + content,
             max_tokens=model_info["maxtoken"])
 
-        chat_completion = await openai.ChatCompletion.acreate(
+        answer_completion = await chat_completion(
+            "completion",
             deployment_id=model_info["deployment"],
             model=model_info["model"],
             messages=messages,
@@ -175,7 +180,7 @@ If you cannot generate a search query, return just the number 0.
             max_tokens=1024,
             n=1)
 
-        chat_content = chat_completion.choices[0].message.content
+        chat_content = answer_completion.choices[0].message.content
 
         msg_to_display = '\n\n'.join([str(message) for message in messages])
 
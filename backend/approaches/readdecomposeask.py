@@ -12,7 +12,9 @@ from langchain.prompts import BasePromptTemplate, PromptTemplate
 from langchain.tools.base import BaseTool
 
 from approaches.approach import AskApproach
-from langchainadapters import HtmlCallbackHandler
+from core import endpointrouter, ratelimiter, searchcache
+from core.telemetry import embedding, stage
+from langchainadapters import HtmlCallbackHandler, TelemetryCallbackHandler
 from text import nonewlines
 
 
@@ -34,7 +36,7 @@ class ReadDecomposeAsk(AskApproach):
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+            query_vector = await embedding(self.embedding_deployment, query_text)
         else:
             query_vector = None
 
@@ -42,48 +44,51 @@ class ReadDecomposeAsk(AskApproach):
         if not has_text:
             query_text = ""
 
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
+        with stage("search", **{"search.top": top, "search.semantic_ranker": bool(overrides.get("semantic_ranker"))}) as span:
+            if overrides.get("semantic_ranker") and has_text:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             query_type=QueryType.SEMANTIC,
+                                             query_language="en-us",
+                                             query_speller="lexicon",
+                                             semantic_configuration_name="default",
+                                             top=top,
+                                             query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            else:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             top=top,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            if use_semantic_captions:
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) for doc in r]
+            else:
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) for doc in r]
+            span.set_attribute("search.documents", len(results))
+        return results, "\n".join(results)
+
+    async def lookup(self, q: str) -> Optional[str]:
+        with stage("lookup", **{"search.top": 1}):
+            r = await self.search_client.search(q,
+                                          top = 1,
+                                          include_total_count=True,
                                           query_type=QueryType.SEMANTIC,
                                           query_language="en-us",
                                           query_speller="lexicon",
                                           semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(" . ".join([c.text for c in doc['@search.captions'] ])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:500]) async for doc in r]
-        return results, "\n".join(results)
+                                          query_answer="extractive|count-1",
+                                          query_caption="extractive|highlight-false")
 
-    async def lookup(self, q: str) -> Optional[str]:
-        r = await self.search_client.search(q,
-                                      top = 1,
-                                      include_total_count=True,
-                                      query_type=QueryType.SEMANTIC,
-                                      query_language="en-us",
-                                      query_speller="lexicon",
-                                      semantic_configuration_name="default",
-                                      query_answer="extractive|count-1",
-                                      query_caption="extractive|highlight-false")
-
-        answers = await r.get_answers()
-        if answers and len(answers) > 0:
-            return answers[0].text
-        if await r.get_count() > 0:
-            return "\n".join([d['content'] async for d in r])
-        return None
+            answers = await r.get_answers()
+            if answers and len(answers) > 0:
+                return answers[0].text
+            if await r.get_count() > 0:
+                return "\n".join([d['content'] async for d in r])
+            return None
 
     async def run(self, q: str, overrides: dict[str, Any]) -> Any:
 
@@ -95,9 +100,13 @@ class ReadDecomposeAsk(AskApproach):
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
+        telemetry_handler = TelemetryCallbackHandler(self.openai_deployment)
         cb_manager = CallbackManager(handlers=[cb_handler])
 
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        # The agent runs on one endpoint of the deployment
+        endpoint = endpointrouter.router.choose(self.openai_deployment)
+        llm = AzureOpenAI(deployment_name=endpoint.deployment, temperature=overrides.get("temperature") or 0.3,
+                          openai_api_key=endpoint.api_key or openai.api_key, openai_api_base=endpoint.api_base or openai.api_base)
         tools = [
             Tool(name="Search", func=lambda _: 'Not implemented', coroutine=search_and_store, description="useful for when you need to ask with search", callbacks=cb_manager),
             Tool(name="Lookup", func=lambda _: 'Not implemented', coroutine=self.lookup, description="useful for when you need to ask with lookup", callbacks=cb_manager)
@@ -114,7 +123,14 @@ class ReadDecomposeAsk(AskApproach):
 
         agent = ReAct.from_llm_and_tools(llm, tools)
         chain = AgentExecutor.from_agent_and_tools(agent, tools, verbose=True, callback_manager=cb_manager)
-        result = await chain.arun(q)
+        with stage("agent", **{"openai.deployment": self.openai_deployment}) as span:
+            # The agent calls the LLM one step at a time, it holds one slot of the deployment
+            async with endpointrouter.session(endpoint, ratelimiter.estimate_tokens(text=q)) as slot:
+                # Run callbacks are inherited by the LLM calls of the agent
+                result = await chain.arun(q, callbacks=[telemetry_handler])
+                slot.used = telemetry_handler.prompt_tokens + telemetry_handler.completion_tokens
+            telemetry_handler.set_attributes(span)
+            telemetry_handler.record_usage()
 
         # Replace substrings of the form <file.ext> with [file.ext] so that the frontend can render them as links, match them with a regex to avoid
         # generalizing too much and disrupt HTML snippets if present
@@ -9,7 +9,9 @@ from langchain.chains import LLMChain
 from langchain.llms.openai import AzureOpenAI
 
 from approaches.approach import AskApproach
-from langchainadapters import HtmlCallbackHandler
+from core import endpointrouter, ratelimiter, searchcache
+from core.telemetry import embedding, stage
+from langchainadapters import HtmlCallbackHandler, TelemetryCallbackHandler
 from lookuptool import CsvLookupTool
 from text import nonewlines
 
@@ -64,7 +66,7 @@ Thought: {agent_scratchpad}"""
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=query_text))["data"][0]["embedding"]
+            query_vector = await embedding(self.embedding_deployment, query_text)
         else:
             query_vector = None
 
@@ -72,30 +74,32 @@ Thought: {agent_scratchpad}"""
         if not has_text:
             query_text = ""
 
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          query_language="en-us",
-                                          query_speller="lexicon",
-                                          semantic_configuration_name="default",
-                                          top = top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) async for doc in r]
+        with stage("search", **{"search.top": top, "search.semantic_ranker": bool(overrides.get("semantic_ranker"))}) as span:
+            # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
+            if overrides.get("semantic_ranker") and has_text:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             query_type=QueryType.SEMANTIC,
+                                             query_language="en-us",
+                                             query_speller="lexicon",
+                                             semantic_configuration_name="default",
+                                             top = top,
+                                             query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            else:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             top=top,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            if use_semantic_captions:
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(" -.- ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            else:
+                results = [doc[self.sourcepage_field] + ":" + nonewlines(doc[self.content_field][:250]) for doc in r]
+            span.set_attribute("search.documents", len(results))
         content = "\n".join(results)
         return results, content
 
@@ -109,6 +113,7 @@ Thought: {agent_scratchpad}"""
 
         # Use to capture thought process during iterations
         cb_handler = HtmlCallbackHandler()
+        telemetry_handler = TelemetryCallbackHandler(self.openai_deployment)
         cb_manager = CallbackManager(handlers=[cb_handler])
 
         acs_tool = Tool(name="CognitiveSearch",
@@ -124,14 +129,24 @@ Thought: {agent_scratchpad}"""
             prefix=overrides.get("prompt_template_prefix") or self.template_prefix,
             suffix=overrides.get("prompt_template_suffix") or self.template_suffix,
             input_variables = ["input", "agent_scratchpad"])
-        llm = AzureOpenAI(deployment_name=self.openai_deployment, temperature=overrides.get("temperature") or 0.3, openai_api_key=openai.api_key)
+        # The agent runs on one endpoint of the deployment
+        endpoint = endpointrouter.router.choose(self.openai_deployment)
+        llm = AzureOpenAI(deployment_name=endpoint.deployment, temperature=overrides.get("temperature") or 0.3,
+                          openai_api_key=endpoint.api_key or openai.api_key, openai_api_base=endpoint.api_base or openai.api_base)
         chain = LLMChain(llm = llm, prompt = prompt)
         agent_exec = AgentExecutor.from_agent_and_tools(
             agent = ZeroShotAgent(llm_chain = chain),
             tools = tools,
             verbose = True,
             callback_manager = cb_manager)
-        result = await agent_exec.arun(q)
+        with stage("agent", **{"openai.deployment": self.openai_deployment}) as span:
+            # The agent calls the LLM one step at a time, it holds one slot of the deployment
+            async with endpointrouter.session(endpoint, ratelimiter.estimate_tokens(text=q)) as slot:
+                # Run callbacks are inherited by the LLM calls of the agent
+                result = await agent_exec.arun(q, callbacks=[telemetry_handler])
+                slot.used = telemetry_handler.prompt_tokens + telemetry_handler.completion_tokens
+            telemetry_handler.set_attributes(span)
+            telemetry_handler.record_usage()
 
         # Remove references to tool names that might be confused with a citation
         result = result.replace("[CognitiveSearch]", "").replace("[Employee]", "")
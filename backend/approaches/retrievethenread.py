@@ -1,11 +1,12 @@
 from typing import Any
 
-import openai
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType
 
 from approaches.approach import AskApproach
 from core.messagebuilder import MessageBuilder
+from core import searchcache
+from core.telemetry import chat_completion, embedding, stage
 from text import nonewlines
 
 
@@ -54,37 +55,39 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
 
         # If retrieval mode includes vectors, compute an embedding for the query
         if has_vector:
-            query_vector = (await openai.Embedding.acreate(engine=self.embedding_deployment, input=q))["data"][0]["embedding"]
+            query_vector = await embedding(self.embedding_deployment, q)
         else:
             query_vector = None
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else ""
 
-        # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          query_type=QueryType.SEMANTIC,
-                                          query_language="en-us",
-                                          query_speller="lexicon",
-                                          semantic_configuration_name="default",
-                                          top=top,
-                                          query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        else:
-            r = await self.search_client.search(query_text,
-                                          filter=filter,
-                                          top=top,
-                                          vector=query_vector,
-                                          top_k=50 if query_vector else None,
-                                          vector_fields="embedding" if query_vector else None)
-        if use_semantic_captions:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) async for doc in r]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+        with stage("search", **{"search.top": top, "search.semantic_ranker": bool(overrides.get("semantic_ranker"))}) as span:
+            # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
+            if overrides.get("semantic_ranker") and has_text:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             query_type=QueryType.SEMANTIC,
+                                             query_language="en-us",
+                                             query_speller="lexicon",
+                                             semantic_configuration_name="default",
+                                             top=top,
+                                             query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            else:
+                r = await searchcache.search(self.search_client, query_text,
+                                             filter=filter,
+                                             top=top,
+                                             vector=query_vector,
+                                             top_k=50 if query_vector else None,
+                                             vector_fields="embedding" if query_vector else None)
+            if use_semantic_captions:
+                results = [doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc['@search.captions']])) for doc in r]
+            else:
+                results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in r]
+            span.set_attribute("search.documents", len(results))
         content = "\n".join(results)
 
         message_builder = MessageBuilder(overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model)
@@ -98,7 +101,8 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         message_builder.append_message('user', self.question)
 
         messages = message_builder.messages
-        chat_completion = await openai.ChatCompletion.acreate(
+        answer_completion = await chat_completion(
+            "completion",
             deployment_id=self.openai_deployment,
             model=self.chatgpt_model,
             messages=messages,
@@ -106,4 +110,4 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
             max_tokens=1024,
             n=1)
 
-        return {"data_points": results, "answer": chat_completion.choices[0].message.content, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
+        return {"data_points": results, "answer": answer_completion.choices[0].message.content, "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>" + '\n\n'.join([str(message) for message in messages])}
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import time
+from uuid import uuid1
+
+import numpy as np
+from azure.cosmos import CosmosClient, PartitionKey
+
+# Compares read_item + replace_item with a single patch_item for the status / name updates of CosmosdbService.
+# Uses a scratch container in AZURE_COSMOSDB_DATABASE that is deleted afterwards:
+#   python -m benchmark.cosmosPatchBenchmark --updates 200
+
+CONTAINER_NAME = "benchmark-patch"
+
+
+def request_charge(client):
+    return float(client.client_connection.last_response_headers.get("x-ms-request-charge", 0))
+
+
+def create_documents(container, count, payload):
+    ids = []
+    for _ in range(count):
+        item = {"id": str(uuid1()), "type": "file-info", "file_status": "エンベディング処理中",
+                "file_name": "benchmark.pdf", "payload": "x" * payload}
+        container.create_item(item)
+        ids.append(item["id"])
+    return ids
+
+
+def read_replace(client, container, item_id, value):
+    item = container.read_item(item=item_id, partition_key="file-info")
+    charge = request_charge(client)
+    item["file_status"] = value
+    container.replace_item(item=item, body=item)
+    return charge + request_charge(client)
+
+
+def patch(client, container, item_id, value):
+    container.patch_item(item=item_id, partition_key="file-info",
+                         patch_operations=[{"op": "set", "path": "/file_status", "value": value}])
+    return request_charge(client)
+
+
+def run(name, update, client, container, ids, updates):
+    charges = []
+    latencies = []
+    for i in range(updates):
+        start = time.perf_counter()
+        charges.append(update(client, container, ids[i % len(ids)], f"{name}-{i}"))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "method": name,
+        "updates": updates,
+        "ru_mean": round(float(np.mean(charges)), 2),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "latency_p95_ms": round(float(np.percentile(latencies, 95)), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of read + replace against patch for partial updates")
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--payload", type=int, default=2000,
+                        help="Size of the untouched part of each document in bytes")
+    parser.add_argument("--output", help="Write the results as json")
+    args = parser.parse_args()
+
+    client = CosmosClient(url=os.getenv("AZURE_COSMOSDB_URI"),
+                          credential=os.getenv("AZURE_COSMOSDB_KEY"))
+    database = client.get_database_client(os.getenv("AZURE_COSMOSDB_DATABASE"))
+    container = database.create_container_if_not_exists(
+        id=CONTAINER_NAME, partition_key=PartitionKey(path="/type"))
+    try:
+        ids = create_documents(container, args.documents, args.payload)
+        # Warm up the connection before measuring
+        run("warmup", patch, client, container, ids, 10)
+        report = [run("read_replace", read_replace, client, container, ids, args.updates),
+                  run("patch", patch, client, container, ids, args.updates)]
+    finally:
+        database.delete_container(CONTAINER_NAME)
+
+    for row in report:
+        print(" ".join(f"{k}={v}" for k, v in row.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
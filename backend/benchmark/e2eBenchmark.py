@@ -0,0 +1,306 @@
+import argparse
+import asyncio
+import glob
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+from datetime import datetime
+from uuid import uuid1
+
+# Drives the routes of app.py against local stand-ins of the Azure services (benchmark.fakes),
+# and reports the latency percentiles, the throughput and the event-loop lag of each route:
+#   python -m benchmark.e2eBenchmark --concurrency 16 --requests 200 --output results.json
+
+SERVICES = ["openai", "search", "cosmos", "blob", "redis"]
+DEFAULT_LATENCY_MS = {"openai": 300, "search": 50, "cosmos": 10, "blob": 20, "redis": 1}
+BENCHMARK_INDEX = "benchmark"
+BENCHMARK_ENV = {
+    "REDIS_URL": "localhost:6379",
+    "REDIS_KEY": "benchmark",
+    "AZURE_OPENAI_SERVICE": "benchmark",
+    "AZURE_OPENAI_KEY": "benchmark",
+    "AZURE_OPENAI_CHATGPT_DEPLOYMENT": "chat",
+    "AZURE_OPENAI_CHATGPT_MODEL": "gpt-35-turbo",
+    "AZURE_OPENAI_CHATGPT35_DEPLOYMENT": "chat",
+    "AZURE_OPENAI_CHATGPT35_MODEL": "gpt-35-turbo",
+    "AZURE_OPENAI_EMB_DEPLOYMENT": "embedding",
+    "AZURE_SEARCH_SERVICE": "benchmark",
+    "AZURE_SEARCH_INDEX": BENCHMARK_INDEX,
+    "AZURE_SEARCH_KEY": "benchmark",
+    "KB_FIELDS_CONTENT": "content",
+    "KB_FIELDS_CATEGORY": "category",
+    "KB_FIELDS_SOURCEPAGE": "sourcepage",
+    "APPLICATIONINSIGHTS_CONNECTION_STRING": "",
+}
+# The modules read their settings on import, so never pick up the real services from .env
+os.environ.update(BENCHMARK_ENV)
+
+import numpy as np  # noqa: E402
+import openai  # noqa: E402
+from azure.core.credentials import AzureKeyCredential  # noqa: E402
+from azure.search.documents import SearchClient  # noqa: E402
+from azure.search.documents.aio import SearchClient as AsyncSearchClient  # noqa: E402
+from werkzeug.datastructures import FileStorage  # noqa: E402
+
+import app as backend  # noqa: E402
+from core import endpointrouter, ratelimiter, searchcache, singleflight  # noqa: E402
+from benchmark.fakes import (Fault, FakeServer, FakeBlobStorageService, FakeCosmosdbService,  # noqa: E402
+                             FakeRedisClient, FakeRedisService, FakeSearchIndexClient, create_openai_app, create_search_app,
+                             DOCUMENT_TEXT)
+from service.chatDetailsService import ChatDetailsService  # noqa: E402
+from service.chatListViewService import ChatListViewService  # noqa: E402
+from service.cognitiveSearchService import CognitiveSearchService  # noqa: E402
+from service.openaiService import OpenaiService  # noqa: E402
+from service.tokenUsageService import TokenUsageService  # noqa: E402
+from upload.uploadFileProcess import UploadFileProcess  # noqa: E402
+
+QUESTION = "福利厚生の申請方法を教えてください。"
+OPENAI_MODEL = "gpt-35-turbo"
+DOWNLOAD_FILE_ID = "6f1c0b4e-0000-11ee-8000-000000000000"
+
+
+def text_file(name, i):
+    # Ten distinct documents, so that the retrieve chat also hits its shared chunks
+    data = (f"{DOCUMENT_TEXT}\n" * 40 + f"({i % 10})").encode("utf-8")
+    return FileStorage(io.BytesIO(data), filename=name, content_type="text/plain")
+
+
+def chat_form(i, stream=False):
+    form = {"history": json.dumps([{"user": QUESTION}], ensure_ascii=False),
+            "chatid": str(uuid1()), "openaimodel": OPENAI_MODEL}
+    if stream:
+        form["stream"] = "true"
+    return {"form": form, "files": {"file0": text_file(f"retrieve-{i}.txt", i)}}
+
+
+SCENARIOS = {
+    "ask-rtr": lambda i: ("POST", "/ask", {"json": {"approach": "rtr", "question": QUESTION, "overrides": {}}}),
+    "ask-rrr": lambda i: ("POST", "/ask", {"json": {"approach": "rrr", "question": QUESTION, "overrides": {}}}),
+    "ask-rda": lambda i: ("POST", "/ask", {"json": {"approach": "rda", "question": QUESTION, "overrides": {}}}),
+    "qaanswer": lambda i: ("POST", "/qaanswer", {"json": {
+        "approach": "rrr", "chatid": str(uuid1()), "openaimodel": OPENAI_MODEL,
+        "history": [{"user": QUESTION}], "overrides": {}}}),
+    "gptanswer": lambda i: ("POST", "/gptanswer", {"json": {
+        "chatid": str(uuid1()), "openaimodel": OPENAI_MODEL, "history": [{"user": QUESTION}]}}),
+    "retrievechat": lambda i: ("POST", "/retrievechat", chat_form(i)),
+    "retrievechat-stream": lambda i: ("POST", "/retrievechat", chat_form(i, stream=True)),
+    "upload": lambda i: ("POST", "/api/enterprisefile", {
+        "form": {"created_user": "benchmark", "folder_id": "benchmark", "tag": "benchmark"},
+        "files": {"file": text_file(f"benchmark-{uuid1()}.txt", i)}}),
+    "download": lambda i: ("GET", "/api/downloadEnterpriseFile", {
+        "query_string": {"file_name": "benchmark.txt", "file_id": DOWNLOAD_FILE_ID}}),
+}
+
+
+class LoopLagMonitor:
+    """
+    Measures how late a periodic timer fires, i.e. how long the event loop was blocked.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, time.perf_counter() - start - self.interval) * 1000)
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        return self.lags or [0.0]
+
+
+def create_benchmark_app(openai_url, search_url, faults):
+    app = backend.create_app()
+    search_client = AsyncSearchClient(endpoint=search_url, index_name=BENCHMARK_INDEX,
+                                      credential=AzureKeyCredential("benchmark"))
+    app.config[backend.CONFIG_ASK_APPROACHES] = {
+        "rtr": backend.RetrieveThenReadApproach(search_client, "chat", "gpt-35-turbo", "embedding", "sourcepage", "content"),
+        "rrr": backend.ReadRetrieveReadApproach(search_client, "chat", "embedding", "sourcepage", "content"),
+        "rda": backend.ReadDecomposeAsk(search_client, "chat", "embedding", "sourcepage", "content"),
+    }
+    app.config[backend.CONFIG_CHAT_APPROACHES] = {
+        "rrr": backend.ChatReadRetrieveReadApproach(search_client, "chat", "gpt-35-turbo", "embedding", "sourcepage", "content"),
+    }
+    app.config[backend.CONFIG_OPENAI_SERVICE] = OpenaiService()
+    # OpenaiService points the openai module at Azure, and langchain reads the environment
+    openai.api_base = openai_url
+    openai.api_key = "benchmark"
+    os.environ["OPENAI_API_TYPE"] = "azure"
+    os.environ["OPENAI_API_BASE"] = openai_url
+    os.environ["OPENAI_API_KEY"] = "benchmark"
+    os.environ["OPENAI_API_VERSION"] = openai.api_version
+
+    cosmosdbService = FakeCosmosdbService(faults["cosmos"])
+    blobStorageService = FakeBlobStorageService(faults["blob"])
+    blobStorageService.blobs[DOWNLOAD_FILE_ID] = (DOCUMENT_TEXT * 1000).encode("utf-8")
+    app.config[backend.CONFIG_COSMOSDB_SERVICE] = cosmosdbService
+    app.config[backend.CONFIG_BLOBSTORAGE_SERVICE] = blobStorageService
+    app.config[backend.CONFIG_PRIVATE_BLOBSTORAGE_SERVICE] = blobStorageService
+    # .txt uploads do not use Form Recognizer
+    app.config[backend.CONFIG_FORMRECOGNIZER_SERVICE] = None
+    app.config[backend.CONFIG_REDIS_SERVICE] = FakeRedisService(faults["redis"])
+    app.config[backend.CONFIG_CHAT_LIST_VIEW_SERVICE] = ChatListViewService(
+        cosmosdbService, FakeRedisClient(faults["redis"]))
+    app.config[backend.CONFIG_CHAT_DETAILS_SERVICE] = ChatDetailsService(blobStorageService)
+    app.config[backend.CONFIG_TOKEN_USAGE_SERVICE] = TokenUsageService(cosmosdbService, FakeRedisClient(faults["redis"]))
+    return app
+
+
+async def setup_search_service(app, search_url):
+    async with app.app_context():
+        cognitiveSearchService = CognitiveSearchService()
+    cognitiveSearchService.search_index_client = SearchClient(
+        endpoint=search_url, index_name=BENCHMARK_INDEX, credential=AzureKeyCredential("benchmark"))
+    cognitiveSearchService.search_client = FakeSearchIndexClient(BENCHMARK_INDEX)
+    app.config[backend.CONFIG_SEARCH_SERVICE] = cognitiveSearchService
+
+
+async def send(client, build, i):
+    """
+    Sends one request and reads the whole (also streamed) body. Returns False on an error.
+    """
+    method, path, kwargs = build(i)
+    try:
+        response = await client.open(path, method=method, **kwargs)
+        await response.get_data()
+        return response.status_code < 400
+    except Exception:
+        # Errors raised while streaming the response reach the test client
+        return False
+
+
+async def run_scenario(client, name, requests, concurrency, warmup):
+    build = SCENARIOS[name]
+    for i in range(warmup):
+        await send(client, build, i)
+
+    latencies = []
+    errors = 0
+    indexes = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for i in indexes:
+            start = time.perf_counter()
+            if not await send(client, build, i):
+                errors += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    monitor = LoopLagMonitor()
+    monitor.start()
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    lags = await monitor.stop()
+    return {
+        "route": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": errors,
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 2),
+        "latency_p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        "latency_p99_ms": round(float(np.percentile(latencies, 99)), 2),
+        "latency_mean_ms": round(float(np.mean(latencies)), 2),
+        "throughput_rps": round(requests / elapsed, 2),
+        "loop_lag_p50_ms": round(float(np.percentile(lags, 50)), 2),
+        "loop_lag_p99_ms": round(float(np.percentile(lags, 99)), 2),
+        "loop_lag_max_ms": round(float(np.max(lags)), 2),
+    }
+
+
+async def run(args, faults, openai_url, search_url):
+    app = create_benchmark_app(openai_url, search_url, faults)
+    await setup_search_service(app, search_url)
+    client = app.test_client()
+    report = []
+    for name in args.routes.split(","):
+        row = await run_scenario(client, name, args.requests, args.concurrency, args.warmup)
+        print(" ".join(f"{k}={v}" for k, v in row.items()), flush=True)
+        report.append(row)
+    # Uploads are indexed in background threads, wait for them before stopping the fakes
+    for thread in threading.enumerate():
+        if isinstance(thread, UploadFileProcess):
+            thread.join()
+    # The route leaves the files of the uploads that failed before indexing
+    for path in glob.glob(os.path.join("enterprise_data", "benchmark-*.txt")):
+        os.remove(path)
+    # The approaches share one search client
+    await app.config[backend.CONFIG_ASK_APPROACHES]["rtr"].search_client.close()
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="End-to-end benchmark of the backend routes with local stand-ins of the Azure services")
+    parser.add_argument("--routes", default=",".join(SCENARIOS),
+                        help=f"Comma separated routes out of {','.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured requests per route")
+    for service in SERVICES:
+        parser.add_argument(f"--{service}-latency-ms", type=float, default=DEFAULT_LATENCY_MS[service])
+    parser.add_argument("--token-latency-ms", type=float, default=20,
+                        help="Delay between the streamed chunks of the chat completions")
+    parser.add_argument("--jitter-ms", type=float, default=0,
+                        help="Uniform jitter added to the latency of every service")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Probability that a call to one of --error-services fails")
+    parser.add_argument("--error-services", default=",".join(SERVICES))
+    parser.add_argument("--error-status", type=int, default=503,
+                        help="HTTP status of the injected OpenAI and Search errors")
+    parser.add_argument("--output", help="Write the results as json")
+    args = parser.parse_args()
+
+    unknown = set(args.routes.split(",")) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown routes: {','.join(sorted(unknown))}")
+    error_services = args.error_services.split(",")
+    faults = {service: Fault(latency_ms=getattr(args, f"{service}_latency_ms"),
+                             jitter_ms=args.jitter_ms,
+                             error_rate=args.error_rate if service in error_services else 0,
+                             status=args.error_status) for service in SERVICES}
+
+    openai_server = FakeServer(create_openai_app(faults["openai"], args.token_latency_ms))
+    search_server = FakeServer(create_search_app(faults["search"]))
+    try:
+        report = asyncio.run(run(args, faults, openai_server.start(), search_server.start()))
+    finally:
+        openai_server.stop()
+        search_server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                       "commit": git_commit(),
+                       "args": vars(args),
+                       "faults": {service: fault.stats() for service, fault in faults.items()},
+                       "limiters": ratelimiter.get_stats(),
+                       "endpoints": endpointrouter.router.get_stats(),
+                       "singleflight": singleflight.get_stats(),
+                       "searchcache": searchcache.cache.stats(),
+                       "results": report}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,531 @@
+import asyncio
+import json
+import random
+import threading
+import time
+import zlib
+from datetime import datetime
+from uuid import uuid1
+
+import numpy as np
+from aiohttp import web
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosHttpResponseError
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from constants import constants
+from core.ttlcache import TTLCache
+
+# Local stand-ins of the Azure services used by the backend, for benchmark.e2eBenchmark.
+# Azure OpenAI and Cognitive Search are HTTP servers so that the real SDK clients are measured.
+# Cosmos DB, Blob Storage and Redis are in-process objects with the interface of the services
+# in service/, since their SDKs are synchronous and talk binary / signed protocols.
+
+EMBEDDING_DIMENSIONS = 1536
+ANSWER = "福利厚生の申請は人事ポータルから行います。申請後、三営業日以内に担当者から連絡があります。[benefits-1.pdf]"
+DOCUMENT_TEXT = "社員は入社後三か月から福利厚生制度を利用できます。健康診断、住宅手当、育児休暇の申請は人事ポータルから行い、" \
+    "承認された申請は給与明細に反映されます。"
+
+
+class Fault:
+    """
+    Latency and error injection of one fake service.
+    """
+
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, status=503):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.status = status
+        self.calls = 0
+        self.errors = 0
+
+    def delay(self):
+        return max(0.0, self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+
+    def fails(self):
+        self.calls += 1
+        if random.random() < self.error_rate:
+            self.errors += 1
+            return True
+        return False
+
+    def sleep(self, error=None):
+        time.sleep(self.delay())
+        if self.fails() and error is not None:
+            raise error()
+
+    async def asleep(self, error=None):
+        await asyncio.sleep(self.delay())
+        if self.fails() and error is not None:
+            raise error()
+
+    def stats(self):
+        return {"calls": self.calls, "errors": self.errors}
+
+
+class FakeServer:
+    """
+    Runs an aiohttp application on its own event loop thread, so that the loop of the
+    benchmarked app only runs the client side and the synchronous SDK calls do not deadlock.
+    """
+
+    def __init__(self, app: web.Application):
+        self.app = app
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.runner = None
+        self.url = None
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+        return self.url
+
+    async def serve(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+async def inject(fault: Fault):
+    await asyncio.sleep(fault.delay())
+    if fault.fails():
+        # Azure OpenAI tells throttled clients when to retry
+        headers = {"retry-after": "1", "retry-after-ms": "100"} if fault.status == 429 else None
+        return web.json_response({"error": {"code": str(fault.status), "message": "Injected fault"}},
+                                 status=fault.status, headers=headers)
+    return None
+
+
+def count_tokens(text):
+    # Roughly one token per three characters, enough for the usage fields
+    return max(1, len(text) // 3)
+
+
+def embedding(text):
+    # Deterministic per text, so that the KNN search of the fake Redis returns stable neighbours
+    rng = np.random.default_rng(zlib.crc32(text.encode("utf-8")))
+    vector = rng.standard_normal(EMBEDDING_DIMENSIONS).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def agent_step(prompt):
+    """
+    Answers the langchain agents of /ask: searches once, then finishes.
+    """
+    tail = prompt.rsplit("Question:", 1)[-1]
+    question = tail.strip().split("\n")[0]
+    react = "Finish[" in prompt
+    if "Observation:" not in tail:
+        if react:
+            return f" I need to search {question}.\nAction: Search[{question}]"
+        return f" I need to search the benefits.\nAction: CognitiveSearch\nAction Input: {question}"
+    if react:
+        return f" I can answer the question.\nAction: Finish[{ANSWER}]"
+    return f" I now know the final answer.\nFinal Answer: {ANSWER}"
+
+
+def create_openai_app(fault: Fault, token_latency_ms=0.0, chunk_chars=4):
+    """
+    Azure OpenAI: chat completions (also streamed), completions and embeddings.
+    """
+
+    async def chat_completions(request: web.Request):
+        body = await request.json()
+        if (error := await inject(fault)) is not None:
+            return error
+        prompt = "".join(m.get("content") or "" for m in body.get("messages", []))
+        usage = {"prompt_tokens": count_tokens(prompt), "completion_tokens": count_tokens(ANSWER),
+                 "total_tokens": count_tokens(prompt) + count_tokens(ANSWER)}
+        if not body.get("stream"):
+            return web.json_response({
+                "id": str(uuid1()), "object": "chat.completion", "created": int(time.time()),
+                "model": request.match_info["deployment"], "usage": usage,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": ANSWER}}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta, finish_reason=None):
+            chunk = {"id": "chunk", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request.match_info["deployment"],
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+        await send({"role": "assistant"})
+        for i in range(0, len(ANSWER), chunk_chars):
+            await asyncio.sleep(token_latency_ms / 1000)
+            await send({"content": ANSWER[i:i + chunk_chars]})
+        await send({}, "stop")
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def completions(request: web.Request):
+        body = await request.json()
+        if (error := await inject(fault)) is not None:
+            return error
+        prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+        texts = [agent_step(prompt) for prompt in prompts]
+        prompt_tokens = sum(count_tokens(prompt) for prompt in prompts)
+        completion_tokens = sum(count_tokens(text) for text in texts)
+        return web.json_response({
+            "id": str(uuid1()), "object": "text_completion", "created": int(time.time()),
+            "model": request.match_info["deployment"],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+            "choices": [{"index": i, "text": text, "finish_reason": "stop", "logprobs": None}
+                        for i, text in enumerate(texts)]})
+
+    async def embeddings(request: web.Request):
+        body = await request.json()
+        if (error := await inject(fault)) is not None:
+            return error
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        tokens = sum(count_tokens(text) for text in inputs)
+        return web.json_response({
+            "object": "list", "model": request.match_info["deployment"],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            "data": [{"object": "embedding", "index": i, "embedding": embedding(text)}
+                     for i, text in enumerate(inputs)]})
+
+    app = web.Application()
+    app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    app.router.add_post("/openai/deployments/{deployment}/completions", completions)
+    app.router.add_post("/openai/deployments/{deployment}/embeddings", embeddings)
+    return app
+
+
+def create_search_app(fault: Fault, documents=50):
+    """
+    Azure Cognitive Search: search and indexing.
+    """
+    corpus = [{"id": f"doc-{i}",
+               "content": f"{DOCUMENT_TEXT} ({i})",
+               "category": "enterprise_data",
+               "sourcepage": f"benefits-{i}.pdf",
+               "sourcefile": "benefits.pdf"} for i in range(documents)]
+
+    async def search(request: web.Request):
+        body = await request.json()
+        if (error := await inject(fault)) is not None:
+            return error
+        top = int(body.get("top") or 50)
+        start = zlib.crc32((body.get("search") or "").encode("utf-8")) % len(corpus)
+        value = []
+        for rank, doc in enumerate((corpus[start:] + corpus[:start])[:top]):
+            value.append({**doc, "@search.score": 10.0 - rank * 0.1,
+                          "@search.captions": [{"text": doc["content"][:100], "highlights": None}]})
+        result = {"value": value}
+        if body.get("answers"):
+            result["@search.answers"] = [{"key": value[0]["id"], "text": value[0]["content"], "score": 0.9}] if value else []
+        return web.json_response(result)
+
+    async def index(request: web.Request):
+        body = await request.json()
+        if (error := await inject(fault)) is not None:
+            return error
+        return web.json_response({"value": [{"key": doc["id"], "status": True, "errorMessage": None, "statusCode": 201}
+                                            for doc in body["value"]]})
+
+    app = web.Application()
+    app.router.add_post("/indexes('{index}')/docs/search.post.search", search)
+    app.router.add_post("/indexes('{index}')/docs/search.index", index)
+    return app
+
+
+class FakeSearchIndexClient():
+    """
+    SearchIndexClient refuses plain http endpoints, the benchmark index always exists.
+    """
+
+    def __init__(self, index_name):
+        self.index_name = index_name
+
+    def list_index_names(self):
+        return [self.index_name]
+
+
+def cosmos_error():
+    return CosmosHttpResponseError(status_code=503, message="Injected fault")
+
+
+class FakeCosmosdbService():
+    """
+    The CosmosdbService methods called by the benchmarked routes, kept in memory.
+    """
+    partitioned_chat = False
+
+    def __init__(self, fault: Fault):
+        self.fault = fault
+        self.items = {}
+        self.lock = threading.Lock()
+        self.cache = TTLCache(300)
+
+    def upsert(self, item):
+        with self.lock:
+            self.items[item["id"]] = item
+        return dict(item)
+
+    def get_chat(self, chat_id):
+        self.fault.sleep(cosmos_error)
+        return dict(self.items[chat_id])
+
+    def update_chat(self, chat_id, chat_name, openai_model):
+        self.fault.sleep(cosmos_error)
+        item = self.items.get(chat_id) or {
+            "id": chat_id, "type": constants.DB_TYPE_CHAT, "chat_type": "qa", "created_user": "benchmark",
+            "create_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        return self.upsert({**item, "chat_name": chat_name, "openai_model": openai_model})
+
+    def add_chat_content(self, chat_id, index, chat_type, question, answer, details=""):
+        self.fault.sleep(cosmos_error)
+        self.upsert({"id": str(uuid1()), "type": constants.DB_TYPE_CONTENT, "chat_id": chat_id, "index": index,
+                     "question": question, "answer": answer["answer"], "details": details})
+
+    def insert_file_info(self, file_data):
+        self.fault.sleep(cosmos_error)
+        self.upsert({"id": file_data["file_id"], "type": constants.DB_TYPE_FILE_INFO,
+                     "file_status": "エンベディング処理中", **file_data})
+
+    def update_file_status(self, file_id, file_status, etag=None):
+        self.fault.sleep(cosmos_error)
+        return self.upsert({**self.items[file_id], "file_status": file_status})
+
+
+def blob_error():
+    return HttpResponseError(message="Injected fault")
+
+
+class FakeBlob():
+
+    def __init__(self, data):
+        self.data = data
+
+    def readall(self):
+        return self.data
+
+
+class FakeBlobStorageService():
+    """
+    The BlobStorageService methods called by the benchmarked routes, kept in memory.
+    """
+
+    def __init__(self, fault: Fault):
+        self.fault = fault
+        self.blobs = {}
+
+    def get_blob(self, file_name):
+        self.fault.sleep(blob_error)
+        if file_name not in self.blobs:
+            raise ResourceNotFoundError(message=f"{file_name} does not exist")
+        return FakeBlob(self.blobs[file_name])
+
+    def upload_blobs(self, filename, file_id):
+        self.fault.sleep(blob_error)
+        with open(filename, "rb") as f:
+            self.blobs[file_id] = f.read()
+        return f"https://benchmark.blob.core.windows.net/content/{file_id}"
+
+    def upload_data(self, blob_name, data):
+        self.fault.sleep(blob_error)
+        self.blobs[blob_name] = data
+
+    def delete_data(self, blob_name):
+        self.fault.sleep(blob_error)
+        self.blobs.pop(blob_name, None)
+
+    def delete_prefix(self, prefix):
+        self.fault.sleep(blob_error)
+        for name in [name for name in self.blobs if name.startswith(prefix)]:
+            del self.blobs[name]
+
+
+def redis_error():
+    return RedisConnectionError("Injected fault")
+
+
+def encode(value):
+    # redis-py returns bytes
+    return value if isinstance(value, bytes) else str(value).encode("utf-8")
+
+
+class FakePipeline():
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def execute(self):
+        # A pipeline is one round trip
+        self.client.fault.sleep(redis_error)
+        results = [getattr(self.client, name)(*args, round_trip=False, **kwargs)
+                   for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class FakeRedisClient():
+    """
+    The redis-py commands used by ChatListViewService and TokenUsageService, one fault per round trip.
+    """
+
+    def __init__(self, fault: Fault):
+        self.fault = fault
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def call(self, round_trip):
+        if round_trip:
+            self.fault.sleep(redis_error)
+        return self.lock
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def exists(self, *keys, round_trip=True):
+        with self.call(round_trip):
+            return sum(1 for key in keys if key in self.data)
+
+    def get(self, key, round_trip=True):
+        with self.call(round_trip):
+            return self.data.get(key)
+
+    def set(self, key, value, nx=False, ex=None, round_trip=True):
+        with self.call(round_trip):
+            if nx and key in self.data:
+                return None
+            self.data[key] = value.encode("utf-8") if isinstance(value, str) else value
+            return True
+
+    def delete(self, *keys, round_trip=True):
+        with self.call(round_trip):
+            return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    def hset(self, key, field, value, round_trip=True):
+        with self.call(round_trip):
+            self.data.setdefault(key, {})[field] = value.encode("utf-8") if isinstance(value, str) else value
+            return 1
+
+    def hdel(self, key, *fields, round_trip=True):
+        with self.call(round_trip):
+            return sum(1 for field in fields if self.data.get(key, {}).pop(field, None) is not None)
+
+    def hincrby(self, key, field, amount=1, round_trip=True):
+        with self.call(round_trip):
+            hash = self.data.setdefault(key, {})
+            hash[field] = int(hash.get(field, 0)) + amount
+            return hash[field]
+
+    def zadd(self, key, mapping, round_trip=True):
+        with self.call(round_trip):
+            self.data.setdefault(key, {}).update(mapping)
+            return len(mapping)
+
+    def zrem(self, key, *members, round_trip=True):
+        with self.call(round_trip):
+            return sum(1 for member in members if self.data.get(key, {}).pop(member, None) is not None)
+
+    def zincrby(self, key, amount, member, round_trip=True):
+        with self.call(round_trip):
+            zset = self.data.setdefault(key, {})
+            zset[member] = zset.get(member, 0) + amount
+            return zset[member]
+
+    def expire(self, key, seconds, round_trip=True):
+        with self.call(round_trip):
+            return key in self.data
+
+    def hgetall(self, key, round_trip=True):
+        with self.call(round_trip):
+            return {encode(field): encode(value) for field, value in self.data.get(key, {}).items()}
+
+    def zrevrange(self, key, start, end, withscores=False, round_trip=True):
+        with self.call(round_trip):
+            members = sorted(self.data.get(key, {}).items(), key=lambda item: -item[1])[start:end + 1]
+            return [(encode(member), score) if withscores else encode(member) for member, score in members]
+
+
+class FakeRedisService():
+    """
+    The RedisService methods called by RetrieveChatApproach; the KNN search is brute force.
+    """
+
+    def __init__(self, fault: Fault):
+        self.fault = fault
+        self.sources = {}
+        self.chat_sources = {}
+        self.manifests = {}
+        self.url_cache = {}
+
+    def has_source(self, source_hash):
+        self.fault.sleep(redis_error)
+        return source_hash in self.sources
+
+    def store_source(self, source_hash, resource, texts, embeddings):
+        self.fault.sleep(redis_error)
+        self.sources[source_hash] = [(f"source:{source_hash}:{i}", text, resource, np.array(vector, dtype=np.float32))
+                                     for i, (text, vector) in enumerate(zip(texts, embeddings))]
+
+    def link_source(self, chatid, source_hash):
+        self.fault.sleep(redis_error)
+        if source_hash not in self.sources:
+            return False
+        self.chat_sources.setdefault(chatid, set()).add(source_hash)
+        return True
+
+    def get_chat_sources(self, chatid):
+        self.fault.sleep(redis_error)
+        return list(self.chat_sources.get(chatid, set()))
+
+    def set_manifest(self, chatid, resource_key, source_hash):
+        self.fault.sleep(redis_error)
+        self.manifests.setdefault(chatid, {})[resource_key] = source_hash
+
+    def get_manifest(self, chatid):
+        self.fault.sleep(redis_error)
+        return dict(self.manifests.get(chatid, {}))
+
+    def source_blob_name(self, source_hash):
+        return f"retrievechat/{source_hash}"
+
+    def touch_chat(self, chatid):
+        self.fault.sleep(redis_error)
+
+    def count_rehydration(self):
+        self.fault.sleep(redis_error)
+
+    def get_url_cache(self, url):
+        self.fault.sleep(redis_error)
+        return self.url_cache.get(url)
+
+    def set_url_cache(self, url, source_hash, etag="", last_modified=""):
+        self.fault.sleep(redis_error)
+        self.url_cache[url] = {"source_hash": source_hash, "etag": etag, "last_modified": last_modified}
+
+    async def knn_search(self, vector, chatid, source_hashes, k):
+        await self.fault.asleep(redis_error)
+        chunks = [chunk for source_hash in source_hashes for chunk in self.sources.get(source_hash, [])]
+        if not chunks:
+            return []
+        query = np.array(vector, dtype=np.float32)
+        # Cosine distance, as the COSINE index of RedisService
+        distances = 1 - np.stack([chunk[3] for chunk in chunks]) @ query / np.linalg.norm(query)
+        return [{"id": chunks[i][0], "content": chunks[i][1], "resource": chunks[i][2], "distance": float(distances[i])}
+                for i in np.argsort(distances)[:k]]
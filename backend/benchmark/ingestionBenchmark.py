@@ -0,0 +1,293 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import tiktoken
+
+from core.messagebuilder import MessageBuilder
+from core.modelhelper import num_tokens_from_messages
+from service.cognitiveSearchService import CognitiveSearchService
+from service.formRecognizerService import FormRecognizerService
+
+# Time and peak memory of the ingestion hot paths on synthetic inputs of several sizes, without network:
+#   python -m benchmark.ingestionBenchmark --output ingestion.json
+#   python -m benchmark.ingestionBenchmark --baseline ingestion.json
+# The scaling exponent (slope of log time over log size) flags algorithmic regressions independently of the machine.
+
+MODEL = "gpt-35-turbo"
+PAGE_CHARS = 3000
+TABLES_PER_PAGE = 3
+TABLE_ROWS = 12
+TABLE_COLUMNS = 6
+EMBEDDING = [0.0] * 1536
+WORDS = ["benefit", "employee", "plan", "coverage", "claim", "policy", "deductible", "network",
+         "provider", "premium", "dental", "vision", "retirement", "contribution", "handbook"]
+
+
+def sentence(rng):
+    words = rng.choices(WORDS, k=rng.randint(6, 18))
+    return " ".join(words).capitalize() + rng.choice([".", ".", ".", "!", "?", ","]) + " "
+
+
+def page_text(rng, chars):
+    text = ""
+    while len(text) < chars:
+        text += sentence(rng)
+    return text[:chars]
+
+
+def table_html(rng, rows, columns):
+    cells = "".join("<tr>" + "".join(f"<td>{rng.choice(WORDS)}</td>" for _ in range(columns)) + "</tr>"
+                    for _ in range(rows))
+    return f"<table>{cells}</table>"
+
+
+def generate_page_map(pages, seed=0):
+    """
+    (page_num, offset, text) as returned by get_document_text, with html tables between the paragraphs.
+    """
+    rng = random.Random(seed)
+    page_map = []
+    offset = 0
+    for page_num in range(pages):
+        text = ""
+        for _ in range(TABLES_PER_PAGE):
+            text += page_text(rng, PAGE_CHARS // TABLES_PER_PAGE) + table_html(rng, 4, TABLE_COLUMNS)
+        page_map.append((page_num, offset, text))
+        offset += len(text)
+    return page_map
+
+
+def generate_table(rows, columns, page_number=1, offset=0, seed=0):
+    rng = random.Random(seed)
+    cells = []
+    for row in range(rows):
+        for column in range(columns):
+            cells.append(SimpleNamespace(
+                row_index=row, column_index=column, content=f"{rng.choice(WORDS)} & {row}-{column}",
+                kind="columnHeader" if row == 0 else "content",
+                column_span=2 if row == 0 and column == 0 else 1, row_span=1))
+    # Cells of the prebuilt-layout result are not in row order
+    rng.shuffle(cells)
+    length = sum(len(cell.content) + 1 for cell in cells)
+    return SimpleNamespace(row_count=rows, column_count=columns, cells=cells,
+                           bounding_regions=[SimpleNamespace(page_number=page_number)],
+                           spans=[SimpleNamespace(offset=offset, length=length)])
+
+
+def generate_layout(pages, seed=0):
+    """
+    A prebuilt-layout result: every page holds paragraphs and TABLES_PER_PAGE tables whose spans cover part of the content.
+    """
+    rng = random.Random(seed)
+    content = ""
+    result_pages = []
+    tables = []
+    for page_num in range(pages):
+        page_offset = len(content)
+        for table_num in range(TABLES_PER_PAGE):
+            content += page_text(rng, PAGE_CHARS // TABLES_PER_PAGE)
+            table = generate_table(TABLE_ROWS, TABLE_COLUMNS, page_num + 1, len(content),
+                                   seed=seed + page_num * TABLES_PER_PAGE + table_num)
+            content += "x" * table.spans[0].length
+            tables.append(table)
+        result_pages.append(SimpleNamespace(
+            spans=[SimpleNamespace(offset=page_offset, length=len(content) - page_offset)]))
+    return SimpleNamespace(content=content, pages=result_pages, tables=tables)
+
+
+def generate_history(messages, seed=0):
+    rng = random.Random(seed)
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": page_text(rng, 400)}
+            for i in range(messages)]
+
+
+class FakeLayoutClient:
+    # begin_analyze_document returns a poller whose result is the synthetic layout
+    def __init__(self, result):
+        self.result = result
+
+    def begin_analyze_document(self, model_id, document):
+        document.read()
+        return SimpleNamespace(result=lambda: self.result)
+
+
+class FakeOpenaiService:
+    def compute_embedding(self, text):
+        return EMBEDDING
+
+
+def search_service():
+    # __init__ needs the app context and the search endpoints, the benchmarked methods only need the embeddings
+    service = CognitiveSearchService.__new__(CognitiveSearchService)
+    service.openai_service = FakeOpenaiService()
+    return service
+
+
+def bench_split_text(pages):
+    page_map = generate_page_map(pages)
+    service = search_service()
+    return lambda: list(service.split_text(page_map, "benchmark.pdf"))
+
+
+def bench_create_sections(pages):
+    page_map = generate_page_map(pages)
+    service = search_service()
+    return lambda: list(service.create_sections(page_map, "benchmark.pdf", "benchmark", "tag", "folder"))
+
+
+def bench_get_document_text(pages, path):
+    service = FormRecognizerService.__new__(FormRecognizerService)
+    service.form_recognizer_client = FakeLayoutClient(generate_layout(pages))
+    return lambda: service.get_document_text(path)
+
+
+def bench_table_to_html(rows):
+    table = generate_table(rows, TABLE_COLUMNS)
+    service = FormRecognizerService.__new__(FormRecognizerService)
+    return lambda: service.table_to_html(table)
+
+
+def bench_message_builder(messages):
+    history = generate_history(messages)
+
+    def build():
+        # Same order as the chat approaches: the newest message is inserted right after the system prompt
+        builder = MessageBuilder("You are an assistant.", MODEL)
+        for message in reversed(history):
+            builder.append_message(message["role"], message["content"], index=1)
+        return builder.token_length
+    return build
+
+
+def bench_num_tokens_from_messages(chars):
+    message = {"role": "user", "content": page_text(random.Random(0), chars)}
+    return lambda: num_tokens_from_messages(message, MODEL)
+
+
+def tiktoken_available():
+    # tiktoken downloads the encodings on first use, offline runs need them in TIKTOKEN_CACHE_DIR
+    try:
+        tiktoken.get_encoding("cl100k_base")
+        return True
+    except Exception:
+        return False
+
+
+def measure(func, repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()  # warm up
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append((time.perf_counter() - start) * 1000)
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return times, peak
+
+
+def scaling_exponent(sizes, times):
+    # 1 is linear, 2 quadratic
+    if len(sizes) < 2:
+        return None
+    return round(float(np.polyfit(np.log(sizes), np.log(times), 1)[0]), 2)
+
+
+def compare(report, baseline, tolerance):
+    """
+    Returns the rows slower than the baseline by more than the tolerance, or scaling worse than it.
+    """
+    previous = {(row["function"], row["size"]): row for row in baseline["results"]}
+    exponents = baseline.get("scaling", {})
+    regressions = []
+    for row in report["results"]:
+        before = previous.get((row["function"], row["size"]))
+        if before and row["median_ms"] > before["median_ms"] * tolerance:
+            regressions.append(f"{row['function']} size={row['size']}: "
+                               f"{before['median_ms']} ms -> {row['median_ms']} ms")
+    for function, exponent in report["scaling"].items():
+        before = exponents.get(function)
+        if before is not None and exponent is not None and exponent > before + 0.5:
+            regressions.append(f"{function} scaling exponent: {before} -> {exponent}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of the document ingestion and prompt building")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies every input size")
+    parser.add_argument("--only", help="Comma separated function names")
+    parser.add_argument("--output", help="Write the results as json")
+    parser.add_argument("--baseline", help="Fail if slower than this json by more than --tolerance")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    # (function, unit of size, sizes, setup)
+    suites = [
+        ("split_text", "pages", [10, 50, 200], bench_split_text),
+        ("create_sections", "pages", [10, 50, 200], bench_create_sections),
+        ("get_document_text", "pages", [10, 50, 200], lambda size: bench_get_document_text(size, path)),
+        ("table_to_html", "rows", [10, 100, 1000], bench_table_to_html),
+        ("MessageBuilder", "messages", [10, 100, 1000], bench_message_builder),
+        ("num_tokens_from_messages", "chars", [1000, 10000, 100000], bench_num_tokens_from_messages),
+    ]
+    only = args.only.split(",") if args.only else None
+    has_tiktoken = tiktoken_available()
+
+    report = {"results": [], "scaling": {}, "skipped": []}
+    try:
+        for function, unit, sizes, setup in suites:
+            if only and function not in only:
+                continue
+            if function in ("MessageBuilder", "num_tokens_from_messages") and not has_tiktoken:
+                print(f"{function}: skipped, the tiktoken encoding is not cached")
+                report["skipped"].append(function)
+                continue
+            sizes = [max(1, int(size * args.scale)) for size in sizes]
+            medians = []
+            for size in sizes:
+                times, peak = measure(setup(size), args.repeat)
+                row = {
+                    "function": function,
+                    "unit": unit,
+                    "size": size,
+                    "median_ms": round(float(np.median(times)), 3),
+                    "min_ms": round(float(np.min(times)), 3),
+                    "peak_kib": round(peak / 1024, 1),
+                }
+                medians.append(row["median_ms"])
+                print(" ".join(f"{k}={v}" for k, v in row.items()), flush=True)
+                report["results"].append(row)
+            report["scaling"][function] = scaling_exponent(sizes, medians)
+            print(f"{function}: scaling exponent {report['scaling'][function]}")
+    finally:
+        os.remove(path)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
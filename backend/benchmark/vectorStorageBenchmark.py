@@ -0,0 +1,171 @@
+import argparse
+import json
+import time
+
+import numpy as np
+import redis
+from redis.commands.search.query import Query
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.field import VectorField, TagField, TextField
+
+# Compares the memory, recall@k and latency of the retrieve-chat vector index for each storage type.
+# Run against a local redis-stack (docker-compose.yml): python -m benchmark.vectorStorageBenchmark
+# Without redis, --offline measures only the effect of the storage type itself: the vector bytes and the
+# recall@k of an exact search over the stored (rounded) vectors, without the HNSW index.
+
+DIM = 1536
+VECTOR_DTYPES = {"FLOAT32": np.float32, "FLOAT16": np.float16}
+
+
+def generate_vectors(count, clusters, seed):
+    # Embeddings of one chat are close to each other, so use clustered unit vectors
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, DIM)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + \
+        0.5 * rng.standard_normal((count, DIM)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def create_index(client, name, vector_type):
+    # Same schema as RedisService.create_index
+    client.ft(name).create_index(
+        fields=[TextField(name="content"), TextField(name="chat_id"), TextField(name="source"),
+                TextField(name="resource"), TagField(name="source_hash"),
+                VectorField("content_vector", "HNSW", {
+                    "TYPE": vector_type,
+                    "DIM": DIM,
+                    "DISTANCE_METRIC": "COSINE",
+                    "INITIAL_CAP": 2000,
+                })],
+        definition=IndexDefinition(prefix=[f"{name}:"], index_type=IndexType.HASH))
+
+
+def load(client, name, vectors, dtype):
+    pipeline = client.pipeline(transaction=False)
+    for i, vector in enumerate(vectors):
+        pipeline.hset(f"{name}:{i}", mapping={
+            "content": "x" * 200,
+            "chat_id": "",
+            "source": "benchmark",
+            "resource": "benchmark",
+            "source_hash": "benchmark",
+            "content_vector": vector.astype(dtype).tobytes(),
+        })
+        if i % 1000 == 0:
+            pipeline.execute()
+    pipeline.execute()
+    # Wait for the background indexing
+    while float(client.ft(name).info().get("percent_indexed", 1)) < 1:
+        time.sleep(0.5)
+
+
+def memory_per_chunk(client, name, count, sample):
+    info = client.ft(name).info()
+    index_bytes = float(info["vector_index_sz_mb"]) * 1024 * 1024
+    keys = [f"{name}:{i}" for i in range(0, count, max(1, count // sample))]
+    key_bytes = sum(client.memory_usage(key) for key in keys) / len(keys)
+    return key_bytes, index_bytes / count
+
+
+def query(client, name, queries, dtype, k):
+    results = []
+    latencies = []
+    for vector in queries:
+        q = Query(f"*=>[KNN {k} @content_vector $vector AS distance]") \
+            .return_fields("distance") \
+            .sort_by("distance") \
+            .paging(0, k) \
+            .dialect(2)
+        start = time.perf_counter()
+        res = client.ft(name).search(q, {"vector": vector.astype(dtype).tobytes()})
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([int(doc.id.split(":")[-1]) for doc in res.docs])
+    return results, latencies
+
+
+def offline(vectors, queries, truth, vector_type, k):
+    dtype = VECTOR_DTYPES[vector_type]
+    stored = vectors.astype(dtype).astype(np.float32)
+    encoded = queries.astype(dtype).astype(np.float32)
+    start = time.perf_counter()
+    results = np.argsort(-(encoded @ stored.T), axis=1)[:, :k]
+    seconds = time.perf_counter() - start
+    recall = np.mean([len(set(r) & set(t)) / k for r, t in zip(results, truth)])
+    return {
+        "type": vector_type,
+        "chunks": len(vectors),
+        "vector_bytes_per_chunk": DIM * np.dtype(dtype).itemsize,
+        f"exact_recall@{k}": round(float(recall), 4),
+        "exact_search_ms_per_query": round(seconds * 1000 / len(queries), 3),
+    }
+
+
+def drop(client, name, count):
+    try:
+        client.ft(name).dropindex(delete_documents=False)
+    except redis.ResponseError:
+        pass
+    for start in range(0, count, 1000):
+        client.delete(*[f"{name}:{i}" for i in range(start, min(count, start + 1000))])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the retrieve-chat vector storage types")
+    parser.add_argument("--redis-url", default="redis://localhost:6379")
+    parser.add_argument("--chunks", type=int, default=10000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--types", default="FLOAT32,FLOAT16")
+    parser.add_argument("--offline", action="store_true",
+                        help="Compare the stored vectors without redis (no index memory or HNSW recall)")
+    parser.add_argument("--output", help="Write the results as json")
+    args = parser.parse_args()
+
+    vectors = generate_vectors(args.chunks, args.clusters, seed=0)
+    queries = generate_vectors(args.queries, args.clusters, seed=1)
+    # Exact top-k in float32 as ground truth
+    truth = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+
+    report = []
+    if args.offline:
+        report = [offline(vectors, queries, truth, vector_type, args.k) for vector_type in args.types.split(",")]
+    client = None if args.offline else redis.from_url(args.redis_url)
+    for vector_type in [] if args.offline else args.types.split(","):
+        name = f"benchmark-{vector_type.lower()}"
+        dtype = VECTOR_DTYPES[vector_type]
+        drop(client, name, args.chunks)
+        try:
+            create_index(client, name, vector_type)
+            start = time.perf_counter()
+            load(client, name, vectors, dtype)
+            load_seconds = time.perf_counter() - start
+            key_bytes, index_bytes = memory_per_chunk(
+                client, name, args.chunks, sample=100)
+            results, latencies = query(client, name, queries, dtype, args.k)
+            recall = np.mean([len(set(r) & set(t)) / args.k
+                             for r, t in zip(results, truth)])
+            report.append({
+                "type": vector_type,
+                "chunks": args.chunks,
+                "key_bytes_per_chunk": round(key_bytes),
+                "index_bytes_per_chunk": round(index_bytes),
+                "total_bytes_per_chunk": round(key_bytes + index_bytes),
+                f"recall@{args.k}": round(float(recall), 4),
+                "latency_p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                "latency_p95_ms": round(float(np.percentile(latencies, 95)), 3),
+                "load_seconds": round(load_seconds, 2),
+            })
+        finally:
+            drop(client, name, args.chunks)
+
+    for row in report:
+        print(" ".join(f"{k}={v}" for k, v in row.items()))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import json
 
 OPENAI_MODEL = {
     "gpt-35-turbo": {
@@ -19,9 +20,18 @@ OPENAI_MODEL = {
         "maxtoken": 32768}
 }
 
+# モデル毎に複数のエンドポイント・デプロイを振り分ける（JSON）。キーは OPENAI_MODEL のモデル名またはデプロイ名
+# 例 {"gpt-4": [{"service": "aoai-east", "key": "...", "deployment": "gpt-4", "weight": 2},
+#              {"service": "aoai-west", "key": "...", "deployment": "gpt-4", "weight": 1}]}
+# 指定しないモデルは AZURE_OPENAI_SERVICE のデプロイのみを使う
+OPENAI_ENDPOINTS = json.loads(os.getenv("AZURE_OPENAI_ENDPOINTS", "{}"))
+
 DB_TYPE_CHAT = "chat"
 DB_TYPE_CONTENT = "content"
 DB_TYPE_USER_INFO = "user-info"
 DB_TYPE_LOGIN_HISTORY = "login-history"
+DB_TYPE_LOGIN_SUMMARY = "login-summary"
 DB_TYPE_FILE_INFO = "file-info"
+DB_TYPE_FILE_FACET = "file-facet"
 DB_TYPE_FOLDER_INFO = "folder-info"
+DB_TYPE_MIGRATION = "migration"
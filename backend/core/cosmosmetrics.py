@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import contextvars
+import functools
+import os
+import threading
+import time
+from collections import deque
+
+from opentelemetry import metrics
+
+# プロビジョニングした RU/s と、バックグラウンド処理が使ってよい割合
+COSMOSDB_RU_PER_SECOND = float(os.getenv("AZURE_COSMOSDB_RU_PER_SECOND", "400"))
+COSMOSDB_BACKGROUND_RU_SHARE = float(os.getenv("AZURE_COSMOSDB_BACKGROUND_RU_SHARE", "0.5"))
+# バックグラウンド処理を待たせる最大時間（秒）
+COSMOSDB_BACKGROUND_MAX_WAIT = float(os.getenv("AZURE_COSMOSDB_BACKGROUND_MAX_WAIT", "30"))
+
+meter = metrics.get_meter("cosmosdb")
+request_charge_histogram = meter.create_histogram(
+    "cosmosdb.request_charge", unit="RU", description="Request charge of each Cosmos DB request")
+duration_histogram = meter.create_histogram(
+    "cosmosdb.duration", unit="ms", description="Duration of each CosmosdbService method including retries")
+throttle_counter = meter.create_counter(
+    "cosmosdb.throttled_requests", description="Requests rejected with 429 and retried by the SDK")
+background_wait_histogram = meter.create_histogram(
+    "cosmosdb.background_wait", unit="ms", description="Time background work waited for the RU budget")
+
+current_method = contextvars.ContextVar("cosmosdb_method", default=None)
+is_background = contextvars.ContextVar("cosmosdb_background", default=False)
+
+
+class RequestUnitBudget:
+    """
+    Tracks the RU consumed by this worker in the last second.
+    Background work waits while the consumption is above its share or after a 429,
+    so that interactive requests keep the throughput.
+    """
+
+    def __init__(self, ru_per_second: float, background_share: float, max_wait: float):
+        self.background_limit = ru_per_second * background_share
+        self.max_wait = max_wait
+        self.window: deque[tuple[float, float]] = deque()
+        self.lock = threading.Lock()
+        self.throttled_until = 0.0
+        self.throttled = 0
+
+    def record(self, charge: float):
+        now = time.monotonic()
+        with self.lock:
+            self.window.append((now, charge))
+            self.prune(now)
+
+    def record_throttle(self, retry_after_ms: float):
+        with self.lock:
+            self.throttled += 1
+            self.throttled_until = max(
+                self.throttled_until, time.monotonic() + retry_after_ms / 1000)
+
+    def prune(self, now: float):
+        while self.window and self.window[0][0] < now - 1:
+            self.window.popleft()
+
+    def used(self) -> float:
+        with self.lock:
+            self.prune(time.monotonic())
+            return sum(charge for _, charge in self.window)
+
+    def wait(self):
+        start = time.monotonic()
+        deadline = start + self.max_wait
+        while time.monotonic() < deadline:
+            if time.monotonic() >= self.throttled_until and self.used() < self.background_limit:
+                break
+            time.sleep(0.1)
+        background_wait_histogram.record((time.monotonic() - start) * 1000)
+
+    def stats(self) -> dict:
+        return {
+            "ru_last_second": round(self.used(), 2),
+            "background_limit": self.background_limit,
+            "throttled": self.throttled,
+            "backing_off": time.monotonic() < self.throttled_until,
+        }
+
+
+budget = RequestUnitBudget(COSMOSDB_RU_PER_SECOND,
+                           COSMOSDB_BACKGROUND_RU_SHARE, COSMOSDB_BACKGROUND_MAX_WAIT)
+
+
+def response_hook(response):
+    """
+    raw_response_hook of the CosmosClient, called for every HTTP attempt including the retried 429s.
+    """
+    http_response = response.http_response
+    headers = http_response.headers
+    attributes = {"method": current_method.get() or "unknown",
+                  "background": is_background.get(),
+                  "status_code": http_response.status_code}
+    charge = float(headers.get("x-ms-request-charge", 0) or 0)
+    request_charge_histogram.record(charge, attributes)
+    budget.record(charge)
+    if http_response.status_code == 429:
+        throttle_counter.add(1, attributes)
+        budget.record_throttle(
+            float(headers.get("x-ms-retry-after-ms", 1000) or 1000))
+
+
+def wait_for_budget():
+    # バックグラウンド処理の場合のみ待つ
+    if is_background.get():
+        budget.wait()
+
+
+def background(func):
+    """
+    Marks a method as background work: it waits for the RU budget before running.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = is_background.set(True)
+        try:
+            budget.wait()
+            return func(*args, **kwargs)
+        finally:
+            is_background.reset(token)
+    return wrapper
+
+
+def instrumented(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # 入れ子の呼び出しは外側のメソッドとして記録する
+        if current_method.get() is not None:
+            return func(*args, **kwargs)
+        token = current_method.set(func.__name__)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # background のメソッドは RU の待ち時間も含む（待ち時間は cosmosdb.background_wait）
+            duration_histogram.record((time.perf_counter() - start) * 1000,
+                                      {"method": func.__name__})
+            current_method.reset(token)
+    return wrapper
+
+
+def instrument_methods(cls):
+    """
+    Class decorator recording the RU charge and duration of every public method.
+    """
+    for name, value in list(vars(cls).items()):
+        if callable(value) and not name.startswith("_"):
+            setattr(cls, name, instrumented(value))
+    return cls
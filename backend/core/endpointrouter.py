@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Optional
+
+from constants.constants import OPENAI_ENDPOINTS, OPENAI_MODEL
+from core import ratelimiter
+from core.ratelimiter import INTERACTIVE, BACKGROUND
+
+OPENAI_API_VERSION = "2023-05-15"
+# 429・5xx を返したエンドポイントを使わない秒数（5xx は連続する度に倍にする）
+OPENAI_ENDPOINT_COOLDOWN = float(os.getenv("OPENAI_ENDPOINT_COOLDOWN", "10"))
+OPENAI_ENDPOINT_MAX_COOLDOWN = float(os.getenv("OPENAI_ENDPOINT_MAX_COOLDOWN", "120"))
+# 他のワーカーと状態を共有する間隔（秒）
+OPENAI_ENDPOINT_SYNC_INTERVAL = float(os.getenv("OPENAI_ENDPOINT_SYNC_INTERVAL", "5"))
+# 応答時間が未計測のエンドポイントの想定（ミリ秒）。小さいほど新しいエンドポイントを試す
+OPENAI_ENDPOINT_DEFAULT_LATENCY_MS = 1000
+LATENCY_SMOOTHING = 0.2
+ENDPOINT_STATE_PREFIX = "openai_endpoint"
+
+
+class Endpoint:
+    """
+    One deployment on one Azure OpenAI resource. Without api_base the global openai settings are used.
+    """
+
+    def __init__(self, deployment: str, service: str = "", api_base: Optional[str] = None,
+                 api_key: Optional[str] = None, weight: float = 1.0):
+        self.deployment = deployment
+        self.api_base = api_base or (f"https://{service}.openai.azure.com" if service else None)
+        self.api_key = api_key
+        self.weight = weight
+        self.id = f"{service or self.api_base}/{deployment}" if self.api_base else deployment
+        # 他のエンドポイントに切り替えられる（状態をワーカー間で共有する）
+        self.shared = False
+        self.latency_ms: Optional[float] = None
+        # time.time()（ワーカー間で共有するため）
+        self.cooldown_until = 0.0
+        self.failures = 0
+
+    def params(self) -> dict[str, Any]:
+        """
+        Keyword arguments of the openai calls, the deployment is passed by the caller.
+        """
+        if not self.api_base:
+            return {}
+        return {"api_base": self.api_base, "api_key": self.api_key, "api_type": "azure", "api_version": OPENAI_API_VERSION}
+
+    def state(self) -> dict[str, Any]:
+        return {"deployment": self.deployment,
+                "weight": self.weight,
+                "latency_ms": round(self.latency_ms, 1) if self.latency_ms is not None else None,
+                "cooldown_seconds": round(max(0.0, self.cooldown_until - time.time()), 1),
+                "failures": self.failures,
+                **ratelimiter.get_limiter(self.id).stats()}
+
+
+class EndpointRouter:
+    """
+    Routes the calls of a deployment to one of its endpoints, by weight, observed latency and the
+    headroom left in the endpoint's limiter. Endpoints returning 429 or 5xx are skipped until their
+    cooldown ends; cooldowns and latencies are shared with the other workers through Redis.
+    """
+
+    def __init__(self):
+        self.groups: dict[str, list[Endpoint]] = {}
+        self.lock = threading.Lock()
+        self.client = None
+
+    def connect(self, redis_client):
+        self.client = redis_client
+
+    def endpoints(self, deployment: str) -> list[Endpoint]:
+        with self.lock:
+            if deployment not in self.groups:
+                self.groups[deployment] = self.load(deployment)
+            return self.groups[deployment]
+
+    def load(self, deployment: str) -> list[Endpoint]:
+        config = OPENAI_ENDPOINTS.get(deployment)
+        if config is None:
+            config = next((OPENAI_ENDPOINTS[name] for name, info in OPENAI_MODEL.items()
+                           if info["deployment"] == deployment and name in OPENAI_ENDPOINTS), None)
+        if not config:
+            return [Endpoint(deployment)]
+        endpoints = [Endpoint(item.get("deployment", deployment), item.get("service", ""), item.get("endpoint"),
+                              item.get("key"), float(item.get("weight", 1))) for item in config]
+        for endpoint in endpoints:
+            endpoint.shared = len(endpoints) > 1
+        return endpoints
+
+    def score(self, endpoint: Endpoint) -> float:
+        stats = ratelimiter.get_limiter(endpoint.id).stats()
+        headroom = max(0.05, 1 - stats["in_flight"] / max(1.0, stats["limit"]))
+        if stats["tpm"]:
+            headroom *= max(0.05, stats["tokens"] / stats["tpm"])
+        latency = endpoint.latency_ms if endpoint.latency_ms is not None else OPENAI_ENDPOINT_DEFAULT_LATENCY_MS
+        return endpoint.weight * headroom / max(latency, 1.0)
+
+    def choose(self, deployment: str, exclude: set[str] = frozenset()) -> Endpoint:
+        endpoints = self.endpoints(deployment)
+        if len(endpoints) == 1:
+            return endpoints[0]
+        now = time.time()
+        available = [e for e in endpoints if e.id not in exclude] or endpoints
+        candidates = [e for e in available if e.cooldown_until <= now]
+        if not candidates:
+            # 全てクールダウン中の場合は最も早く使えるようになるエンドポイント
+            return min(available, key=lambda e: e.cooldown_until)
+        scores = [self.score(e) for e in candidates]
+        return random.choices(candidates, weights=scores)[0]
+
+    def has_alternative(self, deployment: str, exclude: set[str]) -> bool:
+        now = time.time()
+        return any(e.id not in exclude and e.cooldown_until <= now for e in self.endpoints(deployment))
+
+    def succeeded(self, endpoint: Endpoint, seconds: float):
+        latency_ms = seconds * 1000
+        endpoint.latency_ms = latency_ms if endpoint.latency_ms is None else \
+            endpoint.latency_ms + LATENCY_SMOOTHING * (latency_ms - endpoint.latency_ms)
+        endpoint.failures = 0
+
+    def failed(self, endpoint: Endpoint, error: Exception) -> bool:
+        """
+        Puts the endpoint in cooldown. Returns True when the cooldown should be shared with publish().
+        """
+        if not endpoint.shared:
+            # 切り替え先がない場合は limiter の retry-after とバックオフに任せる
+            return False
+        endpoint.failures += 1
+        cooldown = ratelimiter.retry_after(error) if ratelimiter.is_throttled(error) else None
+        if cooldown is None:
+            cooldown = min(OPENAI_ENDPOINT_MAX_COOLDOWN, OPENAI_ENDPOINT_COOLDOWN * 2 ** (endpoint.failures - 1))
+        endpoint.cooldown_until = max(endpoint.cooldown_until, time.time() + cooldown)
+        logging.warning(f"OpenAI endpoint {endpoint.id} failed ({error}), skipped for {cooldown:.1f}s")
+        return self.client is not None
+
+    def publish(self, endpoint: Endpoint):
+        # 他のワーカーもすぐに切り替えられるよう、クールダウンは sync を待たずに共有する
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.hset(self.key(endpoint), "cooldown_until", endpoint.cooldown_until)
+            pipeline.expire(self.key(endpoint), int(OPENAI_ENDPOINT_MAX_COOLDOWN * 10))
+            pipeline.execute()
+        except Exception:
+            logging.exception("Failed to share the OpenAI endpoint state")
+
+    async def failed_async(self, endpoint: Endpoint, error: Exception):
+        # Redis への書き込みでイベントループを止めない
+        if self.failed(endpoint, error):
+            await asyncio.to_thread(self.publish, endpoint)
+
+    def key(self, endpoint: Endpoint) -> str:
+        return f"{ENDPOINT_STATE_PREFIX}:{endpoint.id}"
+
+    def sync(self):
+        """
+        Publishes the latencies of this worker and reads the cooldowns and latencies of the others.
+        """
+        if self.client is None:
+            return
+        with self.lock:
+            endpoints = [e for group in self.groups.values() for e in group if e.shared]
+        if not endpoints:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for endpoint in endpoints:
+            pipeline.hgetall(self.key(endpoint))
+        shared = pipeline.execute()
+        pipeline = self.client.pipeline(transaction=False)
+        for endpoint, item in zip(endpoints, shared):
+            item = {k.decode(): float(v) for k, v in item.items()}
+            endpoint.cooldown_until = max(endpoint.cooldown_until, item.get("cooldown_until", 0.0))
+            if "latency_ms" in item:
+                endpoint.latency_ms = item["latency_ms"] if endpoint.latency_ms is None else \
+                    (endpoint.latency_ms + item["latency_ms"]) / 2
+            if endpoint.latency_ms is not None:
+                pipeline.hset(self.key(endpoint), "latency_ms", endpoint.latency_ms)
+                pipeline.expire(self.key(endpoint), int(OPENAI_ENDPOINT_MAX_COOLDOWN * 10))
+        pipeline.execute()
+
+    def get_stats(self) -> dict[str, list[dict[str, Any]]]:
+        with self.lock:
+            groups = dict(self.groups)
+        return {deployment: [{"id": e.id, **e.state()} for e in endpoints] for deployment, endpoints in groups.items()}
+
+
+router = EndpointRouter()
+
+
+async def call(deployment: str, tokens: int, request: Callable[[Endpoint], Awaitable[Any]], priority: int = INTERACTIVE):
+    """
+    Runs the OpenAI request on an endpoint of the deployment, in a slot of its limiter.
+    On 429, 5xx or a connection error the request moves to another endpoint at once, or is retried
+    after a backoff when none is left.
+    """
+    tried: set[str] = set()
+    for attempt in range(ratelimiter.OPENAI_MAX_RETRIES + 1):
+        endpoint = router.choose(deployment, tried)
+        try:
+            async with ratelimiter.slot(endpoint.id, tokens, priority) as current:
+                start = time.perf_counter()
+                response = await request(endpoint)
+                current.used = ratelimiter.used_tokens(response)
+            router.succeeded(endpoint, time.perf_counter() - start)
+            return response
+        except Exception as e:
+            if not ratelimiter.is_retryable(e):
+                raise
+            await router.failed_async(endpoint, e)
+            if attempt == ratelimiter.OPENAI_MAX_RETRIES:
+                raise
+            tried.add(endpoint.id)
+            if router.has_alternative(deployment, tried):
+                continue
+            tried.clear()
+            delay = ratelimiter.backoff(e, attempt)
+        await asyncio.sleep(delay)
+
+
+def call_sync(deployment: str, tokens: int, request: Callable[[Endpoint], Any], priority: int = BACKGROUND):
+    tried: set[str] = set()
+    for attempt in range(ratelimiter.OPENAI_MAX_RETRIES + 1):
+        endpoint = router.choose(deployment, tried)
+        try:
+            with ratelimiter.slot_sync(endpoint.id, tokens, priority) as current:
+                start = time.perf_counter()
+                response = request(endpoint)
+                current.used = ratelimiter.used_tokens(response)
+            router.succeeded(endpoint, time.perf_counter() - start)
+            return response
+        except Exception as e:
+            if not ratelimiter.is_retryable(e):
+                raise
+            if router.failed(endpoint, e):
+                router.publish(endpoint)
+            if attempt == ratelimiter.OPENAI_MAX_RETRIES:
+                raise
+            tried.add(endpoint.id)
+            if router.has_alternative(deployment, tried):
+                continue
+            tried.clear()
+            delay = ratelimiter.backoff(e, attempt)
+        time.sleep(delay)
+
+
+@asynccontextmanager
+async def stream(deployment: str, tokens: int, request: Callable[[Endpoint], Awaitable[Any]], priority: int = INTERACTIVE):
+    """
+    Opens a streamed request like call and yields (slot, response); the slot is held until the block exits.
+    Only opening the stream fails over, the latency of the endpoint is the time to open it.
+    """
+    tried: set[str] = set()
+    for attempt in range(ratelimiter.OPENAI_MAX_RETRIES + 1):
+        endpoint = router.choose(deployment, tried)
+        opened = False
+        try:
+            async with ratelimiter.slot(endpoint.id, tokens, priority) as current:
+                start = time.perf_counter()
+                response = await request(endpoint)
+                opened = True
+                router.succeeded(endpoint, time.perf_counter() - start)
+                yield current, response
+                return
+        except Exception as e:
+            if opened or not ratelimiter.is_retryable(e):
+                raise
+            await router.failed_async(endpoint, e)
+            if attempt == ratelimiter.OPENAI_MAX_RETRIES:
+                raise
+            tried.add(endpoint.id)
+            if router.has_alternative(deployment, tried):
+                continue
+            tried.clear()
+            delay = ratelimiter.backoff(e, attempt)
+        await asyncio.sleep(delay)
+
+
+@asynccontextmanager
+async def session(endpoint: Endpoint, tokens: int, priority: int = INTERACTIVE):
+    """
+    Holds a slot of an endpoint chosen by router.choose for a caller making its own requests (the langchain agents).
+    There is no failover inside the block; a failing endpoint is skipped by the following requests.
+    """
+    try:
+        async with ratelimiter.slot(endpoint.id, tokens, priority) as current:
+            yield current
+    except Exception as e:
+        if ratelimiter.is_retryable(e):
+            await router.failed_async(endpoint, e)
+        raise
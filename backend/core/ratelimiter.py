@@ -0,0 +1,466 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Callable, Optional
+
+import openai
+
+# 優先度：対話（チャット・質問）はバックグラウンド（ファイルのエンベディング）より先に実行する
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# デプロイ毎の同時実行数（AIMD で増減する）の初期値と上限
+OPENAI_CONCURRENCY_INITIAL = float(os.getenv("OPENAI_CONCURRENCY_INITIAL", "8"))
+OPENAI_CONCURRENCY_MAX = float(os.getenv("OPENAI_CONCURRENCY_MAX", "64"))
+# 429 を受けた時に同時実行数に掛ける係数。同じ輻輳で何度も下げないよう、下げた後この秒数は下げない
+OPENAI_CONCURRENCY_DECREASE = float(os.getenv("OPENAI_CONCURRENCY_DECREASE", "0.5"))
+OPENAI_CONCURRENCY_DECREASE_INTERVAL = float(os.getenv("OPENAI_CONCURRENCY_DECREASE_INTERVAL", "2"))
+# 対話用に空けておく同時実行数・トークンの割合
+OPENAI_INTERACTIVE_RESERVE = float(os.getenv("OPENAI_INTERACTIVE_RESERVE", "0.25"))
+# デプロイ毎の 1 分当たりのトークン数の上限（JSON、例 {"gpt-35-turbo": 120000}）。未指定のデプロイは無制限
+# 全ワーカー合計の上限で、Redis に接続している場合はワーカー間で共有するトークンバケットで管理する
+OPENAI_TPM_LIMITS: dict[str, int] = json.loads(os.getenv("OPENAI_TPM_LIMITS", "{}"))
+# max_tokens を指定しない呼び出しの回答トークン数の見積もり
+OPENAI_COMPLETION_ESTIMATE = int(os.getenv("OPENAI_COMPLETION_ESTIMATE", "512"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+OPENAI_MAX_BACKOFF = float(os.getenv("OPENAI_MAX_BACKOFF", "60"))
+# 日本語は 1 文字 1 トークン前後のため、文字数から少し多めに見積もる
+CHARS_PER_TOKEN = 1
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+# 対話の呼び出しが待っていることを他のワーカーに知らせる期間（秒）。待っている間は半分の間隔で延長する
+OPENAI_INTERACTIVE_SIGNAL_TTL = float(os.getenv("OPENAI_INTERACTIVE_SIGNAL_TTL", "2"))
+SHARED_BUDGET_PREFIX = "openai_budget"
+SHARED_INTERACTIVE_PREFIX = "openai_interactive"
+# 全ワーカーのトークンバケット。refill してから取得（need > 0）または実際の使用量との差を反映（need <= 0）する
+# 戻り値は {待つミリ秒, 残りトークン}
+SHARED_BUCKET_SCRIPT = """
+local tpm = tonumber(ARGV[1])
+local need = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local adjust = ARGV[4] == "1"
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or tpm
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(tpm, tokens + (now - ts) * tpm / 60)
+local wait = 0
+if adjust then
+    tokens = math.min(tpm, tokens - need)
+elseif tokens - reserve < need then
+    wait = math.ceil((need + reserve - tokens) * 60000 / tpm)
+else
+    tokens = tokens - need
+end
+redis.call("HSET", KEYS[1], "tokens", tostring(tokens), "ts", tostring(now))
+redis.call("PEXPIRE", KEYS[1], 120000)
+return {wait, math.floor(tokens)}
+"""
+
+
+class SharedBudget:
+    """
+    The tokens per minute of a deployment and the interactive waiting signal, shared by the workers through Redis.
+    """
+
+    def __init__(self, client, deployment: str, tpm: int):
+        self.client = client
+        self.tpm = tpm
+        self.bucket_key = f"{SHARED_BUDGET_PREFIX}:{deployment}"
+        self.interactive_key = f"{SHARED_INTERACTIVE_PREFIX}:{deployment}"
+        self.script = client.register_script(SHARED_BUCKET_SCRIPT)
+        self.signaled = 0.0
+
+    def take(self, tokens: float, reserve: float) -> tuple[Optional[float], float]:
+        """
+        Returns (None, remaining) when the tokens are taken, or (seconds to wait, remaining).
+        """
+        wait_ms, remaining = self.script(keys=[self.bucket_key], args=[self.tpm, tokens, reserve, "0"])
+        return (wait_ms / 1000 if wait_ms else None), remaining
+
+    def adjust(self, tokens: float):
+        # 見積もりと実際の使用量の差（多く見積もった場合は負）
+        self.script(keys=[self.bucket_key], args=[self.tpm, tokens, 0, "1"])
+
+    def signal_interactive(self):
+        # ワーカー毎に有効期限をスコアにして登録する（終了したワーカーの登録は期限切れになる）
+        now = time.time()
+        if now - self.signaled < OPENAI_INTERACTIVE_SIGNAL_TTL / 2:
+            return
+        self.signaled = now
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.zadd(self.interactive_key, {WORKER_ID: now + OPENAI_INTERACTIVE_SIGNAL_TTL})
+        pipeline.zremrangebyscore(self.interactive_key, "-inf", now)
+        pipeline.expire(self.interactive_key, int(OPENAI_INTERACTIVE_SIGNAL_TTL) + 1)
+        pipeline.execute()
+
+    def interactive_waiting(self) -> bool:
+        return self.client.zcount(self.interactive_key, time.time(), "+inf") > 0
+
+
+WORKER_ID = f"{os.getpid()}:{uuid.uuid4()}"
+# イベントループを止めないよう、共有状態の更新は結果を待たずにこのスレッドで行う
+shared_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="openai-budget")
+
+
+def submit(func: Callable, *args):
+    def run():
+        try:
+            func(*args)
+        except Exception:
+            logging.exception("Failed to update the shared OpenAI budget")
+    shared_executor.submit(run)
+
+
+class AdaptiveLimiter:
+    """
+    Limits the calls to one deployment, shared by the async requests and the ingestion threads.
+    The concurrency grows by one per window of successful calls at the limit and is halved on a 429 (AIMD).
+    A 429 with retry-after holds every call until then, and a token bucket refilled at the
+    tokens per minute limit is charged with the estimated tokens, corrected with the actual usage.
+    Background calls leave part of the concurrency and of the tokens to the interactive ones,
+    and never start while an interactive call is waiting.
+    With a SharedBudget the tokens and the interactive waiting signal cover every worker;
+    the concurrency stays per worker and adapts to the 429s each worker receives.
+    """
+
+    def __init__(self, deployment: str, tpm: int = 0, shared: Optional[SharedBudget] = None):
+        self.deployment = deployment
+        self.tpm = tpm
+        self.shared = shared
+        self.limit = OPENAI_CONCURRENCY_INITIAL
+        self.in_flight = 0
+        self.tokens = float(tpm)
+        self.refilled = time.monotonic()
+        self.blocked_until = 0.0
+        self.decreased = 0.0
+        self.waiting = [0, 0]
+        self.throttled = 0
+        # Redis の確認を待っている枠の数と、その間に枠がなく待たせた呼び出しがあるか
+        self.pending = 0
+        self.contended = False
+        self.lock = threading.Lock()
+        # 空きを待っている呼び出しを起こす関数
+        self.wakers: set[Callable[[], None]] = set()
+
+    def refill(self, now: float):
+        # 共有している場合は、最後に Redis から読んだ残りを Redis に接続できない間の見積もりに使う
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + (now - self.refilled) * self.tpm / 60)
+        self.refilled = now
+
+    def try_acquire(self, tokens: int, priority: int) -> tuple[bool, Optional[float]]:
+        """
+        Takes a slot and the tokens if available. Otherwise returns the seconds until they may be,
+        or None if a release is needed first. Called with the lock held.
+        With a SharedBudget only the slot is taken here, the shared state is checked by take_shared.
+        """
+        now = time.monotonic()
+        self.refill(now)
+        if now < self.blocked_until:
+            return False, self.blocked_until - now
+        capacity = max(1, math.floor(self.limit))
+        if priority == BACKGROUND:
+            if self.waiting[INTERACTIVE] > 0:
+                return False, None
+            capacity = max(1, capacity - math.ceil(capacity * OPENAI_INTERACTIVE_RESERVE))
+        if self.in_flight >= capacity:
+            if self.pending:
+                self.contended = True
+            return False, None
+        if self.tpm and self.shared is None:
+            wait = self.take_tokens(tokens, priority)
+            if wait is not None:
+                return False, wait
+        self.in_flight += 1
+        return True, None
+
+    def take_tokens(self, tokens: int, priority: int) -> Optional[float]:
+        # 上限を超える見積もりでも、バケットが満杯になれば実行する
+        need = min(tokens, self.tpm)
+        reserve = self.tpm * OPENAI_INTERACTIVE_RESERVE if priority == BACKGROUND else 0
+        if self.tokens - reserve < need:
+            return (need + reserve - self.tokens) * 60 / self.tpm
+        self.tokens -= need
+        return None
+
+    def take_shared(self, tokens: int, priority: int) -> Optional[float]:
+        """
+        Checks the interactive calls waiting on the other workers and takes the tokens from the shared bucket.
+        Returns the seconds to wait if the call may not start. Called without the lock, as it waits for Redis.
+        """
+        if priority == BACKGROUND and self.shared_call(self.shared.interactive_waiting, False):
+            # 他のワーカーの対話の呼び出しが終わったことは通知されないため、期限まで待って確認する
+            return OPENAI_INTERACTIVE_SIGNAL_TTL / 2
+        if not self.tpm:
+            return None
+        need = min(tokens, self.tpm)
+        reserve = self.tpm * OPENAI_INTERACTIVE_RESERVE if priority == BACKGROUND else 0
+        taken = self.shared_call(self.shared.take, None, need, reserve)
+        with self.lock:
+            if taken is None:
+                self.refill(time.monotonic())
+                return self.take_tokens(tokens, priority)
+            wait, self.tokens = taken
+            return wait
+
+    def shared_call(self, func: Callable, default: Any, *args) -> Any:
+        # Redis に接続できない間はこのワーカーの状態だけで判断する
+        try:
+            return func(*args)
+        except Exception:
+            logging.exception("Failed to read the shared OpenAI budget")
+            return default
+
+    def release(self, reserved: int, used: Optional[int] = None, retry_after: Optional[float] = None,
+                throttled: bool = False):
+        now = time.monotonic()
+        with self.lock:
+            # 上限まで使っていない時に増やすと、上限が実際の負荷と無関係に大きくなる
+            saturated = self.in_flight >= math.floor(self.limit)
+            self.in_flight -= 1
+            if self.tpm and used is not None:
+                self.tokens -= used - min(reserved, self.tpm)
+                if self.shared is not None and used != min(reserved, self.tpm):
+                    submit(self.shared.adjust, used - min(reserved, self.tpm))
+            if throttled:
+                self.throttled += 1
+                if now - self.decreased > OPENAI_CONCURRENCY_DECREASE_INTERVAL:
+                    self.limit = max(1.0, self.limit * OPENAI_CONCURRENCY_DECREASE)
+                    self.decreased = now
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            elif used is not None and saturated:
+                self.limit = min(OPENAI_CONCURRENCY_MAX, self.limit + 1 / self.limit)
+            wakers = list(self.wakers)
+        for wake in wakers:
+            wake()
+
+    async def acquire(self, tokens: int, priority: int = INTERACTIVE):
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # イベントループが終了している
+                pass
+        while True:
+            if self.shared is not None:
+                # 共有のトークンバケットと対話の待ちは Redis にあるため、イベントループの外で確認する
+                granted, timeout = await asyncio.to_thread(self.register, tokens, priority, wake)
+            else:
+                granted, timeout = self.register(tokens, priority, wake)
+            if granted:
+                return
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                event.clear()
+                self.unregister(priority, wake)
+
+    def acquire_sync(self, tokens: int, priority: int = BACKGROUND):
+        event = threading.Event()
+        while True:
+            granted, timeout = self.register(tokens, priority, event.set)
+            if granted:
+                return
+            try:
+                event.wait(timeout)
+            finally:
+                event.clear()
+                self.unregister(priority, event.set)
+
+    def register(self, tokens: int, priority: int, wake: Callable[[], None]) -> tuple[bool, Optional[float]]:
+        # 空きの確認と待ちの登録は同じロックの中で行い、その間の release を取りこぼさない
+        with self.lock:
+            granted, timeout = self.try_acquire(tokens, priority)
+            if not granted:
+                self.waiting[priority] += 1
+                self.wakers.add(wake)
+            elif self.shared is not None:
+                self.pending += 1
+        if granted and self.shared is not None:
+            # 枠を取ってから Redis を確認し、取れなければ枠を戻して待つ
+            # （ロックを持ったまま Redis を待つと、イベントループで呼ぶ release も待たされる）
+            timeout = self.take_shared(tokens, priority)
+            wakers = []
+            with self.lock:
+                self.pending -= 1
+                if timeout is not None:
+                    granted = False
+                    self.in_flight -= 1
+                    self.waiting[priority] += 1
+                    self.wakers.add(wake)
+                    # 確認の間に枠がなく待たせた呼び出しは、戻した枠を使える
+                    if self.contended:
+                        wakers = [other for other in self.wakers if other is not wake]
+                if not self.pending:
+                    self.contended = False
+            for other in wakers:
+                other()
+        if not granted and priority == INTERACTIVE and self.shared is not None:
+            # 他のワーカーのバックグラウンドの呼び出しを待たせる。期限が切れる前に登録し直す
+            submit(self.shared.signal_interactive)
+            timeout = min(timeout or OPENAI_INTERACTIVE_SIGNAL_TTL / 2, OPENAI_INTERACTIVE_SIGNAL_TTL / 2)
+        return granted, timeout
+
+    def unregister(self, priority: int, wake: Callable[[], None]):
+        with self.lock:
+            self.waiting[priority] -= 1
+            self.wakers.discard(wake)
+            wakers = list(self.wakers) if priority == INTERACTIVE and self.waiting[INTERACTIVE] == 0 else []
+        # 対話の待ちがなくなるとバックグラウンドが実行できる場合がある
+        for other in wakers:
+            other()
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            self.refill(time.monotonic())
+            return {"limit": round(self.limit, 2),
+                    "in_flight": self.in_flight,
+                    "waiting_interactive": self.waiting[INTERACTIVE],
+                    "waiting_background": self.waiting[BACKGROUND],
+                    "tpm": self.tpm,
+                    "tokens": round(self.tokens) if self.tpm else None,
+                    "blocked_seconds": round(max(0.0, self.blocked_until - time.monotonic()), 1),
+                    "throttled": self.throttled}
+
+
+limiters: dict[str, AdaptiveLimiter] = {}
+limiters_lock = threading.Lock()
+redis_client = None
+
+
+def connect(client):
+    """
+    Shares the token buckets and the interactive waiting signal with the other workers.
+    Without it each worker applies the whole OPENAI_TPM_LIMITS on its own.
+    """
+    global redis_client
+    with limiters_lock:
+        redis_client = client
+        for deployment, limiter in limiters.items():
+            limiter.shared = SharedBudget(client, deployment, limiter.tpm)
+
+
+def get_limiter(deployment: str) -> AdaptiveLimiter:
+    with limiters_lock:
+        if deployment not in limiters:
+            tpm = int(OPENAI_TPM_LIMITS.get(deployment, 0))
+            shared = SharedBudget(redis_client, deployment, tpm) if redis_client is not None else None
+            limiters[deployment] = AdaptiveLimiter(deployment, tpm, shared)
+        return limiters[deployment]
+
+
+def get_stats() -> dict[str, dict[str, Any]]:
+    with limiters_lock:
+        return {deployment: limiter.stats() for deployment, limiter in limiters.items()}
+
+
+def estimate_tokens(messages: Optional[list[dict[str, str]]] = None, text: str = "",
+                    max_tokens: Optional[int] = None) -> int:
+    """
+    Prompt size from the characters plus the completion allowance, as Azure OpenAI counts max_tokens
+    against the quota when the request is accepted.
+    """
+    chars = len(text) + sum(len(m.get("content") or "") for m in messages or [])
+    return chars // CHARS_PER_TOKEN + (OPENAI_COMPLETION_ESTIMATE if max_tokens is None else max_tokens)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1)):
+        try:
+            if headers.get(name):
+                return float(headers[name]) * scale
+        except ValueError:
+            pass
+    return None
+
+
+def is_throttled(error: Exception) -> bool:
+    return isinstance(error, openai.error.RateLimitError) or getattr(error, "http_status", None) == 429
+
+
+def is_retryable(error: Exception) -> bool:
+    return (is_throttled(error)
+            or isinstance(error, (openai.error.APIConnectionError, openai.error.Timeout,
+                                  openai.error.ServiceUnavailableError))
+            or getattr(error, "http_status", None) in RETRYABLE_STATUS)
+
+
+def backoff(error: Exception, attempt: int) -> float:
+    # retry-after がある場合は limiter が全員を待たせるため、ここでは待たない
+    if is_throttled(error) and retry_after(error) is not None:
+        return 0.0
+    return min(OPENAI_MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+class Slot:
+    """
+    A call holding a slot of the deployment; used is the actual token count, set from the response usage.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, tokens: int):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.used: Optional[int] = None
+        self.started = time.perf_counter()
+
+    def release(self, error: Optional[BaseException]):
+        if error is None:
+            self.limiter.release(self.tokens, self.used if self.used is not None else self.tokens)
+        elif isinstance(error, Exception):
+            self.limiter.release(self.tokens, self.used, retry_after(error), is_throttled(error))
+        else:
+            # キャンセル・ストリームの中断は同時実行数を変えない
+            self.limiter.release(self.tokens, self.used)
+
+
+@asynccontextmanager
+async def slot(deployment: str, tokens: int, priority: int = INTERACTIVE):
+    limiter = get_limiter(deployment)
+    await limiter.acquire(tokens, priority)
+    current = Slot(limiter, tokens)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        current.release(error)
+
+
+@contextmanager
+def slot_sync(deployment: str, tokens: int, priority: int = BACKGROUND):
+    limiter = get_limiter(deployment)
+    limiter.acquire_sync(tokens, priority)
+    current = Slot(limiter, tokens)
+    error = None
+    try:
+        yield current
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        current.release(error)
+
+
+def used_tokens(response) -> Optional[int]:
+    usage = response.get("usage") if response else None
+    return usage.get("total_tokens") if usage else None
@@ -0,0 +1,153 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from opentelemetry import metrics, trace
+
+from core import singleflight
+from core.ttlcache import TTLCache
+
+# 検索結果を再利用する秒数と、ワーカー毎の最大件数
+SEARCH_CACHE_TTL = float(os.getenv("AZURE_SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("AZURE_SEARCH_CACHE_MAX_ENTRIES", "1000"))
+# インデックスの世代（Redis）。通知を取りこぼした場合もこの秒数で読み直す
+SEARCH_GENERATION_KEY = "search_index_generation"
+SEARCH_GENERATION_TTL = float(os.getenv("AZURE_SEARCH_GENERATION_TTL", "10"))
+# 登録・削除したドキュメントが検索結果に反映されるまでの秒数。この後にもう一度世代を進める
+SEARCH_INDEX_REFRESH_DELAY = float(os.getenv("AZURE_SEARCH_INDEX_REFRESH_DELAY", "3"))
+
+meter = metrics.get_meter("searchcache")
+lookups_counter = meter.create_counter(
+    "searchcache.lookups", description="Search result cache lookups, hit=true when the search was skipped")
+
+
+class SearchResultCache:
+    """
+    Per-worker LRU cache of search results with a time to live.
+    Each entry is tagged with the generation of the index when the search started; indexing or removing
+    documents increments the generation in Redis, which drops every entry of the older generations on all workers.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expiry, generation, documents)
+        self.items: OrderedDict[Hashable, tuple[float, int, list[dict[str, Any]]]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.generations = TTLCache(SEARCH_GENERATION_TTL)
+        self.local_generation = 0
+        self.client = None
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self, redis_client):
+        self.client = redis_client
+        # 世代の更新を他のワーカー・ノードから受け取る
+        self.generations.subscribe(redis_client)
+
+    def generation(self) -> int:
+        if self.client is None:
+            return self.local_generation
+        try:
+            return self.generations.get(SEARCH_GENERATION_KEY, lambda: int(self.client.get(SEARCH_GENERATION_KEY) or 0))
+        except Exception:
+            # 世代を確認できない場合はキャッシュを使わない
+            logging.exception("Failed to read the search index generation")
+            return -1
+
+    async def current_generation(self) -> int:
+        """
+        Like generation, without blocking the event loop: only a read from Redis runs on a thread.
+        """
+        if self.client is None:
+            return self.local_generation
+        generation = self.generations.peek(SEARCH_GENERATION_KEY)
+        if generation is not None:
+            return generation
+        return await asyncio.to_thread(self.generation)
+
+    def increment(self, refresh: bool = True):
+        """
+        Called after the index changed. The entries of the previous generations are no longer returned.
+        The change takes a few seconds to be searchable, so the generation is incremented again after
+        SEARCH_INDEX_REFRESH_DELAY to drop the results read in between.
+        """
+        if refresh:
+            timer = threading.Timer(SEARCH_INDEX_REFRESH_DELAY, self.increment, kwargs={"refresh": False})
+            timer.daemon = True
+            timer.start()
+        with self.lock:
+            self.local_generation += 1
+            self.items.clear()
+        if self.client is None:
+            return
+        try:
+            self.client.incr(SEARCH_GENERATION_KEY)
+            self.generations.invalidate(SEARCH_GENERATION_KEY)
+        except Exception:
+            # 他のワーカーのキャッシュは TTL で期限切れになる
+            logging.exception("Failed to increment the search index generation")
+
+    def get(self, key: Hashable, generation: int) -> Optional[list[dict[str, Any]]]:
+        now = time.monotonic()
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] > now and item[1] == generation:
+                self.items.move_to_end(key)
+                self.hits += 1
+                return item[2]
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, generation: int, documents: list[dict[str, Any]]):
+        if generation < 0:
+            return
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, generation, documents)
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_entries:
+                self.items.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        generation = self.generation()
+        with self.lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 4) if total else 0,
+                    "size": len(self.items),
+                    "generation": generation,
+                    "ttl": self.ttl}
+
+
+cache = SearchResultCache(SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+
+
+async def search(search_client, search_text: str, **kwargs: Any) -> list[dict[str, Any]]:
+    """
+    Like singleflight.search, answered from the cache when the same search ran on the current index generation.
+    The documents are shared and must not be modified.
+    """
+    key = singleflight.search_key(search_client, search_text, **kwargs)
+    # 検索の前に世代を読み、検索中にインデックスが変わった結果は古い世代として扱う
+    generation = await cache.current_generation()
+    documents = cache.get(key, generation)
+    hit = documents is not None
+    lookups_counter.add(1, {"hit": hit})
+    trace.get_current_span().set_attribute("searchcache.hit", hit)
+    if documents is None:
+        async def request():
+            result = await singleflight.read(search_client, search_text, **kwargs)
+            cache.put(key, generation, result)
+            return result
+        # 世代の異なる検索は共有しない
+        documents = await singleflight.searches.do((generation, key), request)
+    return list(documents)
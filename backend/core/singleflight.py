@@ -0,0 +1,101 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Hashable
+
+from opentelemetry import metrics, trace
+
+meter = metrics.get_meter("singleflight")
+calls_counter = meter.create_counter(
+    "singleflight.calls", description="Embedding and search calls, shared=true when joining an identical call in flight")
+
+
+class SingleFlight:
+    """
+    Shares one in-flight call among the concurrent callers with the same key (per worker).
+    Every caller receives the result or the exception of the first one; nothing is kept once it completes.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: dict[Hashable, asyncio.Future] = {}
+        self.lock = threading.Lock()
+        self.started = 0
+        self.shared = 0
+
+    def record(self, shared: bool):
+        with self.lock:
+            if shared:
+                self.shared += 1
+            else:
+                self.started += 1
+        calls_counter.add(1, {"call": self.name, "shared": shared})
+        trace.get_current_span().set_attribute("singleflight.shared", shared)
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]]) -> Any:
+        while (future := self.calls.get(key)) is not None:
+            self.record(True)
+            try:
+                # 先に始めた呼び出し元がキャンセルされても、結果を待つ他の呼び出し元は巻き込まない
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # 先に始めた呼び出し元がキャンセルされたため、やり直す
+        self.record(False)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 待っている呼び出し元がいない場合に "exception was never retrieved" を出さない
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
+
+    def stats(self) -> dict[str, Any]:
+        with self.lock:
+            total = self.started + self.shared
+            return {"calls": total,
+                    "started": self.started,
+                    "shared": self.shared,
+                    "in_flight": len(self.calls),
+                    "coalescing_ratio": round(self.shared / total, 4) if total else 0.0}
+
+
+embeddings = SingleFlight("embedding")
+searches = SingleFlight("search")
+
+
+def get_stats() -> dict[str, dict[str, Any]]:
+    return {flight.name: flight.stats() for flight in (embeddings, searches)}
+
+
+def search_key(search_client, search_text: str, **kwargs: Any) -> tuple:
+    # 同じテキストのエンベディングは同じベクトルになるが、呼び出し元の指定どおりベクトルもキーに含める
+    vector = kwargs.pop("vector", None)
+    return (id(search_client), search_text, hash(tuple(vector)) if vector else None,
+            tuple(sorted((k, v) for k, v in kwargs.items() if v is not None)))
+
+
+async def search(search_client, search_text: str, **kwargs: Any) -> list[dict[str, Any]]:
+    """
+    search_client.search with the results read into a list, shared by identical concurrent searches.
+    The documents are shared as well and must not be modified.
+    """
+    return list(await searches.do(search_key(search_client, search_text, **kwargs),
+                                  lambda: read(search_client, search_text, **kwargs)))
+
+
+async def read(search_client, search_text: str, **kwargs: Any) -> list[dict[str, Any]]:
+    r = await search_client.search(search_text, **kwargs)
+    return [doc async for doc in r]
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import time
+from contextlib import contextmanager
+from typing import Any, AsyncIterator
+
+import openai
+from opentelemetry import metrics, trace
+
+from core import endpointrouter, ratelimiter, singleflight
+from core.modelhelper import num_tokens_from_messages
+from core.tokenusage import record_tokens
+
+tracer = trace.get_tracer("approaches")
+meter = metrics.get_meter("openai")
+time_to_first_token_histogram = meter.create_histogram(
+    "openai.time_to_first_token", unit="ms", description="Time until the first streamed token of a chat completion")
+tokens_per_second_histogram = meter.create_histogram(
+    "openai.tokens_per_second", unit="{token}/s", description="Completion tokens generated per second")
+
+
+@contextmanager
+def stage(name: str, **attributes: Any):
+    """
+    Span of one stage of an approach (query rewrite, embedding, search, completion, persistence).
+    """
+    with tracer.start_as_current_span(name, attributes={k: v for k, v in attributes.items() if v is not None}) as span:
+        yield span
+
+
+def prompt_attributes(deployment: str, messages: list[dict[str, str]]) -> dict[str, Any]:
+    return {"openai.deployment": deployment,
+            "openai.prompt_messages": len(messages),
+            "openai.prompt_chars": sum(len(m.get("content") or "") for m in messages)}
+
+
+def record_usage(span, usage, duration: float, attributes: dict[str, Any]):
+    if not usage:
+        return
+    span.set_attribute("openai.prompt_tokens", usage.get("prompt_tokens", 0))
+    span.set_attribute("openai.completion_tokens", usage.get("completion_tokens", 0))
+    if usage.get("completion_tokens") and duration > 0:
+        tokens_per_second_histogram.record(usage["completion_tokens"] / duration, attributes)
+
+
+def count_prompt_tokens(model: str, messages: list[dict[str, str]]) -> int:
+    try:
+        return sum(num_tokens_from_messages(message, model) for message in messages)
+    except Exception:
+        # 未知のモデル名、またはエンコーディングを取得できない場合
+        return 0
+
+
+async def chat_completion(name: str, **kwargs: Any):
+    """
+    openai.ChatCompletion.acreate on an endpoint of the deployment, inside a span carrying the prompt size and the token usage.
+    """
+    deployment = kwargs.get("deployment_id")
+    messages = kwargs.get("messages", [])
+    with stage(name, **prompt_attributes(deployment, messages)) as span:
+        queued = time.perf_counter()
+        start = queued
+
+        async def request(endpoint):
+            nonlocal start
+            start = time.perf_counter()
+            return await openai.ChatCompletion.acreate(**{**kwargs, "deployment_id": endpoint.deployment},
+                                                       **endpoint.params())
+        chat_completion = await endpointrouter.call(
+            deployment, ratelimiter.estimate_tokens(messages, max_tokens=kwargs.get("max_tokens")), request)
+        span.set_attribute("openai.queue_ms", round((start - queued) * 1000, 1))
+        record_usage(span, chat_completion.get("usage"), time.perf_counter() - start,
+                     {"deployment": deployment, "stream": False})
+        record_tokens(deployment, chat_completion.get("usage"))
+        return chat_completion
+
+
+async def stream_chat_completion(name: str, **kwargs: Any) -> AsyncIterator[str]:
+    """
+    Streams the content deltas of a chat completion, recording the time to first token and the tokens per second.
+    Streamed responses carry no usage, every content delta is counted as one token
+    and the prompt tokens are counted with tiktoken once the answer is complete.
+    The slot of the deployment is held until the whole answer is read.
+    """
+    deployment = kwargs.get("deployment_id")
+    messages = kwargs.get("messages", [])
+    attributes = {"deployment": deployment, "stream": True}
+    with stage(name, **prompt_attributes(deployment, messages)) as span:
+        start = time.perf_counter()
+        first_token = None
+        tokens = 0
+        async with endpointrouter.stream(
+                deployment, ratelimiter.estimate_tokens(messages, max_tokens=kwargs.get("max_tokens")),
+                lambda endpoint: openai.ChatCompletion.acreate(
+                    stream=True, **{**kwargs, "deployment_id": endpoint.deployment}, **endpoint.params())) as (slot, response):
+            span.set_attribute("openai.queue_ms", round((slot.started - start) * 1000, 1))
+            async for chunk in response:
+                if chunk.choices and (delta := chunk.choices[0].delta.get("content")):
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        time_to_first_token_histogram.record((first_token - start) * 1000, attributes)
+                        span.set_attribute("openai.time_to_first_token_ms", round((first_token - start) * 1000, 1))
+                    tokens += 1
+                    yield delta
+            prompt_tokens = count_prompt_tokens(kwargs.get("model"), messages)
+            slot.used = prompt_tokens + tokens
+        span.set_attribute("openai.completion_tokens", tokens)
+        if first_token is not None and tokens > 1:
+            tokens_per_second_histogram.record((tokens - 1) / (time.perf_counter() - first_token), attributes)
+        record_tokens(deployment, {"prompt_tokens": prompt_tokens, "completion_tokens": tokens})
+
+
+async def embedding(deployment: str, text: str) -> list[float]:
+    """
+    Embedding of a query, shared by the concurrent requests embedding the same text.
+    The tokens are recorded for the request that made the call only.
+    """
+    with stage("embedding", **{"openai.deployment": deployment, "openai.prompt_chars": len(text)}) as span:
+        async def request():
+            response = await endpointrouter.call(
+                deployment, ratelimiter.estimate_tokens(text=text, max_tokens=0),
+                lambda endpoint: openai.Embedding.acreate(engine=endpoint.deployment, input=text, **endpoint.params()))
+            if usage := response.get("usage"):
+                span.set_attribute("openai.prompt_tokens", usage.get("prompt_tokens", 0))
+            record_tokens(deployment, usage)
+            return response["data"][0]["embedding"]
+        return await singleflight.embeddings.do((deployment, text), request)
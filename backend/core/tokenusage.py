@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Optional
+
+
+class UsageCollector:
+    """
+    Token usage of the OpenAI calls made while handling one request, per deployment.
+    Flushed once at the end of the request by TokenUsageService.record.
+    """
+
+    def __init__(self, user: str = "", chat_id: str = ""):
+        self.user = user
+        self.chat_id = chat_id
+        # deployment -> [prompt_tokens, completion_tokens, requests]
+        self.usage: dict[str, list[int]] = {}
+
+    def add(self, deployment: str, prompt_tokens: int, completion_tokens: int, requests: int = 1):
+        counters = self.usage.setdefault(deployment or "unknown", [0, 0, 0])
+        counters[0] += prompt_tokens
+        counters[1] += completion_tokens
+        counters[2] += requests
+
+
+# asyncio のタスク・to_thread にはコピーされるが、スレッド・run_in_executor には引き継がれない
+current_usage: ContextVar[Optional[UsageCollector]] = ContextVar("token_usage", default=None)
+
+
+def record_tokens(deployment: str, usage: Optional[dict[str, Any]], requests: int = 1):
+    """
+    Adds the usage of an OpenAI response to the collector of the current request, if any.
+    """
+    collector = current_usage.get()
+    if collector is None or not usage:
+        return
+    collector.add(deployment, usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0), requests)
+
+
+@contextmanager
+def collect_usage(user: str = "", chat_id: str = ""):
+    collector = UsageCollector(user, chat_id)
+    token = current_usage.set(collector)
+    try:
+        yield collector
+    finally:
+        current_usage.reset(token)
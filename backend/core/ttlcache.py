@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import copy
+import logging
+import threading
+import time
+from typing import Any, Callable
+
+# 他のワーカー・ノードへ無効化を通知する Redis のチャネル
+INVALIDATION_CHANNEL = "cache_invalidation"
+
+
+class TTLCache:
+    """
+    Per-worker read-through cache with a time to live.
+    Invalidations are published on Redis so that every worker drops the key.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.items: dict[str, tuple[float, Any]] = {}
+        # 無効化の回数（キー毎と全体）。読み込み中に無効化された値は保存しない
+        self.versions: dict[str, int] = {}
+        self.cleared = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.redis_client = None
+        self.pubsub_thread = None
+
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        """
+        Returns the cached value of the key, calling the loader on a miss or after expiry.
+        The loaded value is not cached if the key was invalidated while loading.
+        A copy is returned so callers can modify it freely.
+        """
+        now = time.monotonic()
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] > now:
+                self.hits += 1
+                return copy.deepcopy(item[1])
+            self.misses += 1
+            version = (self.versions.get(key, 0), self.cleared)
+        value = loader()
+        with self.lock:
+            if (self.versions.get(key, 0), self.cleared) == version:
+                self.items[key] = (now + self.ttl, value)
+        return copy.deepcopy(value)
+
+    def peek(self, key: str, default: Any = None) -> Any:
+        """
+        Returns the cached value of the key without loading it, or default on a miss or after expiry.
+        """
+        with self.lock:
+            item = self.items.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self.hits += 1
+                return copy.deepcopy(item[1])
+        return default
+
+    def invalidate(self, *keys: str):
+        """
+        Drops the keys on this worker and publishes them to the other workers.
+        """
+        self.drop(keys)
+        if self.redis_client is not None:
+            try:
+                for key in keys:
+                    self.redis_client.publish(INVALIDATION_CHANNEL, key)
+            except Exception:
+                # 通知できなくても TTL で期限切れになる
+                logging.exception("Failed to publish cache invalidation")
+
+    def drop(self, keys):
+        with self.lock:
+            for key in keys:
+                self.versions[key] = self.versions.get(key, 0) + 1
+                if self.items.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def subscribe(self, redis_client):
+        """
+        Listens for invalidations from the other workers on a background thread.
+        """
+        self.redis_client = redis_client
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: self.on_message})
+        self.pubsub_thread = pubsub.run_in_thread(
+            sleep_time=1, daemon=True, exception_handler=self.on_error)
+
+    def unsubscribe(self):
+        if self.pubsub_thread is not None:
+            self.pubsub_thread.stop()
+            self.pubsub_thread = None
+
+    def on_message(self, message):
+        key = message["data"]
+        self.drop([key.decode("utf-8") if isinstance(key, bytes) else key])
+
+    def on_error(self, error, pubsub, thread):
+        # 接続が切れている間の通知は失われるため、キャッシュを全て破棄して再接続する
+        logging.warning(f"Cache invalidation subscriber error: {error}")
+        with self.lock:
+            self.items.clear()
+            self.cleared += 1
+        time.sleep(1)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0,
+                "invalidations": self.invalidations,
+                "size": len(self.items),
+                "ttl": self.ttl,
+            }
@@ -13,6 +13,8 @@ class ChatContent():
     answer: str
     data_points: List[str]
     thoughts: str
+    # thoughts / data_points を保存した Blob 名
+    details: str = ""
 
     @property
     def __dict__(self):
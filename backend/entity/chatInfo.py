@@ -12,6 +12,7 @@ class ChatInfo():
     openai_model:str
     created_user:str
     create_date: str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    chat_id: str = ""
 
     @property
     def __dict__(self):
@@ -1,8 +1,13 @@
+import time
 from typing import Any, Dict, List, Optional, Union
+from uuid import UUID
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import AgentAction, AgentFinish, LLMResult
 
+from core.telemetry import tokens_per_second_histogram
+from core.tokenusage import record_tokens
+
 
 def ch(text: Union[str, object]) -> str:
     s = text if isinstance(text, str) else str(text)
@@ -88,3 +93,42 @@ class HtmlCallbackHandler (BaseCallbackHandler):
     ) -> None:
         """Run on agent end."""
         self.html += f"<span style='color:{color}'>{ch(finish.log)}</span><br>"
+
+
+class TelemetryCallbackHandler (BaseCallbackHandler):
+    """
+    Sums the token usage of the LLM calls of an agent and records their tokens per second.
+    """
+
+    def __init__(self, deployment: str):
+        self.deployment = deployment
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.llm_calls = 0
+        self.starts: Dict[UUID, float] = {}
+
+    def on_llm_start(
+        self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any
+    ) -> None:
+        self.starts[run_id] = time.perf_counter()
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> None:
+        start = self.starts.pop(run_id, None)
+        usage = (response.llm_output or {}).get("token_usage", {})
+        completion_tokens = usage.get("completion_tokens", 0)
+        self.llm_calls += 1
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += completion_tokens
+        if start is not None and completion_tokens:
+            tokens_per_second_histogram.record(completion_tokens / (time.perf_counter() - start),
+                                               {"deployment": self.deployment, "stream": False})
+
+    def set_attributes(self, span) -> None:
+        span.set_attribute("openai.llm_calls", self.llm_calls)
+        span.set_attribute("openai.prompt_tokens", self.prompt_tokens)
+        span.set_attribute("openai.completion_tokens", self.completion_tokens)
+
+    def record_usage(self) -> None:
+        # コールバックはコンテキストを引き継がないスレッドで呼ばれるため、エージェントの終了後に記録する
+        record_tokens(self.deployment, {"prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens},
+                      requests=self.llm_calls)
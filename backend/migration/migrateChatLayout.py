@@ -0,0 +1,190 @@
+import argparse
+import time
+
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+from constants import constants
+from service.cosmosdbService import CosmosdbService, CHAT_SUMMARY_FIELDS
+
+# chat-data（/type）から chats（/chat_id）と user-chats（/created_user）へ移行する。
+# アプリを止めずに実行でき、チェックポイントから再開できる。
+#   python -m migration.migrateChatLayout --max-ru 200
+#   python -m migration.migrateChatLayout --follow   # 切り替えまで追従する
+#   python -m migration.migrateChatLayout --reconcile   # 切り替え直前に実行する
+# _ts による追従では削除を検出できない（削除したドキュメントは読めない）ため、
+# --reconcile で移行元にないドキュメントを移行先から削除する。
+# 移行先に直接書き込むアプリ（AZURE_COSMOSDB_CHAT_LAYOUT=chat）に切り替えた後は実行しないこと。
+
+CHECKPOINT_ID = "chat-layout-migration"
+SYSTEM_PROPERTIES = ["_rid", "_self", "_etag", "_attachments", "_ts"]
+
+
+def load_checkpoint(service: CosmosdbService) -> dict:
+    QUERY = "SELECT * FROM c WHERE c.id=@id"
+    params = [dict(name="@id", value=CHECKPOINT_ID)]
+    items = list(service.common_data_container.query_items(
+        query=QUERY, parameters=params, partition_key=constants.DB_TYPE_MIGRATION))
+    if items:
+        return items[0]
+    return {"id": CHECKPOINT_ID, "type": constants.DB_TYPE_MIGRATION, "last_ts": {}}
+
+
+def save_checkpoint(service: CosmosdbService, checkpoint: dict):
+    body = {k: v for k, v in checkpoint.items() if k not in SYSTEM_PROPERTIES}
+    service.common_data_container.upsert_item(body)
+
+
+def strip(item: dict) -> dict:
+    return {k: v for k, v in item.items() if k not in SYSTEM_PROPERTIES}
+
+
+class RequestUnitLimiter():
+    # 直近の request charge を積算し、max_ru / 秒 を超えないように待つ
+    def __init__(self, client_connection, max_ru: float):
+        self.client_connection = client_connection
+        self.max_ru = max_ru
+        self.window_start = time.monotonic()
+        self.consumed = 0.0
+        self.total = 0.0
+
+    def charge(self):
+        headers = self.client_connection.last_response_headers or {}
+        ru = float(headers.get("x-ms-request-charge", 0))
+        self.consumed += ru
+        self.total += ru
+        if self.max_ru <= 0:
+            return
+        elapsed = time.monotonic() - self.window_start
+        required = self.consumed / self.max_ru
+        if required > elapsed:
+            time.sleep(required - elapsed)
+        if time.monotonic() - self.window_start >= 1:
+            self.window_start = time.monotonic()
+            self.consumed = 0.0
+
+
+def migrate_chat(service: CosmosdbService, limiter: RequestUnitLimiter, item: dict):
+    item = strip(item)
+    item["chat_id"] = item["id"]
+    service.chats_container.upsert_item(item)
+    limiter.charge()
+    service.user_chats_container.upsert_item(
+        {key: item[key] for key in CHAT_SUMMARY_FIELDS if key in item})
+    limiter.charge()
+
+
+def migrate_content(service: CosmosdbService, limiter: RequestUnitLimiter, item: dict):
+    service.chats_container.upsert_item(strip(item))
+    limiter.charge()
+
+
+def migrate_type(service: CosmosdbService, limiter: RequestUnitLimiter, checkpoint: dict, doc_type: str, migrate, page_size: int) -> int:
+    last_ts = checkpoint["last_ts"].get(doc_type, 0)
+    # 同じ _ts の書き込みを取りこぼさないよう >= で読み、upsert で重複を吸収する
+    QUERY = "SELECT * FROM c WHERE c._ts >= @ts ORDER BY c._ts"
+    params = [dict(name="@ts", value=last_ts)]
+    pages = service.chat_data_container.query_items(
+        query=QUERY, parameters=params, partition_key=doc_type, max_item_count=page_size).by_page()
+    count = 0
+    for page in pages:
+        items = list(page)
+        limiter.charge()
+        for item in items:
+            migrate(service, limiter, item)
+            last_ts = item["_ts"]
+        count += len(items)
+        checkpoint["last_ts"][doc_type] = last_ts
+        save_checkpoint(service, checkpoint)
+        print(f"{doc_type}: {count} items migrated (_ts={last_ts}, {limiter.total:.1f} RU)")
+    return count
+
+
+def list_ids(pages, limiter: RequestUnitLimiter) -> list:
+    items = []
+    for page in pages:
+        items.extend(page)
+        limiter.charge()
+    return items
+
+
+def reconcile(service: CosmosdbService, limiter: RequestUnitLimiter, page_size: int) -> int:
+    """
+    Deletes the documents of chats and user-chats whose source document no longer exists in chat-data.
+    The targets are listed before the sources, so a document copied after the listing is never deleted.
+    """
+    QUERY = "SELECT c.id, c.chat_id FROM c WHERE c.type=@type"
+    targets = {}
+    for doc_type in [constants.DB_TYPE_CHAT, constants.DB_TYPE_CONTENT]:
+        targets[doc_type] = list_ids(service.chats_container.query_items(
+            query=QUERY, parameters=[dict(name="@type", value=doc_type)],
+            enable_cross_partition_query=True, max_item_count=page_size).by_page(), limiter)
+    user_chats = list_ids(service.user_chats_container.query_items(
+        query="SELECT c.id, c.created_user FROM c", enable_cross_partition_query=True,
+        max_item_count=page_size).by_page(), limiter)
+
+    deleted = 0
+    sources = {}
+    for doc_type in [constants.DB_TYPE_CHAT, constants.DB_TYPE_CONTENT]:
+        sources[doc_type] = set(list_ids(service.chat_data_container.query_items(
+            query="SELECT VALUE c.id FROM c", partition_key=doc_type, max_item_count=page_size).by_page(), limiter))
+        for item in targets[doc_type]:
+            if item["id"] not in sources[doc_type]:
+                try:
+                    service.chats_container.delete_item(item=item["id"], partition_key=item["chat_id"])
+                    deleted += 1
+                except CosmosResourceNotFoundError:
+                    pass
+                limiter.charge()
+    for item in user_chats:
+        if item["id"] not in sources[constants.DB_TYPE_CHAT]:
+            try:
+                service.user_chats_container.delete_item(item=item["id"], partition_key=item["created_user"])
+                deleted += 1
+            except CosmosResourceNotFoundError:
+                pass
+            limiter.charge()
+    print(f"Reconciled: {deleted} documents deleted from the target ({limiter.total:.1f} RU total)")
+    return deleted
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrate chat-data to the chat-partitioned containers")
+    parser.add_argument("--max-ru", type=float, default=200,
+                        help="Request units per second to spend, 0 for unlimited")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--follow", action="store_true",
+                        help="Keep copying new writes until interrupted")
+    parser.add_argument("--interval", type=float, default=10,
+                        help="Seconds between catch-up passes with --follow")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="After each pass, delete the target documents missing from chat-data")
+    parser.add_argument("--reset", action="store_true",
+                        help="Ignore the checkpoint and migrate from the beginning")
+    args = parser.parse_args()
+
+    service = CosmosdbService()
+    limiter = RequestUnitLimiter(service.client.client_connection, args.max_ru)
+    checkpoint = load_checkpoint(service)
+    if args.reset:
+        checkpoint["last_ts"] = {}
+
+    try:
+        while True:
+            # 会話内容より先にチャットを移行する
+            chats = migrate_type(service, limiter, checkpoint,
+                                 constants.DB_TYPE_CHAT, migrate_chat, args.page_size)
+            contents = migrate_type(service, limiter, checkpoint,
+                                    constants.DB_TYPE_CONTENT, migrate_content, args.page_size)
+            print(f"Pass done: {chats} chats, {contents} contents, {limiter.total:.1f} RU total")
+            if args.reconcile:
+                reconcile(service, limiter, args.page_size)
+            if not args.follow:
+                break
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print("Stopped, run again to resume from the checkpoint")
+
+
+if __name__ == "__main__":
+    main()
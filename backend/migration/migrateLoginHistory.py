@@ -0,0 +1,74 @@
+import argparse
+from collections import defaultdict
+from datetime import datetime
+
+from constants import constants
+from migration.migrateChatLayout import RequestUnitLimiter, strip
+from service.cosmosdbService import CosmosdbService, LOGIN_HISTORY_RETENTION_DAYS
+
+# common-data（/type）のログイン履歴を login-history（/user_id）へコピーし、直近ログインのまとめに反映する。
+# アプリを止めずに実行でき、何度実行しても同じ結果になる（upsert）。デプロイ直後に一度実行すること。
+#   python -m migration.migrateLoginHistory --max-ru 200
+#   python -m migration.migrateLoginHistory --delete   # コピー後に common-data から削除する
+# 保持期間（LOGIN_HISTORY_RETENTION_DAYS）を過ぎた履歴はコピーせず、残りの期間を ttl に設定する。
+
+LOGIN_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def remaining_ttl(item: dict, now: datetime):
+    try:
+        login_time = datetime.strptime(item["login_time"], LOGIN_TIME_FORMAT)
+    except (KeyError, TypeError, ValueError):
+        return None
+    remaining = LOGIN_HISTORY_RETENTION_DAYS * 24 * 60 * 60 - int((now - login_time).total_seconds())
+    return remaining if remaining > 0 else None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Copy the login history of common-data to the login-history container")
+    parser.add_argument("--max-ru", type=float, default=200,
+                        help="Request units per second to spend, 0 for unlimited")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--delete", action="store_true",
+                        help="Delete the copied and expired documents from common-data")
+    args = parser.parse_args()
+
+    service = CosmosdbService()
+    limiter = RequestUnitLimiter(service.client.client_connection, args.max_ru)
+    now = datetime.now()
+    pages = service.common_data_container.query_items(
+        query="SELECT * FROM c", partition_key=constants.DB_TYPE_LOGIN_HISTORY,
+        max_item_count=args.page_size).by_page()
+    logins = defaultdict(list)
+    copied = expired = 0
+    for page in pages:
+        items = list(page)
+        limiter.charge()
+        for item in items:
+            if not item.get("user_id"):
+                continue
+            ttl = remaining_ttl(item, now)
+            if ttl is not None:
+                service.login_history_container.upsert_item({**strip(item), "ttl": ttl})
+                limiter.charge()
+                logins[item["user_id"]].append(
+                    {key: item.get(key) for key in ["id", "user_id", "user_name", "login_time"]})
+                copied += 1
+            else:
+                expired += 1
+            if args.delete:
+                service.common_data_container.delete_item(
+                    item=item["id"], partition_key=constants.DB_TYPE_LOGIN_HISTORY)
+                limiter.charge()
+        print(f"{copied} logins copied, {expired} expired ({limiter.total:.1f} RU)")
+
+    # 移行後に記録されたログインとまとめる
+    for user_id, user_logins in logins.items():
+        service.merge_login_summary(user_id, user_logins)
+        limiter.charge()
+    print(f"Done: {copied} logins of {len(logins)} users copied, {expired} expired, {limiter.total:.1f} RU total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import argparse
+
+from service.blobStorageService import BlobStorageService, AZURE_STORAGE_PRIVATE_CONTAINER
+from service.chatArchiveService import CHAT_ARCHIVE_PREFIX
+from service.chatDetailsService import CHAT_DETAILS_PREFIX
+from service.redisService import SOURCE_BLOB_PREFIX
+
+# 企業ファイルのコンテナ（AZURE_STORAGE_CONTAINER）に保存していたアプリ内部の Blob を
+# AZURE_STORAGE_PRIVATE_CONTAINER へ移す。Blob 名は変えないため、Cosmos 側の参照はそのまま使える。
+# 何度実行しても同じ結果になる。デプロイ直後に一度実行すること。
+#   python -m migration.migratePrivateBlobs
+
+PRIVATE_BLOB_PREFIXES = [CHAT_ARCHIVE_PREFIX, CHAT_DETAILS_PREFIX, SOURCE_BLOB_PREFIX]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move the internal blobs out of the enterprise file container")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="List the blobs without moving them")
+    args = parser.parse_args()
+
+    source = BlobStorageService()
+    target = BlobStorageService(AZURE_STORAGE_PRIVATE_CONTAINER)
+    if not args.dry_run and not target.blob_container.exists():
+        target.blob_container.create_container()
+    total = 0
+    for prefix in PRIVATE_BLOB_PREFIXES:
+        moved = 0
+        for blob_name in source.blob_container.list_blob_names(name_starts_with=f"{prefix}/"):
+            if args.dry_run:
+                print(blob_name)
+                continue
+            # コピーしてから削除する（途中で止めても再実行できる）
+            data = source.get_blob(blob_name).readall()
+            target.upload_data(blob_name, data)
+            source.delete_data(blob_name)
+            moved += 1
+        total += moved
+        print(f"{prefix}: {moved} blobs moved")
+    print(f"Done: {total} blobs moved to {AZURE_STORAGE_PRIVATE_CONTAINER}")
+
+
+if __name__ == "__main__":
+    main()
@@ -35,7 +35,7 @@ class FileApproach():
         self.cosmosdbService.insert_file_info(file_info)
 
         file_upload_thread = UploadFileProcess(
-            file_path, file_id, tag, folder_id)
+            file_path, file_id, tag, folder_id, created_user)
         file_upload_thread.start()
 
     def delete_enterprise_file(self, id, filename):
@@ -1,13 +1,13 @@
 import logging
-import openai
 from constants.constants import OPENAI_MODEL
+from core.telemetry import chat_completion
 
 PROMPT = """
 問題を簡潔に答えください。
 """
 
 
-def gptChat(chatId, history, openaiModel):
+async def gptChat(chatId, history, openaiModel):
     logging.info(f"Processing ChatId: {chatId} OpenaiModel: {openaiModel}")
 
     messages = [
@@ -21,7 +21,8 @@ def gptChat(chatId, history, openaiModel):
         openaiModel = "gpt-35-turbo"
     model_info = OPENAI_MODEL[openaiModel]
 
-    response = openai.ChatCompletion.create(
+    response = await chat_completion(
+        "completion",
         deployment_id=model_info["deployment"],
         messages=messages,
         temperature=0.7,
@@ -1,7 +1,7 @@
 
 import os
-import openai
 from core.messagebuilder import MessageBuilder
+from core.telemetry import chat_completion
 
 AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT")
 AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
@@ -20,8 +20,9 @@ PROMPT = """
 """
 
 
-def proofreading(text):
-    response = openai.ChatCompletion.create(
+async def proofreading(text):
+    response = await chat_completion(
+        "completion",
         deployment_id=AZURE_OPENAI_CHATGPT_DEPLOYMENT,
         messages=[
             {"role": "system", "content": PROMPT},
@@ -1,26 +1,19 @@
 import os
 import re
-import tempfile
+import asyncio
+import hashlib
+import logging
+import aiohttp
+import tiktoken
+from bs4 import BeautifulSoup
 from quart import current_app
-from langchain.chat_models import AzureChatOpenAI
-from langchain.chains import ConversationalRetrievalChain
-from langchain.document_loaders.csv_loader import CSVLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.document_loaders import PyPDFLoader
-from langchain.document_loaders import TextLoader
-from langchain.document_loaders import WebBaseLoader
-from langchain.document_loaders import UnstructuredExcelLoader
-from langchain.document_loaders import UnstructuredWordDocumentLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores.redis import Redis
-from langchain.vectorstores.redis import RedisText
-from langchain.memory import ChatMessageHistory
-from langchain.prompts import (
-    ChatPromptTemplate,
-    SystemMessagePromptTemplate,
-    HumanMessagePromptTemplate,
-)
+from langchain.docstore.document import Document
 from service.blobStorageService import BlobStorageService
+from service.redisService import RedisService
+from upload.fileParser import parse_files
+from core.modelhelper import get_oai_chatmodel_tiktok
+from core.telemetry import chat_completion, embedding, stage, stream_chat_completion
 from constants.constants import OPENAI_MODEL
 
 AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT")
@@ -35,6 +28,12 @@ REDIS_URL = os.getenv("REDIS_URL")
 REDIS_KEY = os.getenv("REDIS_KEY")
 REDIS_INDEX_NAME = os.getenv("REDIS_INDEX_NAME")
 AZURE_REDIS_URL = "rediss://:" + REDIS_KEY + "@" + REDIS_URL
+# URL取得の同時実行数・ホスト毎の上限・タイムアウト（秒）
+URL_FETCH_CONCURRENCY = int(os.getenv("URL_FETCH_CONCURRENCY", "8"))
+URL_FETCH_LIMIT_PER_HOST = int(os.getenv("URL_FETCH_LIMIT_PER_HOST", "2"))
+URL_FETCH_TIMEOUT = int(os.getenv("URL_FETCH_TIMEOUT", "20"))
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", "4"))
+SEARCH_TOP = 10
 
 
 CHAT_PROMPT = """資料と会話履歴を基づいて、最後の質問を答えってください。 
@@ -45,67 +44,166 @@ CHAT_PROMPT = """資料と会話履歴を基づいて、最後の質問を答え
 資料:{context}
 """
 
+CONDENSE_QUESTION_PROMPT = """Given the following conversation and a follow up question, rephrase the follow up question to be a standalone question, in its original language.
+
+Chat History:
+{chat_history}
+Follow Up Input: {question}
+Standalone question:"""
+
 
 class RetrieveChatApproach():
+    # Chat roles
+    SYSTEM = "system"
+    USER = "user"
+    ASSISTANT = "assistant"
+
     def __init__(self):
-        self.blobStorageService: BlobStorageService = current_app.config["BlobStorageService"]
-        self.prompt = ChatPromptTemplate(
-            messages=[
-                SystemMessagePromptTemplate.from_template(CHAT_PROMPT),
-                HumanMessagePromptTemplate.from_template("質問:{question}")
-            ]
-        )
-
-    def chat(self, chatId, history, openaiModel):
-        question = history[-1]["user"]
-        chat_history = ChatMessageHistory()
-        if (len(history[:-1]) > 0):
-            for h in reversed(history[:-1]):
-                if bot_msg := h.get("bot"):
-                    chat_history.add_ai_message(bot_msg)
-                if user_msg := h.get("user"):
-                    chat_history.add_user_message(user_msg)
-        chain_input = {"question": question,
-                       "chat_history": chat_history.messages}
-        
-        embeddings: OpenAIEmbeddings = OpenAIEmbeddings(
-            deployment=AZURE_OPENAI_EMB_DEPLOYMENT, chunk_size=1)
-        # seach the redis data
-        rds = Redis.from_existing_index(
-            embeddings,
-            index_name=REDIS_INDEX_NAME,
-            redis_url=AZURE_REDIS_URL,
-            schema="redis_schema.yaml"
-        )
-        chat_id_filter = RedisText("chat_id") == chatId.replace("-", "")
-        retriever = rds.as_retriever(search_type="similarity",
-                                     search_kwargs={"k": 10, 'filter': chat_id_filter})
+        # 元ファイルはダウンロード API で公開しないコンテナに保存する
+        self.blobStorageService: BlobStorageService = current_app.config["PrivateBlobStorageService"]
+        self.redisService: RedisService = current_app.config["RedisService"]
+
+    async def chat(self, chatId, history, openaiModel):
+        answer = "".join([delta async for delta in self.chatStream(chatId, history, openaiModel)])
+        return {"answer": answer}
 
+    async def chatStream(self, chatId, history, openaiModel):
+        """
+        Answers the last question with the chat's documents and yields the answer as it is generated.
+        The KNN search on the raw question runs while the question is condensed with the history.
+        """
+        question = history[-1]["user"]
         if (not openaiModel) or (openaiModel.strip() == ""):
             openaiModel = "gpt-35-turbo"
         model_info = OPENAI_MODEL[openaiModel]
-        print(model_info)
-        llm = AzureChatOpenAI(
-            deployment_name=model_info["deployment"], model_name=model_info["model"])
-        
-
-        chain = ConversationalRetrievalChain.from_llm(llm=llm,
-                                                      retriever=retriever,
-                                                      max_tokens_limit=model_info["maxtoken"],
-                                                      combine_docs_chain_kwargs={
-                                                          "prompt": self.prompt},
-                                                      verbose=True,
-                                                      return_source_documents=True)
-
-        result = chain(chain_input)
-        return {"answer": result["answer"]}
-    
-    def uploadFile(self, chat_id, files):
+
+        await self.rehydrate(chatId)
+        self.redisService.touch_chat(chatId)
+        source_hashes = self.redisService.get_chat_sources(chatId)
+        raw_search = asyncio.create_task(
+            self.search(question, chatId, source_hashes))
+        try:
+            standalone_question = question
+            if len(history) > 1:
+                standalone_question = await self.condenseQuestion(history, model_info)
+            docs = await raw_search
+        finally:
+            raw_search.cancel()
+        if standalone_question != question:
+            # 両方の検索結果から距離の近い順に上位を残す
+            nearest = {}
+            for doc in docs + await self.search(standalone_question, chatId, source_hashes):
+                if doc["id"] not in nearest or doc["distance"] < nearest[doc["id"]]["distance"]:
+                    nearest[doc["id"]] = doc
+            docs = sorted(nearest.values(),
+                          key=lambda doc: doc["distance"])[:SEARCH_TOP]
+
+        messages = [
+            {"role": self.SYSTEM, "content": CHAT_PROMPT.format(
+                context=self.buildContext(docs, openaiModel, model_info["maxtoken"]))},
+            {"role": self.USER, "content": f"質問:{standalone_question}"}
+        ]
+        async for delta in stream_chat_completion(
+                "completion",
+                deployment_id=model_info["deployment"],
+                model=model_info["model"],
+                messages=messages,
+                temperature=0.7):
+            yield delta
+
+    async def condenseQuestion(self, history, model_info):
+        chat_history = "\n".join(
+            [f"Human: {h['user']}\nAssistant: {h.get('bot', '')}" for h in history[:-1]])
+        query_completion = await chat_completion(
+            "query_rewrite",
+            deployment_id=model_info["deployment"],
+            model=model_info["model"],
+            messages=[{"role": self.USER, "content": CONDENSE_QUESTION_PROMPT.format(
+                chat_history=chat_history, question=history[-1]["user"])}],
+            temperature=0.0,
+            n=1)
+        return query_completion.choices[0].message.content.strip() or history[-1]["user"]
+
+    async def search(self, query, chatId, source_hashes):
+        query_vector = await embedding(AZURE_OPENAI_EMB_DEPLOYMENT, query)
+        with stage("search", **{"search.top": SEARCH_TOP, "search.sources": len(source_hashes)}) as span:
+            docs = await self.redisService.knn_search(query_vector, chatId, source_hashes, SEARCH_TOP)
+            span.set_attribute("search.documents", len(docs))
+            return docs
+
+    def buildContext(self, docs, openaiModel, max_tokens):
+        # ConversationalRetrievalChain の max_tokens_limit と同じく、上限を超える資料を除く
+        encoding = tiktoken.encoding_for_model(
+            get_oai_chatmodel_tiktok(openaiModel))
+        contents = []
+        token_length = 0
+        for doc in docs:
+            token_length += len(encoding.encode(doc["content"]))
+            if token_length > max_tokens:
+                break
+            contents.append(doc["content"])
+        return "\n\n".join(contents)
+
+    async def uploadFile(self, chat_id, files):
+        """
+        Links the files to the chat. Chunks are stored once per file content (sha256),
+        new files are parsed concurrently in the process pool.
+        """
+        new_files = {}
         for i in range(len(files)):
             file_key = f"file{i}"
             file = files.get(file_key)
-            documents = self.loadFile(file)
-            self.storeDocEmbeds(documents, chat_id, file.filename)
+            data = file.read()
+            source_hash = hashlib.sha256(data).hexdigest()
+            self.redisService.set_manifest(
+                chat_id, f"file:{source_hash}:{file.filename}", source_hash)
+            if self.redisService.has_source(source_hash) and self.redisService.link_source(chat_id, source_hash):
+                continue
+            new_files[source_hash] = (file.filename, data)
+
+        if len(new_files) == 0:
+            return
+        # 期限切れ・削除後に復元できるよう元ファイルを保存する
+        await asyncio.gather(*[asyncio.to_thread(self.blobStorageService.upload_data, self.blobName(source_hash), data)
+                               for source_hash, (_, data) in new_files.items()])
+        await self.storeFiles(chat_id, new_files)
+
+    async def storeFiles(self, chat_id, files):
+        parsed = await parse_files(list(files.values()))
+        for (source_hash, (filename, _)), documents in zip(files.items(), parsed):
+            await self.storeAndLink(chat_id, source_hash, filename, lambda documents=documents: documents)
+
+    async def rehydrate(self, chat_id):
+        """
+        Re-creates the chunks of the chat that were evicted or expired, from the original blob or url.
+        """
+        files = {}
+        urls = []
+        for resource_key, source_hash in self.redisService.get_manifest(chat_id).items():
+            if self.redisService.link_source(chat_id, source_hash):
+                continue
+            if resource_key.startswith("url:"):
+                urls.append(resource_key[len("url:"):])
+                continue
+            filename = resource_key.split(":", 2)[2]
+            blob_name = self.blobName(source_hash)
+            try:
+                blob = await asyncio.to_thread(self.blobStorageService.get_blob, blob_name)
+                data = await asyncio.to_thread(blob.readall)
+            except Exception:
+                logging.exception(f"Failed to rehydrate {blob_name}")
+                continue
+            files[source_hash] = (filename, data)
+        if len(files) == 0 and len(urls) == 0:
+            return
+        self.redisService.count_rehydration()
+        if len(files) > 0:
+            await self.storeFiles(chat_id, files)
+        if len(urls) > 0:
+            await self.uploadURL(chat_id, urls)
+
+    def blobName(self, source_hash):
+        return self.redisService.source_blob_name(source_hash)
 
     def checkURL(self, content):
         # URLの正規表現パターン
@@ -114,81 +212,99 @@ class RetrieveChatApproach():
         urls = re.findall(url_pattern, content)
         return urls
 
-    def uploadURL(self, chat_id, urls):
-        for url in urls:
-            loader = WebBaseLoader(url)
+    async def uploadURL(self, chat_id, urls):
+        """
+        Fetches the urls concurrently and links their chunks to the chat.
+        Chunks are embedded once per content and shared between chats.
+        """
+        urls = list(dict.fromkeys(urls))
+        semaphore = asyncio.Semaphore(URL_FETCH_CONCURRENCY)
+        connector = aiohttp.TCPConnector(
+            limit_per_host=URL_FETCH_LIMIT_PER_HOST)
+        timeout = aiohttp.ClientTimeout(total=URL_FETCH_TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(
+                *[self.uploadOneURL(session, semaphore, chat_id, url) for url in urls], return_exceptions=True)
+        for url, result in zip(urls, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to load URL: {url} {result}")
+
+    async def uploadOneURL(self, session: aiohttp.ClientSession, semaphore: asyncio.Semaphore, chat_id, url, conditional=True):
+        cached = self.redisService.get_url_cache(url) if conditional else None
+        if cached and not self.redisService.has_source(cached["source_hash"]):
+            cached = None
+        headers = {}
+        if cached:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        async with semaphore:
+            async with session.get(url, headers=headers) as response:
+                not_modified = response.status == 304
+                if not not_modified:
+                    response.raise_for_status()
+                    html = await response.text()
+                    etag = response.headers.get("ETag", "")
+                    last_modified = response.headers.get("Last-Modified", "")
+        if not_modified:
+            if cached is None:
+                # 条件を付けていないのに 304 を返された場合は、キャッシュなしとして条件なしで再取得する
+                if not conditional:
+                    raise RuntimeError(f"{url} returned 304 to an unconditional request")
+                return await self.uploadOneURL(session, semaphore, chat_id, url, conditional=False)
+            if self.redisService.link_source(chat_id, cached["source_hash"]):
+                self.redisService.set_manifest(
+                    chat_id, f"url:{url}", cached["source_hash"])
+                return
+            # リンク前にソースが削除された場合は条件なしで再取得する
+            return await self.uploadOneURL(session, semaphore, chat_id, url, conditional=False)
+
+        text = BeautifulSoup(html, "html.parser").get_text()
+        source_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+        def split():
             text_splitter = RecursiveCharacterTextSplitter(
                 chunk_size=200,
                 chunk_overlap=10,
                 length_function=len,
             )
-            documents = loader.load_and_split(text_splitter)
-            self.storeDocEmbeds(documents, chat_id, url)
+            return text_splitter.split_documents(
+                [Document(page_content=text, metadata={"source": url})])
+        self.redisService.set_manifest(chat_id, f"url:{url}", source_hash)
+        if await self.storeAndLink(chat_id, source_hash, url, split):
+            self.redisService.set_url_cache(
+                url, source_hash, etag, last_modified)
 
-    def storeDocEmbeds(self, documents, chat_id: str, resource):
+    async def storeAndLink(self, chat_id, source_hash: str, resource, split) -> bool:
         """
-        Stores document embeddings using Langchain and redis
+        Stores the chunks of the source unless another chat already did, and links them to the chat.
+        The source may be removed by the last other chat between the two, it is stored again then.
         """
-        if documents:
-            for document in documents:
-                document.metadata["chat_id"] = chat_id.replace("-", "")
-                document.metadata["resource"] = resource
-
-            embeddings: OpenAIEmbeddings = OpenAIEmbeddings(
-                deployment=AZURE_OPENAI_EMB_DEPLOYMENT, chunk_size=1)
-            rds = Redis.from_documents(
-                documents,
-                embeddings,
-                redis_url=AZURE_REDIS_URL,
-                index_name=REDIS_INDEX_NAME
-            )
-            # write the schema to a yaml file
-            # rds.write_schema("redis_schema.yaml")
-
-    def loadFile(self, file):
-
-        original_filename = file.filename
-        with tempfile.NamedTemporaryFile(mode="wb", delete=False) as tmp_file:
-            tmp_file.write(file.read())
-            tmp_file_path = tmp_file.name
+        for _ in range(2):
+            if not self.redisService.has_source(source_hash):
+                await self.storeSourceEmbeds(split(), source_hash, resource)
+            if self.redisService.link_source(chat_id, source_hash):
+                return True
+        logging.warning(f"Failed to link {resource} to the chat {chat_id}")
+        return False
 
-        def get_file_extension(uploaded_file):
-            file_extension = os.path.splitext(uploaded_file)[1].lower()
-            return file_extension
+    async def storeSourceEmbeds(self, documents, source_hash: str, resource):
+        """
+        Stores document embeddings shared between chats
+        """
+        texts = [document.page_content for document in documents]
+        if texts:
+            embeddings = await self.embedTexts(texts)
+            self.redisService.store_source(
+                source_hash, resource, texts, embeddings)
 
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=100,
-            length_function=len,
-        )
+    async def embedTexts(self, texts):
+        semaphore = asyncio.Semaphore(EMBEDDING_CONCURRENCY)
 
-        file_extension = get_file_extension(original_filename)
-        try:
-            if file_extension == ".csv":
-                loader = CSVLoader(file_path=tmp_file_path, encoding="utf-8", csv_args={
-                    'delimiter': ',', })
-                documents = loader.load()
-            elif file_extension == ".xlsx":
-                loader = UnstructuredExcelLoader(
-                    file_path=tmp_file_path, mode="elements")
-                documents = loader.load_and_split(text_splitter)
-
-            elif file_extension == ".docx":
-                loader = UnstructuredWordDocumentLoader(
-                    file_path=tmp_file_path)
-                documents = loader.load_and_split(text_splitter)
-
-            elif file_extension == ".pdf":
-                loader = PyPDFLoader(file_path=tmp_file_path)
-                documents = loader.load_and_split(text_splitter)
-
-            elif file_extension == ".txt":
-                loader = TextLoader(file_path=tmp_file_path, encoding="utf-8")
-                documents = loader.load_and_split(text_splitter)
-            else:
-                raise ValueError("csv、xlsx、docx、pdf、txt 以外のファイルを解析できません。") 
-        except Exception as e:
-            raise e
-        finally:
-            os.remove(tmp_file_path)
-        return documents
+        async def embed(text):
+            async with semaphore:
+                return await embedding(AZURE_OPENAI_EMB_DEPLOYMENT, text)
+        with stage("embed_documents", **{"openai.deployment": AZURE_OPENAI_EMB_DEPLOYMENT, "documents": len(texts)}):
+            return await asyncio.gather(*[embed(text) for text in texts])
@@ -8,14 +8,16 @@ from azure.storage.blob import BlobServiceClient
 AZURE_STORAGE_ACCOUNT = os.getenv("AZURE_STORAGE_ACCOUNT")
 AZURE_STORAGE_CONTAINER = os.getenv("AZURE_STORAGE_CONTAINER")
 AZURE_STORAGE_KEY = os.getenv("AZURE_STORAGE_KEY")
+# アプリ内部のデータ（チャットのアーカイブ等）のコンテナ。ダウンロード API で公開するコンテナとは分ける
+AZURE_STORAGE_PRIVATE_CONTAINER = os.getenv("AZURE_STORAGE_PRIVATE_CONTAINER", "chat-private")
 
 
 class BlobStorageService():
 
-    def __init__(self):
+    def __init__(self, container=AZURE_STORAGE_CONTAINER):
         self.blob_service = BlobServiceClient(
             account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=AZURE_STORAGE_KEY)
-        self.blob_container = self.blob_service.get_container_client(AZURE_STORAGE_CONTAINER)
+        self.blob_container = self.blob_service.get_container_client(container)
 
     def get_blob(self, file_name):
         if self.blob_container.exists():
@@ -49,6 +51,20 @@ class BlobStorageService():
                 file_id, data, overwrite=True)
         return uploaded_blob.url
 
+    def upload_data(self, blob_name, data):
+        if not self.blob_container.exists():
+            self.blob_container.create_container()
+        uploaded_blob = self.blob_container.upload_blob(
+            blob_name, data, overwrite=True)
+        return uploaded_blob.url
+
+    def delete_data(self, blob_name):
+        self.blob_container.delete_blob(blob_name)
+
+    def delete_prefix(self, prefix):
+        for blob_name in self.blob_container.list_blob_names(name_starts_with=prefix):
+            self.blob_container.delete_blob(blob_name)
+
     def remove_blobs(self, filename):
         print(f"Removing blobs for '{filename}'")
         if self.blob_container.exists():
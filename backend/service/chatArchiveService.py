@@ -0,0 +1,140 @@
+import os
+import gzip
+import json
+import time
+import uuid
+import logging
+from datetime import datetime
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from service.cosmosdbService import CosmosdbService
+from service.blobStorageService import BlobStorageService
+
+# 最後の会話からこの日数が経過したチャットの会話内容を Blob に移す（0 の場合は無効）
+CHAT_ARCHIVE_IDLE_DAYS = int(os.getenv("CHAT_ARCHIVE_IDLE_DAYS", "30"))
+CHAT_ARCHIVE_INTERVAL = int(os.getenv("CHAT_ARCHIVE_INTERVAL", "3600"))
+# 一回の実行でアーカイブするチャットの最大数
+CHAT_ARCHIVE_BATCH = int(os.getenv("CHAT_ARCHIVE_BATCH", "100"))
+CHAT_ARCHIVE_PREFIX = "chatarchive"
+CHAT_ARCHIVE_STATS_KEY = "chat_archive_stats"
+CHAT_ARCHIVE_LOCK_KEY = "chat_archive_lock"
+# チャット毎のアーカイブ・復元のロックの有効期間と待ち時間（秒）
+CHAT_ARCHIVE_CHAT_LOCK_TIMEOUT = int(os.getenv("CHAT_ARCHIVE_CHAT_LOCK_TIMEOUT", "60"))
+SYSTEM_PROPERTIES = ["_rid", "_self", "_etag", "_attachments", "_ts"]
+
+
+class ChatArchiveService():
+
+    def __init__(self, cosmosdbService: CosmosdbService, blobStorageService: BlobStorageService, redis_client):
+        self.cosmosdbService = cosmosdbService
+        self.blobStorageService = blobStorageService
+        self.client = redis_client
+        cosmosdbService.rehydrate_chat = self.rehydrate
+
+    def blob_name(self, chat_id):
+        return f"{CHAT_ARCHIVE_PREFIX}/{chat_id}.json.gz"
+
+    def archive_idle_chats(self):
+        """
+        一定期間使われていないチャットの会話内容を圧縮して Blob に移す。
+        """
+        if CHAT_ARCHIVE_IDLE_DAYS <= 0:
+            return 0
+        # 複数のワーカーで同時に実行しない
+        if not self.client.set(CHAT_ARCHIVE_LOCK_KEY, str(uuid.uuid4()), nx=True, ex=CHAT_ARCHIVE_INTERVAL):
+            return 0
+        idle_before = int(time.time()) - CHAT_ARCHIVE_IDLE_DAYS * 24 * 60 * 60
+        archived = 0
+        for chat_id in self.cosmosdbService.get_archive_candidates(idle_before, CHAT_ARCHIVE_BATCH):
+            try:
+                last_activity = self.cosmosdbService.get_last_activity(chat_id)
+                if last_activity is None or last_activity >= idle_before:
+                    # 会話内容がない・最近の会話がある場合は、次回以降の候補に挙がらないよう last_activity を記録する
+                    self.cosmosdbService.touch_chat(chat_id, last_activity)
+                    continue
+                if self.archive_chat(chat_id, idle_before):
+                    archived += 1
+            except Exception:
+                logging.exception(f"Failed to archive chat {chat_id}")
+        return archived
+
+    def chat_lock(self, chat_id):
+        # 同じチャットのアーカイブと復元を同時に実行しない
+        # （アーカイブ中の削除と復元が重なると、戻した会話内容を削除してしまう）
+        return self.client.lock(f"{CHAT_ARCHIVE_LOCK_KEY}:{chat_id}",
+                                timeout=CHAT_ARCHIVE_CHAT_LOCK_TIMEOUT, blocking_timeout=CHAT_ARCHIVE_CHAT_LOCK_TIMEOUT)
+
+    def archive_chat(self, chat_id, idle_before):
+        with self.chat_lock(chat_id):
+            items = self.cosmosdbService.get_chat_content(chat_id)
+            body = json.dumps([{k: v for k, v in item.items() if k not in SYSTEM_PROPERTIES} for item in items],
+                              ensure_ascii=False).encode("utf-8")
+            data = gzip.compress(body)
+            # Blob に保存してから Cosmos の会話内容を削除する
+            self.blobStorageService.upload_data(self.blob_name(chat_id), data)
+            archived = {"blob": self.blob_name(chat_id),
+                        "count": len(items),
+                        "original_bytes": len(body),
+                        "compressed_bytes": len(data),
+                        "archived_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            deleted = self.cosmosdbService.archive_chat_content(chat_id, archived, items, idle_before)
+            if deleted is None:
+                # 会話内容を読んだ後に会話が追加された
+                self.blobStorageService.delete_data(self.blob_name(chat_id))
+                return False
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.hincrby(CHAT_ARCHIVE_STATS_KEY, "chats", 1)
+        pipeline.hincrby(CHAT_ARCHIVE_STATS_KEY, "documents", deleted)
+        pipeline.hincrby(CHAT_ARCHIVE_STATS_KEY, "original_bytes", len(body))
+        pipeline.hincrby(CHAT_ARCHIVE_STATS_KEY, "compressed_bytes", len(data))
+        pipeline.execute()
+        print(f"Archived chat {chat_id} ({deleted} documents, {len(body)} -> {len(data)} bytes)")
+        return True
+
+    def rehydrate(self, chat_id, chat=None):
+        """
+        アーカイブされたチャットの会話内容を Cosmos に戻す。アーカイブされていない場合は False。
+        アーカイブ後に追加された会話内容は残したまま、アーカイブ分を戻す。
+        同じチャットを同時に戻した場合、後の呼び出しは何もしない。
+        """
+        chat = chat or self.cosmosdbService.get_chat(chat_id)
+        if not chat.get("archived"):
+            return False
+        with self.chat_lock(chat_id):
+            # 待っている間に他の呼び出しが戻した場合
+            archived = self.cosmosdbService.get_chat(chat_id).get("archived")
+            if not archived:
+                return True
+            data = self.blobStorageService.get_blob(archived["blob"]).readall()
+            items = json.loads(gzip.decompress(data))
+            if not self.cosmosdbService.restore_chat_content(chat_id, items):
+                return True
+            try:
+                self.blobStorageService.delete_data(archived["blob"])
+            except ResourceNotFoundError:
+                pass
+        self.client.hincrby(CHAT_ARCHIVE_STATS_KEY, "rehydrated", 1)
+        print(f"Rehydrated chat {chat_id} ({len(items)} documents)")
+        return True
+
+    def delete_archive(self, chat):
+        # 削除したチャットのアーカイブを削除する
+        if chat.get("archived"):
+            try:
+                self.blobStorageService.delete_data(chat["archived"]["blob"])
+            except Exception:
+                logging.exception(f"Failed to delete the archive of chat {chat['id']}")
+
+    def get_stats(self):
+        """
+        アーカイブで Cosmos から Blob に移したドキュメント数と容量を返す。
+        RU は計測していない（アーカイブ・復元の RU は含まない）。
+        """
+        stats = {k.decode("utf-8"): int(v)
+                 for k, v in self.client.hgetall(CHAT_ARCHIVE_STATS_KEY).items()}
+        original = stats.get("original_bytes", 0)
+        compressed = stats.get("compressed_bytes", 0)
+        stats["saved_bytes"] = original - compressed
+        stats["compression_ratio"] = round(original / compressed, 2) if compressed else 0
+        return stats
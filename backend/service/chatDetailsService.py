@@ -0,0 +1,38 @@
+import gzip
+import json
+import logging
+from uuid import uuid1
+
+from service.blobStorageService import BlobStorageService
+
+# 会話内容の thoughts / data_points は圧縮して Blob に保存し、分析パネルを開いた時に取得する
+CHAT_DETAILS_PREFIX = "chatdetails"
+
+
+class ChatDetailsService():
+
+    def __init__(self, blobStorageService: BlobStorageService):
+        self.blobStorageService = blobStorageService
+
+    def save(self, chat_id, thoughts, data_points):
+        """
+        thoughts / data_points を Blob に保存し、Blob 名を返す。どちらもない場合は空文字。
+        """
+        if not thoughts and not data_points:
+            return ""
+        blob_name = f"{CHAT_DETAILS_PREFIX}/{chat_id}/{uuid1()}.json.gz"
+        data = gzip.compress(json.dumps({"thoughts": thoughts, "data_points": data_points},
+                                        ensure_ascii=False).encode("utf-8"))
+        self.blobStorageService.upload_data(blob_name, data)
+        return blob_name
+
+    def load(self, blob_name):
+        data = self.blobStorageService.get_blob(blob_name).readall()
+        return json.loads(gzip.decompress(data))
+
+    def delete_chat(self, chat_id):
+        # 削除したチャットの thoughts / data_points を削除する
+        try:
+            self.blobStorageService.delete_prefix(f"{CHAT_DETAILS_PREFIX}/{chat_id}/")
+        except Exception:
+            logging.exception(f"Failed to delete the details of chat {chat_id}")
@@ -0,0 +1,170 @@
+import os
+import json
+import uuid
+import logging
+from datetime import datetime
+
+from constants import constants
+from service.cosmosdbService import CosmosdbService, CHAT_LIST_FIELDS, MAX_PAGE_SIZE
+
+# Cosmos の変更フィードから作成する、ユーザー毎のチャット一覧（Redis）
+CHAT_LIST_PREFIX = "chat_list"
+CHAT_LIST_ITEMS_PREFIX = "chat_list_items"
+# 変更フィードの続き（chat-data は etag、chats は読み終えた _ts）
+CHAT_FEED_CONTINUATION_KEY = "chat_list_feed"
+# 一覧が作成済み（最初から最後まで変更フィードを読み終えた）
+CHAT_FEED_READY_KEY = "chat_list_ready"
+# 変更フィードを読むワーカーは一つだけ
+CHAT_FEED_LOCK_KEY = "chat_list_feed_lock"
+CHAT_FEED_INTERVAL = float(os.getenv("CHAT_FEED_INTERVAL", "2"))
+# 一覧の続きのトークン。Redis は "r:<位置>"、Cosmos は "c:<Cosmos のトークン>"
+# 一覧の作成中にページングを始めたクライアントは、作成後も Cosmos で続きを読む
+REDIS_TOKEN_PREFIX = "r:"
+COSMOS_TOKEN_PREFIX = "c:"
+
+
+class ChatListViewService():
+
+    def __init__(self, cosmosdbService: CosmosdbService, redis_client):
+        self.cosmosdbService = cosmosdbService
+        self.client = redis_client
+        self.lock_token = str(uuid.uuid4())
+
+    def list_key(self, user_name, chat_type):
+        return f"{CHAT_LIST_PREFIX}:{user_name}:{chat_type}"
+
+    def items_key(self, user_name, chat_type):
+        return f"{CHAT_LIST_ITEMS_PREFIX}:{user_name}:{chat_type}"
+
+    def get_chat_list(self, user_name, chat_type, page_size=None, continuation_token=None):
+        """
+        Redis のチャット一覧を新しい順に返す。一覧が未作成の場合は Cosmos から取得する。
+        続きはトークンを返した方から読む。
+        """
+        if continuation_token:
+            # 接頭辞のない数字は以前の Redis のトークン
+            use_redis = continuation_token.startswith(REDIS_TOKEN_PREFIX) or continuation_token.isdigit()
+        else:
+            use_redis = self.client.exists(CHAT_FEED_READY_KEY)
+        if not use_redis:
+            if continuation_token:
+                continuation_token = continuation_token.removeprefix(COSMOS_TOKEN_PREFIX)
+            res = self.cosmosdbService.get_chat_list(user_name, chat_type, page_size, continuation_token)
+            if page_size is not None and res["continuation_token"]:
+                res["continuation_token"] = COSMOS_TOKEN_PREFIX + res["continuation_token"]
+            return res
+        start = int(continuation_token.removeprefix(REDIS_TOKEN_PREFIX)) if continuation_token else 0
+        count = max(1, min(int(page_size), MAX_PAGE_SIZE)) if page_size else -1
+        end = start + count - 1 if page_size else -1
+        chat_ids = self.client.zrevrange(
+            self.list_key(user_name, chat_type), start, end)
+        items = []
+        if chat_ids:
+            items = [json.loads(item) for item in self.client.hmget(
+                self.items_key(user_name, chat_type), chat_ids) if item]
+        if page_size is None:
+            return items
+        next_token = f"{REDIS_TOKEN_PREFIX}{start + len(chat_ids)}" if len(chat_ids) == count else None
+        return {"items": items, "continuation_token": next_token}
+
+    def refresh(self, item):
+        # 変更フィードを待たずに反映する（失敗しても変更フィードで反映される）
+        try:
+            self.apply([item])
+        except Exception:
+            logging.exception("Failed to refresh the chat list view")
+
+    def apply(self, items):
+        pipeline = self.client.pipeline(transaction=False)
+        for item in items:
+            if item.get("type") != constants.DB_TYPE_CHAT:
+                continue
+            list_key = self.list_key(item["created_user"], item["chat_type"])
+            items_key = self.items_key(item["created_user"], item["chat_type"])
+            if item.get("deleted"):
+                pipeline.zrem(list_key, item["id"])
+                pipeline.hdel(items_key, item["id"])
+            else:
+                summary = {key: item[key] for key in CHAT_LIST_FIELDS if key in item}
+                pipeline.zadd(list_key, {item["id"]: chat_score(item)})
+                pipeline.hset(items_key, item["id"], json.dumps(summary, ensure_ascii=False))
+        pipeline.execute()
+
+    def acquire_lock(self, ttl):
+        if self.client.set(CHAT_FEED_LOCK_KEY, self.lock_token, nx=True, ex=ttl):
+            return True
+        owner = self.client.get(CHAT_FEED_LOCK_KEY)
+        if owner is not None and owner.decode("utf-8") == self.lock_token:
+            self.client.expire(CHAT_FEED_LOCK_KEY, ttl)
+            return True
+        return False
+
+    def process_change_feed(self):
+        """
+        前回の続きから変更フィードを読み、チャット一覧に反映する。
+        """
+        if not self.acquire_lock(int(CHAT_FEED_INTERVAL * 10) + 10):
+            return 0
+        if self.cosmosdbService.partitioned_chat:
+            processed = self.process_chat_changes()
+        else:
+            processed = self.process_feed()
+        if not self.client.exists(CHAT_FEED_READY_KEY):
+            self.client.set(CHAT_FEED_READY_KEY, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            print(f"Chat list view is ready ({processed} changes)")
+        return processed
+
+    def process_feed(self):
+        # chat-data はチャットが "chat" パーティションにまとまっているため、変更フィードで読む
+        container = self.cosmosdbService.chat_data_container
+        continuation = self.client.hget(CHAT_FEED_CONTINUATION_KEY, "chat")
+        # 続きの etag は各ページの応答から受け取る（client_connection.last_response_headers は
+        # 他のスレッドの要求でも上書きされる）。作成時の呼び出し（結果がページでない）は無視する
+        etags = []
+
+        def on_response(headers, result):
+            if isinstance(result, dict) and headers.get("etag"):
+                etags.append(headers["etag"])
+        if continuation is None:
+            feed = container.query_items_change_feed(
+                is_start_from_beginning=True, max_item_count=MAX_PAGE_SIZE, partition_key=constants.DB_TYPE_CHAT,
+                response_hook=on_response)
+        else:
+            feed = container.query_items_change_feed(
+                continuation=continuation.decode("utf-8"), max_item_count=MAX_PAGE_SIZE,
+                partition_key=constants.DB_TYPE_CHAT, response_hook=on_response)
+        items = list(feed)
+        self.apply(items)
+        if etags:
+            self.client.hset(CHAT_FEED_CONTINUATION_KEY, "chat", etags[-1])
+        return len(items)
+
+    def process_chat_changes(self):
+        # chats はチャット毎のパーティションのため、全パーティションのチャットを _ts 順に読む
+        # 同じ _ts の更新を取りこぼさないよう >= で読み、同じチャットの反映は何度行っても同じ結果になる
+        last_ts = int(self.client.hget(CHAT_FEED_CONTINUATION_KEY, "ts") or 0)
+        QUERY = "SELECT * FROM c WHERE c.type=@type AND c._ts >= @ts ORDER BY c._ts"
+        params = [dict(name="@type", value=constants.DB_TYPE_CHAT),
+                  dict(name="@ts", value=last_ts)]
+        pages = self.cosmosdbService.chats_container.query_items(
+            query=QUERY, parameters=params, enable_cross_partition_query=True, max_item_count=MAX_PAGE_SIZE).by_page()
+        processed = 0
+        for page in pages:
+            items = list(page)
+            if not items:
+                continue
+            self.apply(items)
+            self.client.hset(CHAT_FEED_CONTINUATION_KEY, "ts", items[-1]["_ts"])
+            processed += len(items)
+        return processed
+
+    def reset(self):
+        # レイアウトを切り替えた場合などに一覧を作り直す
+        self.client.delete(CHAT_FEED_CONTINUATION_KEY, CHAT_FEED_READY_KEY)
+
+
+def chat_score(item):
+    try:
+        return datetime.strptime(item["create_date"], "%Y-%m-%d %H:%M:%S").timestamp()
+    except (KeyError, ValueError):
+        return item.get("_ts", 0)
@@ -21,6 +21,7 @@ from azure.search.documents.indexes.models import (
 )
 from quart import current_app
 
+from core import searchcache
 from service.openaiService import OpenaiService
 
 MAX_SECTION_LENGTH = 1000
@@ -135,6 +136,8 @@ class CognitiveSearchService():
             succeeded = sum([1 for r in results if r.succeeded])
             print(
                 f"\tIndexed {len(results)} sections, {succeeded} succeeded")
+        # キャッシュ済みの検索結果に新しいドキュメントが含まれないため、使わないようにする
+        searchcache.cache.increment()
 
     def filename_to_id(self, filename):
         filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", filename)
@@ -226,3 +229,5 @@ class CognitiveSearchService():
             print(f"\tRemoved {len(r)} sections from index")
             # It can take a few seconds for search results to reflect changes, so wait a bit
             time.sleep(2)
+        # キャッシュ済みの検索結果に削除したドキュメントが含まれるため、使わないようにする
+        searchcache.cache.increment()
@@ -1,11 +1,19 @@
 import os
+import json
+import time
+import logging
+import itertools
 from uuid import uuid1
 from datetime import datetime
 from azure.cosmos import CosmosClient, PartitionKey
+from azure.core import MatchConditions
+from azure.cosmos.exceptions import CosmosAccessConditionFailedError, CosmosResourceExistsError, CosmosResourceNotFoundError
 from entity.chatInfo import ChatInfo
 from entity.chatContent import ChatContent
 from entity.fileInfo import FileInfo, Attributes
 from constants import constants
+from core.ttlcache import TTLCache
+from core.cosmosmetrics import background, instrument_methods, response_hook, wait_for_budget
 
 ENDPOINT = os.getenv("AZURE_COSMOSDB_URI")
 KEY = os.getenv("AZURE_COSMOSDB_KEY")
@@ -18,12 +26,91 @@ USER_INFO_CONTAINER_NAME = "user-info"
 # COSMOSDB_DATABASE = "openai-chat-db"
 CONTAINER_CHAT_DATA = "chat-data"
 CONTAINER_COMMON_DATA = "common-data"
+# チャット単位でパーティション分割したレイアウト
+# chats: チャットと会話内容（/chat_id）、user-chats: ユーザー毎のチャット一覧（/created_user）
+CONTAINER_CHATS = "chats"
+CONTAINER_USER_CHATS = "user-chats"
+# ログイン履歴（/user_id）、保持期間を過ぎた履歴は TTL で自動削除される
+CONTAINER_LOGIN_HISTORY = "login-history"
+LOGIN_HISTORY_RETENTION_DAYS = int(os.getenv("LOGIN_HISTORY_RETENTION_DAYS", "90"))
+# ユーザー毎の直近ログインをまとめたドキュメントの件数
+LOGIN_HISTORY_LATEST_COUNT = int(os.getenv("LOGIN_HISTORY_LATEST_COUNT", "20"))
+LOGIN_SUMMARY_ID = "latest"
+# "type": chat-data を使う（従来）、"chat": chats / user-chats を使う
+# migration/migrateChatLayout.py で移行してから切り替えること
+CHAT_LAYOUT = os.getenv("AZURE_COSMOSDB_CHAT_LAYOUT", "type")
+CHAT_SUMMARY_FIELDS = ["id", "type", "chat_id", "chat_type",
+                       "chat_name", "openai_model", "created_user", "create_date"]
+# 一覧表示で取得する項目
+CHAT_LIST_FIELDS = ["id", "chat_type", "chat_name", "create_date", "openai_model"]
+# thoughts / data_points を除いた会話内容の項目
+CHAT_CONTENT_FIELDS = ["id", "chat_id", "index", "question", "answer", "details"]
+# ユーザー権限・フォルダのキャッシュ時間（秒）
+COMMON_DATA_CACHE_TTL = float(os.getenv("AZURE_COSMOSDB_CACHE_TTL", "300"))
+CACHE_KEY_FOLDERS = "folders"
+CACHE_KEY_USER_INFO = "user_info"
+# ファイル一覧の絞り込み項目（ORDER BY と複合インデックスはこの順番に並べる）
+FILE_FILTER_FIELDS = ["folder_id", "attributes.tag", "created_user", "file_name"]
+FILE_FACETS_ID = "file-facets"
+# フォルダ・タグが未設定のファイルの集計キー（空のキーは patch のパスにできない）
+FILE_FACET_NONE = "_none"
+# 一ページの最大件数
+MAX_PAGE_SIZE = int(os.getenv("AZURE_COSMOSDB_MAX_PAGE_SIZE", "100"))
 
+# パーティション内のチャットの会話内容をサーバー側でまとめて削除する
+# 実行時間の上限に達した場合は continuation: true を返すので、再実行すること
+BULK_DELETE_CHAT_SPROC = "bulkDeleteChat"
+BULK_DELETE_CHAT_SCRIPT = """
+function bulkDeleteChat(chatId, ids) {
+    var collection = getContext().getCollection();
+    var response = getContext().getResponse();
+    var deleted = 0;
+    var query = {
+        query: "SELECT c._self FROM c WHERE c.chat_id = @chat_id",
+        parameters: [{ name: "@chat_id", value: chatId }]
+    };
+    if (ids) {
+        // 指定したドキュメントのみ削除する
+        query.query += " AND ARRAY_CONTAINS(@ids, c.id)";
+        query.parameters.push({ name: "@ids", value: ids });
+    }
+    queryAndDelete();
 
+    function queryAndDelete() {
+        var accepted = collection.queryDocuments(collection.getSelfLink(), query, {}, function (err, docs) {
+            if (err) throw err;
+            if (docs.length > 0) {
+                deleteDocuments(docs, 0);
+            } else {
+                response.setBody({ deleted: deleted, continuation: false });
+            }
+        });
+        if (!accepted) response.setBody({ deleted: deleted, continuation: true });
+    }
+
+    function deleteDocuments(docs, index) {
+        if (index >= docs.length) {
+            queryAndDelete();
+            return;
+        }
+        var accepted = collection.deleteDocument(docs[index]._self, {}, function (err) {
+            if (err) throw err;
+            deleted++;
+            deleteDocuments(docs, index + 1);
+        });
+        if (!accepted) response.setBody({ deleted: deleted, continuation: true });
+    }
+}
+"""
+
+
+@instrument_methods
 class CosmosdbService():
 
     def __init__(self):
-        self.client = CosmosClient(url=ENDPOINT, credential=KEY)
+        # 全リクエストの RU・429 を記録する
+        self.client = CosmosClient(
+            url=ENDPOINT, credential=KEY, raw_response_hook=response_hook)
         self.database = self.client.create_database_if_not_exists(
             id=DATABASE_NAME)
         key_path = PartitionKey(path="/id")
@@ -42,70 +129,288 @@ class CosmosdbService():
         self.common_data_container = self.database.create_container_if_not_exists(id=CONTAINER_COMMON_DATA,
                                                                                   partition_key=PartitionKey(path="/type"))
 
+        self.chats_container = self.database.create_container_if_not_exists(id=CONTAINER_CHATS,
+                                                                            partition_key=PartitionKey(path="/chat_id"))
+        self.user_chats_container = self.database.create_container_if_not_exists(
+            id=CONTAINER_USER_CHATS,
+            partition_key=PartitionKey(path="/created_user"),
+            indexing_policy={
+                "indexingMode": "consistent",
+                "includedPaths": [{"path": "/*"}],
+                "excludedPaths": [{"path": "/\"_etag\"/?"}],
+                "compositeIndexes": [[
+                    {"path": "/chat_type", "order": "ascending"},
+                    {"path": "/create_date", "order": "descending"}
+                ]]
+            })
+        login_history_policy = {
+            "indexingMode": "consistent",
+            "includedPaths": [{"path": "/*"}],
+            "excludedPaths": [{"path": "/\"_etag\"/?"}, {"path": "/logins/*"}],
+            "compositeIndexes": [[
+                {"path": "/type", "order": "ascending"},
+                {"path": "/login_time", "order": "descending"}
+            ]]
+        }
+        login_history_ttl = LOGIN_HISTORY_RETENTION_DAYS * 24 * 60 * 60
+        self.login_history_container = self.database.create_container_if_not_exists(
+            id=CONTAINER_LOGIN_HISTORY, partition_key=PartitionKey(path="/user_id"),
+            indexing_policy=login_history_policy, default_ttl=login_history_ttl)
+        if self.login_history_container.read().get("defaultTtl") != login_history_ttl:
+            # 保持期間の変更を反映する
+            self.login_history_container = self.database.replace_container(
+                self.login_history_container, partition_key=PartitionKey(path="/user_id"),
+                indexing_policy=login_history_policy, default_ttl=login_history_ttl)
+        self.ensure_common_data_indexes()
+        self.partitioned_chat = CHAT_LAYOUT == "chat"
+        self.cache = TTLCache(COMMON_DATA_CACHE_TTL)
+        # アーカイブされたチャットに会話を追加する前に会話内容を戻す関数（ChatArchiveService.rehydrate）
+        self.rehydrate_chat = None
+        for container in [self.chat_data_container, self.chats_container]:
+            sproc = {"id": BULK_DELETE_CHAT_SPROC, "body": BULK_DELETE_CHAT_SCRIPT}
+            try:
+                container.scripts.create_stored_procedure(body=sproc)
+            except CosmosResourceExistsError:
+                if container.scripts.get_stored_procedure(BULK_DELETE_CHAT_SPROC)["body"] != BULK_DELETE_CHAT_SCRIPT:
+                    container.scripts.replace_stored_procedure(sproc=BULK_DELETE_CHAT_SPROC, body=sproc)
+
     # chat-data
+    def chat_container(self):
+        return self.chats_container if self.partitioned_chat else self.chat_data_container
+
+    def chat_partition_key(self, chat_id, doc_type):
+        return chat_id if self.partitioned_chat else doc_type
+
     def create_chat(self, user_name, chat_name, chat_type):
+        chat_id = str(uuid1())
         chat_info = ChatInfo(
-            id=str(uuid1()), type=constants.DB_TYPE_CHAT, chat_name=chat_name, chat_type=chat_type, openai_model="", created_user=user_name)
-        self.chat_data_container.create_item(chat_info.json)
+            id=chat_id, type=constants.DB_TYPE_CHAT, chat_name=chat_name, chat_type=chat_type, openai_model="", created_user=user_name, chat_id=chat_id)
+        self.chat_container().create_item(chat_info.json)
+        if self.partitioned_chat:
+            self.user_chats_container.create_item(chat_info.json)
         return chat_info
 
-    def add_chat_content(self, chat_id, index, chat_type, question, answer):
-        if chat_type == "qa":
+    def add_chat_content(self, chat_id, index, chat_type, question, answer, details=""):
+        if chat_type == "qa" and not details:
             chatContent = ChatContent(id=str(uuid1()), type=constants.DB_TYPE_CONTENT, chat_id=chat_id, index=index, question=question,
                                       answer=answer["answer"], data_points=answer["data_points"], thoughts=answer["thoughts"])
         else:
+            # details がある場合、thoughts / data_points は Blob に保存済み
             chatContent = ChatContent(id=str(uuid1()), type=constants.DB_TYPE_CONTENT, chat_id=chat_id, index=index, question=question,
-                                      answer=answer["answer"], data_points=[], thoughts="")
+                                      answer=answer["answer"], data_points=[], thoughts="", details=details)
 
-        self.chat_data_container.create_item(chatContent.json)
+        # 最後の会話の時刻を記録し、アーカイブされている場合は会話内容を戻してから追加する
+        chat = self.touch_chat(chat_id)
+        if chat.get("archived") and self.rehydrate_chat is not None:
+            self.rehydrate_chat(chat_id, chat)
+        self.chat_container().create_item(chatContent.json)
         return chatContent.id
 
+    def touch_chat(self, chat_id, last_activity=None):
+        """
+        チャットの last_activity（最後の会話の時刻、エポック秒）を更新する。アーカイブ対象の判定に使う。
+        """
+        return self.patch(self.chat_container(), chat_id, self.chat_partition_key(chat_id, constants.DB_TYPE_CHAT),
+                          [{"op": "set", "path": "/last_activity", "value": last_activity or int(time.time())}])
+
+    def get_chat_content_item(self, chat_id, content_id):
+        return self.chat_container().read_item(
+            item=content_id, partition_key=self.chat_partition_key(chat_id, constants.DB_TYPE_CONTENT))
+
     def delete_chat_and_content(self, chat_id):
-        self.chat_data_container.delete_item(
-            item=chat_id, partition_key=constants.DB_TYPE_CHAT)
-        results = self.get_chat_content(chat_id)
+        self.mark_chat_deleted(chat_id)
+        self.purge_chat(chat_id)
+
+    def mark_chat_deleted(self, chat_id):
+        """
+        チャットに削除済みの印を付け、一覧から外す。会話内容は purge_chat で削除する。
+        """
+        item = self.chat_container().patch_item(
+            item=chat_id, partition_key=self.chat_partition_key(chat_id, constants.DB_TYPE_CHAT),
+            patch_operations=[{"op": "set", "path": "/deleted", "value": True}])
+        if self.partitioned_chat:
+            try:
+                self.user_chats_container.delete_item(
+                    item=chat_id, partition_key=item["created_user"])
+            except CosmosResourceNotFoundError:
+                pass
+        return item
+
+    @background
+    def purge_chat(self, chat_id):
+        # ストアドプロシージャでパーティション内の会話内容をまとめて削除する
+        # chats コンテナではチャット自体も同じパーティションにあるため一緒に削除される
+        deleted = self.bulk_delete_chat(chat_id)
+        if not self.partitioned_chat:
+            try:
+                self.chat_data_container.delete_item(
+                    item=chat_id, partition_key=constants.DB_TYPE_CHAT)
+            except CosmosResourceNotFoundError:
+                pass
+        print(f"Purged chat {chat_id} ({deleted} documents)")
+
+    def bulk_delete_chat(self, chat_id, ids=None):
+        partition_key = self.chat_partition_key(chat_id, constants.DB_TYPE_CONTENT)
+        deleted = 0
+        while True:
+            wait_for_budget()
+            result = self.chat_container().scripts.execute_stored_procedure(
+                sproc=BULK_DELETE_CHAT_SPROC, partition_key=partition_key, params=[chat_id, ids])
+            deleted += result["deleted"]
+            if not result["continuation"]:
+                return deleted
+
+    @background
+    def purge_deleted_chats(self):
+        # 削除途中で停止したチャットを削除し直す
+        QUERY = "SELECT c.id FROM c WHERE c.type=@type AND c.deleted=true"
+        params = [dict(name="@type", value=constants.DB_TYPE_CHAT)]
+        if self.partitioned_chat:
+            results = self.chats_container.query_items(
+                query=QUERY, parameters=params, enable_cross_partition_query=True)
+        else:
+            results = self.chat_data_container.query_items(
+                query=QUERY, parameters=params, partition_key=constants.DB_TYPE_CHAT)
         for item in list(results):
-            self.chat_data_container.delete_item(
-                item=item, partition_key=constants.DB_TYPE_CONTENT)
+            self.purge_chat(item["id"])
 
-    def update_chat_name(self, chat_id, chat_name):
-        item = self.chat_data_container.read_item(
-            item=chat_id, partition_key=constants.DB_TYPE_CHAT)
-        item["chat_name"] = chat_name
-        self.chat_data_container.replace_item(item=item, body=item)
+    def update_chat_name(self, chat_id, chat_name, etag=None):
+        return self.patch_chat(chat_id, {"chat_name": chat_name}, etag)
 
     def update_chat(self, chat_id, chat_name, openai_model):
-        item = self.chat_data_container.read_item(
-            item=chat_id, partition_key=constants.DB_TYPE_CHAT)
-        item["chat_name"] = chat_name
-        item["openai_model"] = openai_model
-        self.chat_data_container.replace_item(item=item, body=item)
+        return self.patch_chat(chat_id, {"chat_name": chat_name, "openai_model": openai_model})
+
+    def patch_chat(self, chat_id, values, etag=None):
+        """
+        チャットの項目を部分更新する。etag（get_chat が返す _etag）を指定した場合は他の更新と競合すると 412 になる。
+        """
+        operations = [{"op": "set", "path": f"/{key}", "value": value}
+                      for key, value in values.items()]
+        item = self.patch(self.chat_container(), chat_id,
+                          self.chat_partition_key(chat_id, constants.DB_TYPE_CHAT), operations, etag)
+        if self.partitioned_chat:
+            self.patch(self.user_chats_container, chat_id,
+                       item["created_user"], operations)
+        return item
+
+    def patch(self, container, item_id, partition_key, operations, etag=None, filter_predicate=None):
+        kwargs = {}
+        if etag:
+            kwargs = {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+        if filter_predicate:
+            # 条件に一致しない場合は 412 になる
+            kwargs["filter_predicate"] = filter_predicate
+        return container.patch_item(item=item_id, partition_key=partition_key, patch_operations=operations, **kwargs)
 
     def get_chat(self, chat_id):
-        item = self.chat_data_container.read_item(
-            item=chat_id, partition_key=constants.DB_TYPE_CHAT)
+        item = self.chat_container().read_item(
+            item=chat_id, partition_key=self.chat_partition_key(chat_id, constants.DB_TYPE_CHAT))
         return item
 
-    def get_chat_list(self, user_name, chat_type):
-        QUERY = "SELECT * FROM c WHERE c.type=@type AND c.chat_type=@chat_type AND c.created_user=@user_name ORDER BY c.create_date DESC"
+    def get_chat_list(self, user_name, chat_type, page_size=None, continuation_token=None):
+        """
+        ユーザーのチャット一覧を新しい順に取得する。
+        page_size を指定した場合は {"items": [...], "continuation_token": ...} を返す。
+        user_id を指定しない場合は全ユーザーの履歴を返す（page_size を指定しない場合は全件）。
+        """
+        select = projection(CHAT_LIST_FIELDS)
+        if self.partitioned_chat:
+            # ユーザーのパーティション内のみを検索する
+            QUERY = f"SELECT {select} FROM c WHERE c.chat_type=@chat_type AND NOT IS_DEFINED(c.deleted) ORDER BY c.chat_type, c.create_date DESC"
+            params = [dict(name="@chat_type", value=chat_type)]
+            container = self.user_chats_container
+            partition_key = user_name
+        else:
+            QUERY = f"SELECT {select} FROM c WHERE c.chat_type=@chat_type AND c.created_user=@user_name AND NOT IS_DEFINED(c.deleted) ORDER BY c.create_date DESC"
+            params = [dict(name="@user_name", value=user_name),
+                      dict(name="@chat_type", value=chat_type)]
+            container = self.chat_data_container
+            partition_key = constants.DB_TYPE_CHAT
+        return self.query(container, QUERY, params, partition_key, page_size, continuation_token)
+
+    def get_chat_content(self, chat_id, page_size=None, continuation_token=None, detail=True):
+        """
+        チャットの会話内容を順番に取得する。
+        detail=False の場合は thoughts / data_points を取得しない。
+        page_size を指定した場合は {"items": [...], "continuation_token": ...} を返す。
+        user_id を指定しない場合は全ユーザーの履歴を返す（page_size を指定しない場合は全件）。
+        """
+        select = "*" if detail else projection(CHAT_CONTENT_FIELDS)
+        QUERY = f"SELECT {select} FROM c WHERE c.type=@type AND c.chat_id=@chat_id ORDER BY c.index"
+        params = [dict(name="@type", value=constants.DB_TYPE_CONTENT),
+                  dict(name="@chat_id", value=chat_id)]
+        partition_key = self.chat_partition_key(chat_id, constants.DB_TYPE_CONTENT)
+        return self.query(self.chat_container(), QUERY, params, partition_key, page_size, continuation_token)
+
+    # アーカイブ
+    def get_archive_candidates(self, idle_before, max_count):
+        """
+        最後の会話（last_activity、記録前のチャットは _ts）が idle_before より前で、アーカイブされていないチャットを返す。
+        """
+        QUERY = "SELECT TOP @max_count c.id FROM c WHERE c.type=@type " \
+            "AND (c.last_activity < @ts OR (NOT IS_DEFINED(c.last_activity) AND c._ts < @ts)) " \
+            "AND NOT IS_DEFINED(c.archived) AND NOT IS_DEFINED(c.deleted)"
         params = [dict(name="@type", value=constants.DB_TYPE_CHAT),
-                  dict(name="@user_name", value=user_name),
-                  dict(name="@chat_type", value=chat_type)]
-        results = self.chat_data_container.query_items(
-            query=QUERY, parameters=params, enable_cross_partition_query=True
-        )
-        items = [item for item in results]
-        return items
+                  dict(name="@ts", value=idle_before),
+                  dict(name="@max_count", value=max_count)]
+        if self.partitioned_chat:
+            results = self.chats_container.query_items(
+                query=QUERY, parameters=params, enable_cross_partition_query=True)
+        else:
+            results = self.chat_data_container.query_items(
+                query=QUERY, parameters=params, partition_key=constants.DB_TYPE_CHAT)
+        return [item["id"] for item in results]
 
-    def get_chat_content(self, chat_id):
-        QUERY = "SELECT * FROM c WHERE c.type=@type AND c.chat_id=@chat_id ORDER BY c.index"
+    def get_last_activity(self, chat_id):
+        # 会話内容の最後の更新時刻（_ts）、会話内容がない場合は None
+        QUERY = "SELECT VALUE MAX(c._ts) FROM c WHERE c.type=@type AND c.chat_id=@chat_id"
         params = [dict(name="@type", value=constants.DB_TYPE_CONTENT),
                   dict(name="@chat_id", value=chat_id)]
-        results = self.chat_data_container.query_items(
-            query=QUERY, parameters=params, enable_cross_partition_query=True
-        )
-        items = [item for item in results]
-        return items
+        results = list(self.chat_container().query_items(
+            query=QUERY, parameters=params,
+            partition_key=self.chat_partition_key(chat_id, constants.DB_TYPE_CONTENT)))
+        return results[0] if results else None
+
+    def archive_chat_content(self, chat_id, archived, items, idle_before):
+        """
+        チャットに archived（アーカイブ先の情報）を付けて、アーカイブした会話内容を削除する。
+        その間に会話が追加された（last_activity が idle_before 以降になった）場合は何もせず None を返す。
+        """
+        try:
+            self.patch(self.chat_container(), chat_id, self.chat_partition_key(chat_id, constants.DB_TYPE_CHAT),
+                       [{"op": "set", "path": "/archived", "value": archived}],
+                       filter_predicate=f"FROM c WHERE NOT IS_DEFINED(c.last_activity) OR c.last_activity < {int(idle_before)}")
+        except CosmosAccessConditionFailedError:
+            return None
+        return self.bulk_delete_chat(chat_id, [item["id"] for item in items])
+
+    def restore_chat_content(self, chat_id, items):
+        """
+        アーカイブから会話内容を戻す（アーカイブ後に追加された会話内容は残す）。
+        同時に戻した他の呼び出しが先に archived を外していた場合は False を返す。
+        """
+        container = self.chat_container()
+        for item in items:
+            container.upsert_item(item)
+        try:
+            self.patch(container, chat_id, self.chat_partition_key(chat_id, constants.DB_TYPE_CHAT),
+                       [{"op": "remove", "path": "/archived"}], filter_predicate="FROM c WHERE IS_DEFINED(c.archived)")
+        except CosmosAccessConditionFailedError:
+            return False
+        return True
+
+    def query(self, container, query, params, partition_key, page_size=None, continuation_token=None):
+        if page_size is None:
+            results = container.query_items(
+                query=query, parameters=params, partition_key=partition_key
+            )
+            return [item for item in results]
+        page_size = max(1, min(int(page_size), MAX_PAGE_SIZE))
+        pages = container.query_items(
+            query=query, parameters=params, partition_key=partition_key, max_item_count=page_size
+        ).by_page(continuation_token)
+        items = [item for item in next(pages, [])]
+        return {"items": items, "continuation_token": pages.continuation_token}
 
     # file-info
     def insert_file_info(self, file_data):
@@ -121,56 +426,197 @@ class CosmosdbService():
                              created_user=file_data["created_user"],
                              created_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
         self.common_data_container.create_item(file_info.json)
+        self.update_file_facets(file_info.folder_id, attributes.tag, 1)
 
-    def update_file_status(self, file_id, file_status):
-        item = self.common_data_container.read_item(
-            item=file_id, partition_key=constants.DB_TYPE_FILE_INFO)
-        item["file_status"] = file_status
-        self.common_data_container.replace_item(item=item, body=item)
+    @background
+    def update_file_status(self, file_id, file_status, etag=None):
+        return self.patch(self.common_data_container, file_id, constants.DB_TYPE_FILE_INFO,
+                          [{"op": "set", "path": "/file_status", "value": file_status}], etag)
 
     def delete_file_info(self, id):
+        item = self.common_data_container.read_item(
+            item=id, partition_key=constants.DB_TYPE_FILE_INFO)
         self.common_data_container.delete_item(
             item=id, partition_key=constants.DB_TYPE_FILE_INFO)
+        self.update_file_facets(item["folder_id"], item["attributes"]["tag"], -1)
 
-    def get_file_infos(self, file_name="", folder_id="", tag="", created_user=""):
+    def get_file_infos(self, file_name="", folder_id="", tag="", created_user="", page_size=None, continuation_token=None):
+        """
+        ファイル一覧を新しい順に取得する。
+        page_size を指定した場合は {"items": [...], "continuation_token": ...} を返す。
+        user_id を指定しない場合は全ユーザーの履歴を返す（page_size を指定しない場合は全件）。
+        """
+        filters = {"folder_id": (folder_id or "").strip(), "attributes.tag": tag,
+                   "created_user": created_user, "file_name": file_name}
         QUERY = "SELECT * FROM c WHERE c.type=@type "
         params = [dict(name="@type", value=constants.DB_TYPE_FILE_INFO)]
-        if len(file_name) != 0:
-            QUERY += "AND c.file_name=@file_name "
-            params.append(dict(name="@file_name", value=file_name))
-        if len(folder_id) != 0:
-            QUERY += "AND c.folder_id=@folder_id "
-            params.append(dict(name="@folder_id", value=folder_id.strip()))
-        if len(tag) != 0:
-            QUERY += "AND c.attributes.tag=@tag "
-            params.append(dict(name="@tag", value=tag))
-        if len(created_user) != 0:
-            QUERY += "AND c.created_user=@created_user "
-            params.append(dict(name="@created_user", value=created_user))
-        QUERY += " ORDER BY c.create_date DESC"
+        order_by = ["c.type"]
+        # 絞り込み項目を ORDER BY にも含めて複合インデックスを使う
+        for i, field in enumerate(FILE_FILTER_FIELDS):
+            if filters[field]:
+                QUERY += f"AND c.{field}=@p{i} "
+                params.append(dict(name=f"@p{i}", value=filters[field]))
+                order_by.append(f"c.{field}")
+        QUERY += f"ORDER BY {', '.join(order_by)}, c.created_date DESC"
+        return self.query(self.common_data_container, QUERY, params, constants.DB_TYPE_FILE_INFO, page_size, continuation_token)
 
-        results = self.common_data_container.query_items(
-            query=QUERY, parameters=params, enable_cross_partition_query=True
-        )
-        items = [item for item in results]
-        return items
+    def ensure_common_data_indexes(self):
+        # ファイル一覧の絞り込みの組み合わせごとに複合インデックスを作成する
+        composite_indexes = []
+        for n in range(len(FILE_FILTER_FIELDS) + 1):
+            for fields in itertools.combinations(FILE_FILTER_FIELDS, n):
+                composite_indexes.append(
+                    [{"path": "/type", "order": "ascending"}]
+                    + [{"path": "/" + field.replace(".", "/"), "order": "ascending"} for field in fields]
+                    + [{"path": "/created_date", "order": "descending"}])
+        properties = self.common_data_container.read()
+        current = [[(path["path"], path.get("order", "ascending")) for path in composite]
+                   for composite in properties["indexingPolicy"].get("compositeIndexes", [])]
+        expected = [[(path["path"], path["order"]) for path in composite]
+                    for composite in composite_indexes]
+        if sorted(current) == sorted(expected):
+            return
+        indexing_policy = {
+            "indexingMode": "consistent",
+            "includedPaths": [{"path": "/*"}],
+            "excludedPaths": [{"path": "/\"_etag\"/?"}],
+            "compositeIndexes": composite_indexes
+        }
+        self.common_data_container = self.database.replace_container(
+            self.common_data_container, partition_key=PartitionKey(path="/type"), indexing_policy=indexing_policy)
+
+    def get_file_facets(self):
+        """
+        フォルダ毎・タグ毎のファイル数を一回の読み取りで返す。
+        """
+        try:
+            item = self.common_data_container.read_item(
+                item=FILE_FACETS_ID, partition_key=constants.DB_TYPE_FILE_FACET)
+        except CosmosResourceNotFoundError:
+            item = self.rebuild_file_facets()
+        return {"folders": item["folders"], "tags": item["tags"]}
+
+    def rebuild_file_facets(self):
+        # 集計ドキュメントがない場合は一度だけ全件を集計する
+        facets = {"id": FILE_FACETS_ID, "type": constants.DB_TYPE_FILE_FACET,
+                  "folders": {}, "tags": {}}
+        for key, field in [("folders", "c.folder_id"), ("tags", "c.attributes.tag")]:
+            QUERY = f"SELECT {field} AS facet, COUNT(1) AS n FROM c GROUP BY {field}"
+            results = self.common_data_container.query_items(
+                query=QUERY, partition_key=constants.DB_TYPE_FILE_INFO)
+            facets[key] = {}
+            for item in results:
+                facet = item.get("facet") or FILE_FACET_NONE
+                facets[key][facet] = facets[key].get(facet, 0) + item["n"]
+        try:
+            return self.common_data_container.create_item(facets)
+        except CosmosResourceExistsError:
+            return self.common_data_container.read_item(
+                item=FILE_FACETS_ID, partition_key=constants.DB_TYPE_FILE_FACET)
+
+    def update_file_facets(self, folder_id, tag, value):
+        operations = [{"op": "incr", "path": f"/folders/{json_pointer(folder_id or FILE_FACET_NONE)}", "value": value},
+                      {"op": "incr", "path": f"/tags/{json_pointer(tag or FILE_FACET_NONE)}", "value": value}]
+        try:
+            self.common_data_container.patch_item(
+                item=FILE_FACETS_ID, partition_key=constants.DB_TYPE_FILE_FACET, patch_operations=operations)
+        except CosmosResourceNotFoundError:
+            # 集計ドキュメント作成時に、追加・削除済みのファイルも集計される
+            self.rebuild_file_facets()
 
     # login-history
+    @background
     def insert_user_login_info(self, login_info_json):
         login_info_json["id"] = str(uuid1())
         login_info_json["type"] = constants.DB_TYPE_LOGIN_HISTORY
         login_info_json["login_time"] = datetime.now().strftime(
             "%Y-%m-%d %H:%M:%S")
-        self.common_data_container.create_item(login_info_json)
+        self.login_history_container.create_item(login_info_json)
+        self.update_login_summary(login_info_json)
+
+    def update_login_summary(self, login_info_json):
+        login = {key: login_info_json.get(key)
+                 for key in ["id", "user_id", "user_name", "login_time"]}
+        self.merge_login_summary(login_info_json["user_id"], [login])
+
+    def merge_login_summary(self, user_id, logins):
+        # 直近のログインをまとめたドキュメントを更新する（同時更新は etag で再試行する）
+        for _ in range(5):
+            try:
+                summary = self.login_history_container.read_item(
+                    item=LOGIN_SUMMARY_ID, partition_key=user_id)
+            except CosmosResourceNotFoundError:
+                summary = {"id": LOGIN_SUMMARY_ID, "type": constants.DB_TYPE_LOGIN_SUMMARY,
+                           "user_id": user_id, "ttl": -1, "logins": self.latest_logins(logins)}
+                try:
+                    self.login_history_container.create_item(summary)
+                    return
+                except CosmosResourceExistsError:
+                    continue
+            summary["logins"] = self.latest_logins(logins + summary["logins"])
+            try:
+                self.login_history_container.replace_item(
+                    item=summary, body=summary, etag=summary["_etag"], match_condition=MatchConditions.IfNotModified)
+                return
+            except CosmosAccessConditionFailedError:
+                continue
+        logging.warning(f"Failed to update the login summary of {user_id}")
+
+    @staticmethod
+    def latest_logins(logins):
+        # 新しい順に重複を除いて LOGIN_HISTORY_LATEST_COUNT 件まで
+        unique = {login["id"]: login for login in logins}
+        return sorted(unique.values(), key=lambda login: login["login_time"] or "", reverse=True)[:LOGIN_HISTORY_LATEST_COUNT]
 
-    def get_user_login_info(self, user_id):
-        QUERY = "SELECT * FROM c where c.type=@type ORDER BY c.login_time DESC"
+    def get_user_login_info(self, user_id, page_size=None, continuation_token=None):
+        """
+        ログイン履歴を新しい順に取得する。
+        user_id のみ指定した場合は直近のログインを一回の読み取りで返す。
+        page_size を指定した場合は {"items": [...], "continuation_token": ...} を返す。
+        user_id を指定しない場合は全ユーザーの履歴を返す（page_size を指定しない場合は全件）。
+        """
+        if user_id and page_size is None:
+            try:
+                summary = self.login_history_container.read_item(
+                    item=LOGIN_SUMMARY_ID, partition_key=user_id)
+                return summary["logins"]
+            except CosmosResourceNotFoundError:
+                return []
+        QUERY = "SELECT c.id, c.user_id, c.user_name, c.login_time FROM c WHERE c.type=@type ORDER BY c.type, c.login_time DESC"
         params = [dict(name="@type", value=constants.DB_TYPE_LOGIN_HISTORY)]
-        results = self.common_data_container.query_items(
-            query=QUERY, parameters=params, enable_cross_partition_query=True
-        )
-        items = [item for item in results]
-        return items
+        if user_id:
+            return self.query(self.login_history_container, QUERY, params, user_id, page_size, continuation_token)
+        if page_size is None:
+            # 全ユーザーの全履歴（保持期間内のみ）
+            return [item for item in self.login_history_container.query_items(
+                query=QUERY, parameters=params, enable_cross_partition_query=True)]
+        return self.query_all_login_history(int(page_size), continuation_token)
+
+    def query_all_login_history(self, page_size, continuation_token=None):
+        """
+        Returns a page of the login history of all users, newest first.
+        The SDK does not resume cross-partition ORDER BY queries from a continuation token,
+        so the token holds the login_time of the last item and the ids already returned at that time.
+        """
+        page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        QUERY = "SELECT TOP @top c.id, c.user_id, c.user_name, c.login_time FROM c WHERE c.type=@type"
+        params = [dict(name="@top", value=page_size),
+                  dict(name="@type", value=constants.DB_TYPE_LOGIN_HISTORY)]
+        if continuation_token:
+            position = json.loads(continuation_token)
+            QUERY += " AND (c.login_time < @login_time OR (c.login_time = @login_time AND NOT ARRAY_CONTAINS(@ids, c.id)))"
+            params += [dict(name="@login_time", value=position["login_time"]),
+                       dict(name="@ids", value=position["ids"])]
+        QUERY += " ORDER BY c.type, c.login_time DESC"
+        items = [item for item in self.login_history_container.query_items(
+            query=QUERY, parameters=params, enable_cross_partition_query=True)]
+        if len(items) < page_size:
+            return {"items": items, "continuation_token": None}
+        last_time = items[-1]["login_time"]
+        ids = [item["id"] for item in items if item["login_time"] == last_time]
+        if continuation_token and position["login_time"] == last_time:
+            ids += position["ids"]
+        return {"items": items, "continuation_token": json.dumps({"login_time": last_time, "ids": ids})}
 
     # folder-info
     def insert_folder(self, folder_name, user_name):
@@ -183,13 +629,16 @@ class CosmosdbService():
             "created_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         self.common_data_container.create_item(folder_info)
+        self.cache.invalidate(CACHE_KEY_FOLDERS)
         return {"key": folder_id, "value": folder_name}
 
     def get_folders(self):
-        QUERY = "SELECT * FROM c where c.type=@type ORDER BY c.created_date DESC"
-        params = [dict(name="@type", value=constants.DB_TYPE_FOLDER_INFO)]
+        return self.cache.get(CACHE_KEY_FOLDERS, self.query_folders)
+
+    def query_folders(self):
+        QUERY = "SELECT c.id, c.folder_name FROM c ORDER BY c.created_date DESC"
         results = self.common_data_container.query_items(
-            query=QUERY, parameters=params, enable_cross_partition_query=True
+            query=QUERY, partition_key=constants.DB_TYPE_FOLDER_INFO
         )
         items = [{"key": item["id"], "value":item["folder_name"]}
                  for item in results]
@@ -197,6 +646,9 @@ class CosmosdbService():
 
     # user-info
     def get_user_info(self, user_id=""):
+        return self.cache.get(f"{CACHE_KEY_USER_INFO}:{user_id}", lambda: self.query_user_info(user_id))
+
+    def query_user_info(self, user_id):
         if user_id == "":
             QUERY = "SELECT * FROM c where c.type=@type ORDER BY c.created_date DESC"
             params = [dict(name="@type", value=constants.DB_TYPE_USER_INFO)]
@@ -205,11 +657,14 @@ class CosmosdbService():
             params = [dict(name="@type", value=constants.DB_TYPE_USER_INFO),
                       dict(name="@user_id", value=user_id)]
         results = self.common_data_container.query_items(
-            query=QUERY, parameters=params, enable_cross_partition_query=True
+            query=QUERY, parameters=params, partition_key=constants.DB_TYPE_USER_INFO
         )
         items = [item for item in results]
         return items
 
+    def invalidate_user_info(self, user_id):
+        self.cache.invalidate(f"{CACHE_KEY_USER_INFO}:", f"{CACHE_KEY_USER_INFO}:{user_id}")
+
     def create_user_info(self, data):
         user_info_id = str(uuid1())
         user_info = {
@@ -225,16 +680,29 @@ class CosmosdbService():
             "created_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         self.common_data_container.create_item(user_info)
+        self.invalidate_user_info(data["user_id"])
         return user_info_id
 
     def delete_user_info(self, user_info_id):
+        item = self.common_data_container.read_item(
+            item=user_info_id, partition_key=constants.DB_TYPE_USER_INFO)
         self.common_data_container.delete_item(
             item=user_info_id, partition_key=constants.DB_TYPE_USER_INFO)
+        self.invalidate_user_info(item["user_id"])
 
-    def update_user_info(self, data):
-        item = self.common_data_container.read_item(
-            item=data["id"], partition_key=constants.DB_TYPE_USER_INFO)
-        item["authentication"] = {"admin": data["admin"],
-                                  "openai_model": data["openai_model"],
-                                  "file_upload": data["file_upload"]}
-        self.common_data_container.replace_item(item=item, body=item)
+    def update_user_info(self, data, etag=None):
+        authentication = {"admin": data["admin"],
+                          "openai_model": data["openai_model"],
+                          "file_upload": data["file_upload"]}
+        item = self.patch(self.common_data_container, data["id"], constants.DB_TYPE_USER_INFO,
+                          [{"op": "set", "path": "/authentication", "value": authentication}], etag)
+        self.invalidate_user_info(item["user_id"])
+        return item
+
+
+def projection(fields):
+    return ", ".join(f"c.{field}" for field in fields)
+
+
+def json_pointer(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
@@ -1,6 +1,8 @@
 import os
 import openai
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+
+from core import endpointrouter, ratelimiter
+from core.tokenusage import record_tokens
 
 AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT")
 AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
@@ -18,11 +20,12 @@ class OpenaiService():
         openai.api_type = "azure"
         openai.api_key = AZURE_OPENAI_KEY
 
-    def before_retry_sleep(self):
-        print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
-
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(15), before_sleep=before_retry_sleep)
     def compute_embedding(self, text):
         # refresh_openai_token()
-        res =openai.Embedding.create(engine=self.embedding_deployment, input=text)
+        # ファイルのエンベディングはチャットの後に実行し、429 の場合は retry-after まで待つ
+        res = endpointrouter.call_sync(
+            self.embedding_deployment, ratelimiter.estimate_tokens(text=text, max_tokens=0),
+            lambda endpoint: openai.Embedding.create(engine=endpoint.deployment, input=text, **endpoint.params()),
+            ratelimiter.BACKGROUND)
+        record_tokens(self.embedding_deployment, res.get("usage"))
         return res["data"][0]["embedding"]
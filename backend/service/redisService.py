@@ -1,18 +1,23 @@
 import os
+import time
+import hashlib
 import logging
 import uuid
+import numpy as np
 from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple
 
-from langchain.vectorstores.redis import Redis
+from langchain.vectorstores.redis import Redis, RedisText, RedisTag
 from langchain.docstore.document import Document
 from langchain.embeddings.base import Embeddings
 from langchain.vectorstores.base import VectorStore
 from langchain.embeddings.openai import OpenAIEmbeddings
 
 import pandas as pd
+import redis.asyncio as aioredis
 from redis.commands.search.query import Query
 from redis.commands.search.indexDefinition import IndexDefinition, IndexType
 from redis.commands.search.field import VectorField, TagField, TextField
+from redis.exceptions import ResponseError
 
 logger = logging.getLogger()
 REDIS_URL = os.getenv("REDIS_URL")
@@ -20,6 +25,82 @@ REDIS_KEY = os.getenv("REDIS_KEY")
 REDIS_INDEX_NAME = os.getenv("REDIS_INDEX_NAME")
 AZURE_REDIS_URL = "rediss://:" + REDIS_KEY + "@" + REDIS_URL
 AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT")
+# ベクトルの保存形式 FLOAT32 / FLOAT16（FLOAT16 はメモリ半分）
+# インデックス作成時のみ反映されるため、変更する場合は REDIS_INDEX_NAME も変更すること
+REDIS_VECTOR_TYPE = os.getenv("REDIS_VECTOR_TYPE", "FLOAT32").upper()
+VECTOR_DTYPES = {"FLOAT32": np.float32, "FLOAT16": np.float16}
+VECTOR_DIM = 1536
+
+# 複数チャットで共有するチャンク（URL・ファイル）のキー
+SOURCE_META_PREFIX = "source"
+SOURCE_CHATS_PREFIX = "source_chats"
+# マニフェストにソースを記録しているチャット。チャンクの削除後も元ファイルの Blob を残すかの判断に使う
+SOURCE_OWNERS_PREFIX = "source_owners"
+# 復元用の元ファイルの Blob（AZURE_STORAGE_PRIVATE_CONTAINER）
+SOURCE_BLOB_PREFIX = "retrievechat"
+CHAT_SOURCES_PREFIX = "chat_sources"
+URL_CACHE_PREFIX = "url_cache"
+CHAT_MANIFEST_PREFIX = "chat_manifest"
+CHAT_LRU_KEY = "chat_lru"
+RETRIEVE_STATS_KEY = "retrieve_stats"
+SWEEPER_LOCK_KEY = "chat_sweeper_lock"
+CHAT_PURGE_LOCK_KEY = "chat_purge_lock"
+# 有効期限を延長したソース。チャンクの有効期限はスイープでまとめて延長する
+SOURCE_TOUCHED_KEY = "source_touched"
+
+# チャンクの有効期限（秒）。チャットを参照する度に延長する。0 の場合は期限なし
+RETRIEVE_CHAT_TTL = int(os.getenv("RETRIEVE_CHAT_TTL", str(7 * 24 * 3600)))
+# 使用メモリが maxmemory のこの割合を超えると、最近使われていないチャットから削除する
+REDIS_MEMORY_WATERMARK = float(os.getenv("REDIS_MEMORY_WATERMARK", "0.8"))
+# maxmemory が取得できない場合（Azure Cache for Redis 等）の上限（バイト）
+REDIS_MAX_MEMORY = int(os.getenv("REDIS_MAX_MEMORY", "0"))
+REDIS_SWEEP_INTERVAL = int(os.getenv("REDIS_SWEEP_INTERVAL", "60"))
+# チャンクはメタ情報より後に期限切れにする（スイープで延長するまでの間に先に消えないように）
+CHUNK_TTL_MARGIN = 2 * REDIS_SWEEP_INTERVAL
+# 削除途中のチャットの再削除（起動時）を行う間隔（秒）。この間に起動したワーカーは再削除しない
+CHAT_PURGE_INTERVAL = int(os.getenv("CHAT_PURGE_INTERVAL", "3600"))
+
+# ソースのキーはハッシュタグ {source_hash} で同じスロットに置き、Redis Cluster でもスクリプトで扱えるようにする
+# スクリプトで扱うキーは全て KEYS で渡す（KEYS[1]: メタ情報、KEYS[2]: 参照しているチャット、KEYS[3..]: チャンク）
+# ソースを参照しているチャットを追加する。ソースが存在しない場合は -1、それ以外は参照数を返す
+LINK_SOURCE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+redis.call('SADD', KEYS[2], ARGV[1])
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl > 0 then redis.call('PEXPIRE', KEYS[2], ttl) end
+return redis.call('SCARD', KEYS[2])
+"""
+# 参照しているチャットを外し、参照がなくなったソースのチャンクを削除する
+UNLINK_SOURCE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+redis.call('SREM', KEYS[2], ARGV[1])
+local refs = redis.call('SCARD', KEYS[2])
+if refs == 0 then
+  -- unpack は引数の数に上限があるため、チャンクは分けて削除する
+  for i = 1, #KEYS, 1000 do
+    redis.call('DEL', unpack(KEYS, i, math.min(i + 999, #KEYS)))
+  end
+end
+return refs
+"""
+# 元ファイルを参照しているチャット（マニフェスト）を外し、残りの数を返す
+# 記録がない（記録を始める前のチャットが参照している）場合は -1
+RELEASE_SOURCE_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+redis.call('SREM', KEYS[1], ARGV[1])
+local owners = redis.call('SCARD', KEYS[1])
+if owners == 0 then redis.call('DEL', KEYS[1]) end
+return owners
+"""
+# 有効期限が半分を過ぎたソースのメタ情報と参照しているチャットの有効期限を延長する
+# 延長した場合は 1 を返す（チャンクはスイープで延長する）
+TOUCH_SOURCE_SCRIPT = """
+local ttl = redis.call('TTL', KEYS[1])
+if ttl == -2 or ttl > tonumber(ARGV[1]) / 2 then return 0 end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+return 1
+"""
 
 
 class RedisService(Redis):
@@ -32,6 +113,48 @@ class RedisService(Redis):
         except:
             # Create Redis Index
             self.create_index()
+        self.ensure_source_hash_field()
+        self.vector_type = self.check_vector_type()
+        self.async_client = None
+        self.link_source_script = self.client.register_script(
+            LINK_SOURCE_SCRIPT)
+        self.unlink_source_script = self.client.register_script(
+            UNLINK_SOURCE_SCRIPT)
+        self.touch_source_script = self.client.register_script(
+            TOUCH_SOURCE_SCRIPT)
+        self.release_source_script = self.client.register_script(
+            RELEASE_SOURCE_SCRIPT)
+
+    def check_vector_type(self) -> str:
+        """
+        Returns the vector type of the existing index, which is used to encode the chunks and the queries
+        even if REDIS_VECTOR_TYPE was changed afterwards (only a new index applies REDIS_VECTOR_TYPE).
+        """
+        for attribute in self.client.ft(self.index_name).info().get("attributes", []):
+            values = [v.decode("utf-8") if isinstance(v, bytes) else v for v in attribute]
+            fields = dict(zip(values[::2], values[1::2]))
+            if fields.get("identifier") != "content_vector":
+                continue
+            # data_type を返さない RediSearch では、保存済みのベクトルのバイト数から判断する
+            vector_type = str(fields.get("data_type") or self.stored_vector_type() or REDIS_VECTOR_TYPE).upper()
+            if vector_type not in VECTOR_DTYPES:
+                raise RuntimeError(
+                    f"Unsupported vector type {vector_type} of the index {self.index_name}")
+            if vector_type != REDIS_VECTOR_TYPE:
+                logging.warning(f"The index {self.index_name} stores {vector_type} vectors, REDIS_VECTOR_TYPE={REDIS_VECTOR_TYPE} is ignored. "
+                                "Change REDIS_INDEX_NAME to create an index of the new type")
+            return vector_type
+        raise RuntimeError(f"The index {self.index_name} has no content_vector field")
+
+    def stored_vector_type(self) -> Optional[str]:
+        result = self.client.ft(self.index_name).search(Query("*").no_content().paging(0, 1))
+        if not result.docs:
+            return None
+        size = self.client.hstrlen(result.docs[0].id, "content_vector")
+        for vector_type, dtype in VECTOR_DTYPES.items():
+            if size == VECTOR_DIM * np.dtype(dtype).itemsize:
+                return vector_type
+        raise RuntimeError(f"Unexpected vector size {size} bytes in the index {self.index_name}")
 
     def check_existing_index(self, index_name: str = None):
         try:
@@ -49,7 +172,11 @@ class RedisService(Redis):
         keys = self.client.keys(pattern)
         self.delete_keys(keys)
 
-    def delete_by_chatid(self, chatid: str):
+    def delete_by_chatid(self, chatid: str) -> List[str]:
+        """
+        Deletes the chunks of the chat and unlinks its sources.
+        Returns the sources no other chat records in its manifest, whose original blobs can be deleted.
+        """
         page_size = 50  # 一度に取得するドキュメント数
 
         while True:
@@ -69,22 +196,269 @@ class RedisService(Redis):
                 self.client.delete(item['id'])
                 print(item['id'] + " is deleted in redis.")
 
+        self.unlink_chat_sources(chatid)
+        released = []
+        for source_hash in set(self.get_manifest(chatid).values()):
+            owners = self.release_source_script(
+                keys=[self.source_owners_key(source_hash)], args=[chatid.replace("-", "")])
+            if owners == 0:
+                released.append(source_hash)
+        self.client.delete(self.chat_manifest_key(chatid))
+        self.client.zrem(CHAT_LRU_KEY, chatid.replace("-", ""))
+        return released
+
+    def unlink_chat_sources(self, chatid: str):
+        # 共有チャンクはチャットとのリンクのみ削除し、参照がなくなったものを削除する
+        for source_hash in self.get_chat_sources(chatid):
+            refs = self.unlink_source_script(
+                keys=self.source_keys(source_hash), args=[chatid.replace("-", "")])
+            if refs <= 0:
+                print(source_hash + " is deleted in redis.")
+        self.client.delete(self.chat_sources_key(chatid))
+
+    def ensure_source_hash_field(self):
+        # 既存インデックスに source_hash フィールドを追加する
+        try:
+            self.client.ft(self.index_name).alter_schema_add(
+                [TagField(name="source_hash")])
+        except ResponseError as e:
+            if "Duplicate" not in str(e):
+                raise e
+
+    def source_prefix(self, source_hash: str) -> str:
+        return f"doc:{self.index_name}:src:{{{source_hash}}}"
+
+    def source_meta_key(self, source_hash: str) -> str:
+        return f"{SOURCE_META_PREFIX}:{{{source_hash}}}"
+
+    def source_chats_key(self, source_hash: str) -> str:
+        return f"{SOURCE_CHATS_PREFIX}:{{{source_hash}}}"
+
+    def source_owners_key(self, source_hash: str) -> str:
+        return f"{SOURCE_OWNERS_PREFIX}:{{{source_hash}}}"
+
+    def source_blob_name(self, source_hash: str) -> str:
+        return f"{SOURCE_BLOB_PREFIX}/{source_hash}"
+
+    def source_keys(self, source_hash: str) -> List[str]:
+        # メタ情報、参照しているチャット、チャンクの順（チャンク数は保存後に変わらない）
+        chunks = int(self.client.hget(self.source_meta_key(source_hash), "chunks") or 0)
+        prefix = self.source_prefix(source_hash)
+        return [self.source_meta_key(source_hash), self.source_chats_key(source_hash)] + \
+            [f"{prefix}:{i}" for i in range(chunks)]
+
+    def chat_sources_key(self, chatid: str) -> str:
+        return f"{CHAT_SOURCES_PREFIX}:{chatid.replace('-', '')}"
+
+    def chat_manifest_key(self, chatid: str) -> str:
+        return f"{CHAT_MANIFEST_PREFIX}:{chatid.replace('-', '')}"
+
+    def has_source(self, source_hash: str) -> bool:
+        return self.client.exists(self.source_meta_key(source_hash)) > 0
+
+    def store_source(self, source_hash: str, resource: str, texts: List[str], embeddings: List[List[float]]):
+        """
+        Stores chunks shared by chats under the content hash of the source
+        """
+        prefix = self.source_prefix(source_hash)
+        pipeline = self.client.pipeline(transaction=False)
+        for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+            pipeline.hset(f"{prefix}:{i}", mapping={
+                "content": text,
+                "content_vector": self.vector_to_bytes(embedding),
+                "chat_id": "",
+                "source": resource,
+                "resource": resource,
+                "source_hash": source_hash,
+            })
+        pipeline.hset(self.source_meta_key(source_hash), mapping={
+            "resource": resource,
+            "chunks": len(texts),
+        })
+        if RETRIEVE_CHAT_TTL > 0:
+            for i in range(len(texts)):
+                pipeline.expire(f"{prefix}:{i}", RETRIEVE_CHAT_TTL + CHUNK_TTL_MARGIN)
+            pipeline.expire(
+                self.source_meta_key(source_hash), RETRIEVE_CHAT_TTL)
+        pipeline.execute()
+
+    def link_source(self, chatid: str, source_hash: str) -> bool:
+        """
+        Links the source to the chat and counts the reference.
+        Returns False if the source was garbage collected in the meantime.
+        """
+        # チャット側を先に追加する（リンクできなかった場合に外す。残っても削除時に無視される）
+        self.client.sadd(self.chat_sources_key(chatid), source_hash)
+        refs = self.link_source_script(
+            keys=[self.source_meta_key(source_hash), self.source_chats_key(source_hash)],
+            args=[chatid.replace("-", "")])
+        if refs < 0:
+            self.client.srem(self.chat_sources_key(chatid), source_hash)
+            return False
+        return True
+
+    def get_chat_sources(self, chatid: str) -> List[str]:
+        return [s.decode() for s in self.client.smembers(self.chat_sources_key(chatid))]
+
+    def set_manifest(self, chatid: str, resource_key: str, source_hash: str):
+        """
+        Records the original resource ("file:<sha256>" or "url:<url>") of the chat,
+        so that evicted or expired chunks can be re-created.
+        """
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.hset(self.chat_manifest_key(chatid),
+                      resource_key, source_hash)
+        pipeline.sadd(self.source_owners_key(source_hash), chatid.replace("-", ""))
+        pipeline.execute()
+
+    def get_manifest(self, chatid: str) -> Dict[str, str]:
+        return {k.decode(): v.decode() for k, v in self.client.hgetall(self.chat_manifest_key(chatid)).items()}
+
+    def touch_chat(self, chatid: str):
+        """
+        Marks the chat as used and extends the expiry of its sources.
+        Only the per-source keys are touched here; the chunks are extended by the sweep.
+        """
+        self.client.zadd(CHAT_LRU_KEY, {chatid.replace("-", ""): time.time()})
+        if RETRIEVE_CHAT_TTL <= 0:
+            return
+        touched = {}
+        for source_hash in self.get_chat_sources(chatid):
+            if self.touch_source_script(
+                    keys=[self.source_meta_key(source_hash), self.source_chats_key(source_hash)],
+                    args=[RETRIEVE_CHAT_TTL]):
+                touched[source_hash] = time.time()
+        if touched:
+            self.client.zadd(SOURCE_TOUCHED_KEY, touched)
+
+    def refresh_chunks(self, max_sources: int = 1000) -> int:
+        """
+        Extends the expiry of the chunks of the sources touched since the last sweep
+        """
+        touched = [s.decode() for s in self.client.zrange(SOURCE_TOUCHED_KEY, 0, max_sources - 1)]
+        for source_hash in touched:
+            # メタ情報が期限切れの場合はチャンク数が 0 になり、何もしない
+            pipeline = self.client.pipeline(transaction=False)
+            for key in self.source_keys(source_hash)[2:]:
+                pipeline.expire(key, RETRIEVE_CHAT_TTL + CHUNK_TTL_MARGIN)
+            pipeline.execute()
+        if touched:
+            self.client.zrem(SOURCE_TOUCHED_KEY, *touched)
+        return len(touched)
+
+    def evict_chat(self, chatid: str):
+        # マニフェストは残し、再度開かれた時に復元する
+        self.unlink_chat_sources(chatid)
+        self.client.zrem(CHAT_LRU_KEY, chatid)
+        self.client.hincrby(RETRIEVE_STATS_KEY, "evictions", 1)
+        print(chatid + " is evicted in redis.")
+
+    def sweep(self, max_evictions: int = 100) -> int:
+        """
+        Extends the expiry of the touched chunks and evicts the least recently used chats
+        while the memory is above the watermark. Only one worker sweeps at a time.
+        """
+        if not self.client.set(SWEEPER_LOCK_KEY, os.getpid(), nx=True, ex=REDIS_SWEEP_INTERVAL):
+            return 0
+        if RETRIEVE_CHAT_TTL > 0:
+            self.refresh_chunks()
+        max_memory = REDIS_MAX_MEMORY or int(
+            self.client.info("memory").get("maxmemory", 0))
+        if max_memory <= 0:
+            return 0
+        evicted = 0
+        while evicted < max_evictions and int(self.client.info("memory")["used_memory"]) > max_memory * REDIS_MEMORY_WATERMARK:
+            oldest = self.client.zrange(CHAT_LRU_KEY, 0, 0)
+            if not oldest:
+                break
+            self.evict_chat(oldest[0].decode())
+            evicted += 1
+        return evicted
+
+    def acquire_purge_lock(self) -> bool:
+        """
+        Returns True for only one worker per CHAT_PURGE_INTERVAL, which purges the deleted chats
+        """
+        return bool(self.client.set(CHAT_PURGE_LOCK_KEY, os.getpid(), nx=True, ex=CHAT_PURGE_INTERVAL))
+
+    def chat_memory(self, chatid: str) -> int:
+        # 共有チャンクは参照している全てのチャットに計上する
+        pipeline = self.client.pipeline(transaction=False)
+        for source_hash in self.get_chat_sources(chatid):
+            chunks = int(self.client.hget(
+                self.source_meta_key(source_hash), "chunks") or 0)
+            for i in range(chunks):
+                pipeline.memory_usage(f"{self.source_prefix(source_hash)}:{i}")
+        return sum([usage or 0 for usage in pipeline.execute()])
+
+    def count_rehydration(self):
+        self.client.hincrby(RETRIEVE_STATS_KEY, "rehydrations", 1)
+
+    def get_stats(self) -> Dict[str, int]:
+        stats = {k.decode(): int(v)
+                 for k, v in self.client.hgetall(RETRIEVE_STATS_KEY).items()}
+        return {"evictions": stats.get("evictions", 0),
+                "rehydrations": stats.get("rehydrations", 0),
+                "active_chats": self.client.zcard(CHAT_LRU_KEY)}
+
+    def get_url_cache(self, url: str) -> Optional[Dict[str, str]]:
+        item = self.client.hgetall(f"{URL_CACHE_PREFIX}:{self.url_hash(url)}")
+        if not item:
+            return None
+        return {k.decode(): v.decode() for k, v in item.items()}
+
+    def set_url_cache(self, url: str, source_hash: str, etag: str = "", last_modified: str = ""):
+        self.client.hset(f"{URL_CACHE_PREFIX}:{self.url_hash(url)}", mapping={
+            "url": url,
+            "source_hash": source_hash,
+            "etag": etag,
+            "last_modified": last_modified,
+        })
+
+    async def knn_search(self, vector: List[float], chatid: str, source_hashes: List[str], k: int) -> List[Dict[str, Any]]:
+        """
+        Searches the chunks of the chat and of its linked sources without blocking the event loop
+        """
+        if self.async_client is None:
+            self.async_client = aioredis.from_url(AZURE_REDIS_URL)
+        chat_filter = RedisText("chat_id") == chatid.replace("-", "")
+        if len(source_hashes) > 0:
+            chat_filter = chat_filter | (
+                RedisTag("source_hash") == source_hashes)
+        query = Query(f"({chat_filter})=>[KNN {k} @content_vector $vector AS distance]") \
+            .return_fields("content", "resource", "distance") \
+            .sort_by("distance") \
+            .paging(0, k) \
+            .dialect(2)
+        result = await self.async_client.ft(self.index_name).search(
+            query, {"vector": self.vector_to_bytes(vector)})
+        return [{"id": doc.id, "content": doc.content, "resource": getattr(doc, "resource", ""), "distance": float(doc.distance)}
+                for doc in result.docs]
+
+    def vector_to_bytes(self, vector: List[float]) -> bytes:
+        return np.array(vector, dtype=VECTOR_DTYPES[self.vector_type]).tobytes()
+
+    def url_hash(self, url: str) -> str:
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
 
-    def create_index(self, prefix="doc", distance_metric: str = "COSINE"):
+    def create_index(self, prefix=None, distance_metric: str = "COSINE"):
+        # インデックス毎にキーを分け、保存形式の異なるインデックスを並存できるようにする
+        prefix = prefix or f"doc:{self.index_name}:"
         content = TextField(name="content")
         chat_id = TextField(name="chat_id")
         source = TextField(name="source")
         resource = TextField(name="resource")
+        source_hash = TagField(name="source_hash")
         content_vector = VectorField("content_vector",
                                      "HNSW", {
-                                         "TYPE": "FLOAT32",
-                                         "DIM": 1536,
+                                         "TYPE": REDIS_VECTOR_TYPE,
+                                         "DIM": VECTOR_DIM,
                                          "DISTANCE_METRIC": distance_metric,
                                          "INITIAL_CAP": 2000,
                                      })
         # Create index
         self.client.ft(self.index_name).create_index(
-            fields=[content, chat_id, source, resource, content_vector],
+            fields=[content, chat_id, source, resource, source_hash, content_vector],
             definition=IndexDefinition(
                 prefix=[prefix], index_type=IndexType.HASH)
         )
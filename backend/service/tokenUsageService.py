@@ -0,0 +1,152 @@
+import os
+import json
+import logging
+from datetime import datetime, timedelta
+
+from constants.constants import OPENAI_MODEL
+from core.tokenusage import UsageCollector
+from service.cosmosdbService import CosmosdbService
+
+AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT")
+AZURE_OPENAI_CHATGPT_MODEL = os.getenv("AZURE_OPENAI_CHATGPT_MODEL")
+AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT")
+AZURE_OPENAI_EMB_MODEL = os.getenv("AZURE_OPENAI_EMB_MODEL", "text-embedding-ada-002")
+
+# 日毎・ユーザー毎・チャット毎のトークン数（Redis のハッシュ、フィールドは {model}:{counter}）
+TOKEN_USAGE_DAY_PREFIX = "token_usage:day"
+TOKEN_USAGE_USER_PREFIX = "token_usage:user"
+TOKEN_USAGE_CHAT_PREFIX = "token_usage:chat"
+# 日毎のユーザーの合計トークン数（ソート済みセット）
+TOKEN_USAGE_USERS_PREFIX = "token_usage:users"
+TOKEN_USAGE_COUNTERS = ["prompt_tokens", "completion_tokens", "requests"]
+# 集計の保存日数
+TOKEN_USAGE_RETENTION_DAYS = int(os.getenv("TOKEN_USAGE_RETENTION_DAYS", "90"))
+# 上位ユーザーの最大件数
+TOKEN_USAGE_MAX_TOP = 100
+# 1000 トークン当たりの料金（USD）。TOKEN_USAGE_PRICES に JSON で指定すると上書きする
+MODEL_PRICES = {
+    "gpt-35-turbo": {"prompt": 0.0015, "completion": 0.002},
+    "gpt-35-turbo-16k": {"prompt": 0.003, "completion": 0.004},
+    "gpt-4": {"prompt": 0.03, "completion": 0.06},
+    "gpt-4-32k": {"prompt": 0.06, "completion": 0.12},
+    "text-embedding-ada-002": {"prompt": 0.0001, "completion": 0.0},
+}
+MODEL_PRICES.update(json.loads(os.getenv("TOKEN_USAGE_PRICES", "{}")))
+CHAT_OWNER_CACHE_KEY = "chat_owner"
+UNKNOWN_USER = "unknown"
+
+
+class TokenUsageService():
+
+    def __init__(self, cosmosdbService: CosmosdbService, redis_client):
+        self.cosmosdbService = cosmosdbService
+        self.client = redis_client
+        # デプロイ名からモデル名（OPENAI_MODEL のキー）
+        self.models = {info["deployment"]: name for name, info in OPENAI_MODEL.items() if info["deployment"]}
+        if AZURE_OPENAI_CHATGPT_DEPLOYMENT:
+            self.models.setdefault(AZURE_OPENAI_CHATGPT_DEPLOYMENT,
+                                   AZURE_OPENAI_CHATGPT_MODEL or AZURE_OPENAI_CHATGPT_DEPLOYMENT)
+        if AZURE_OPENAI_EMB_DEPLOYMENT:
+            self.models.setdefault(AZURE_OPENAI_EMB_DEPLOYMENT, AZURE_OPENAI_EMB_MODEL)
+
+    def model_name(self, deployment):
+        return self.models.get(deployment, deployment)
+
+    def chat_owner(self, chat_id):
+        # チャットの作成者は変わらないため、キャッシュから取得する（取得できなかった場合はキャッシュしない）
+        try:
+            return self.cosmosdbService.cache.get(f"{CHAT_OWNER_CACHE_KEY}:{chat_id}",
+                                                  lambda: self.cosmosdbService.get_chat(chat_id)["created_user"])
+        except Exception as e:
+            logging.warning(f"Failed to get the owner of chat {chat_id}: {e}")
+            return UNKNOWN_USER
+
+    def record(self, collector: UsageCollector):
+        """
+        Adds the usage of a request to the day, user and chat counters in one round trip.
+        """
+        if not collector.usage:
+            return
+        try:
+            self.increment(collector)
+        except Exception:
+            # 集計に失敗しても応答には影響させない
+            logging.exception("Failed to record token usage")
+
+    def increment(self, collector: UsageCollector):
+        user = collector.user or (self.chat_owner(collector.chat_id) if collector.chat_id else UNKNOWN_USER)
+        day = datetime.now().strftime("%Y-%m-%d")
+        ttl = TOKEN_USAGE_RETENTION_DAYS * 24 * 60 * 60
+        keys = [f"{TOKEN_USAGE_DAY_PREFIX}:{day}", f"{TOKEN_USAGE_USER_PREFIX}:{user}:{day}"]
+        if collector.chat_id:
+            keys.append(f"{TOKEN_USAGE_CHAT_PREFIX}:{collector.chat_id}")
+        pipeline = self.client.pipeline(transaction=False)
+        total_tokens = 0
+        for deployment, counters in collector.usage.items():
+            model = self.model_name(deployment)
+            total_tokens += counters[0] + counters[1]
+            for key in keys:
+                for name, value in zip(TOKEN_USAGE_COUNTERS, counters):
+                    if value:
+                        pipeline.hincrby(key, f"{model}:{name}", value)
+        pipeline.zincrby(f"{TOKEN_USAGE_USERS_PREFIX}:{day}", total_tokens, user)
+        for key in keys + [f"{TOKEN_USAGE_USERS_PREFIX}:{day}"]:
+            pipeline.expire(key, ttl)
+        pipeline.execute()
+
+    def summarize(self, hashes):
+        """
+        Sums the {model}:{counter} hashes per model and adds the cost.
+        """
+        models = {}
+        for item in hashes:
+            for field, value in item.items():
+                model, name = field.decode().rsplit(":", 1)
+                counters = models.setdefault(model, {counter: 0 for counter in TOKEN_USAGE_COUNTERS})
+                counters[name] = counters.get(name, 0) + int(value)
+        total = {name: 0 for name in TOKEN_USAGE_COUNTERS}
+        total["cost"] = 0.0
+        for model, counters in models.items():
+            price = MODEL_PRICES.get(model, {})
+            counters["cost"] = round(counters["prompt_tokens"] / 1000 * price.get("prompt", 0) +
+                                     counters["completion_tokens"] / 1000 * price.get("completion", 0), 6)
+            for name in total:
+                total[name] += counters[name]
+        total["cost"] = round(total["cost"], 6)
+        return {"models": models, "total": total}
+
+    def days(self, day, days):
+        end = datetime.strptime(day, "%Y-%m-%d") if day else datetime.now()
+        return [(end - timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days)]
+
+    def get_usage(self, day=None, days=1, user=None, chat_id=None, top=10):
+        """
+        Usage of a chat, or of a user or of everyone over the days ending on day (today by default).
+        """
+        if chat_id:
+            res = self.summarize([self.client.hgetall(f"{TOKEN_USAGE_CHAT_PREFIX}:{chat_id}")])
+            res["chat_id"] = chat_id
+            return res
+        dates = self.days(day, days)
+        pipeline = self.client.pipeline(transaction=False)
+        for date in dates:
+            if user:
+                pipeline.hgetall(f"{TOKEN_USAGE_USER_PREFIX}:{user}:{date}")
+            else:
+                pipeline.hgetall(f"{TOKEN_USAGE_DAY_PREFIX}:{date}")
+        res = self.summarize(pipeline.execute())
+        res["days"] = dates
+        if user:
+            res["user"] = user
+            return res
+        # 期間内のトークン数の多いユーザー（各日の上位から集計するため、複数日の場合は概算）
+        users = {}
+        pipeline = self.client.pipeline(transaction=False)
+        for date in dates:
+            pipeline.zrevrange(f"{TOKEN_USAGE_USERS_PREFIX}:{date}", 0, top - 1, withscores=True)
+        for ranking in pipeline.execute():
+            for name, tokens in ranking:
+                users[name.decode()] = users.get(name.decode(), 0) + int(tokens)
+        res["top_users"] = [{"user": name, "tokens": tokens}
+                            for name, tokens in sorted(users.items(), key=lambda item: -item[1])[:top]]
+        return res
@@ -0,0 +1,102 @@
+import os
+import io
+import csv
+import time
+import asyncio
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pypdf import PdfReader
+from langchain.docstore.document import Document
+from langchain.document_loaders import UnstructuredExcelLoader
+from langchain.document_loaders import UnstructuredWordDocumentLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+# ファイル解析プロセスの最大数
+FILE_PARSE_WORKERS = int(os.getenv("FILE_PARSE_WORKERS", "2"))
+
+_executor = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=FILE_PARSE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+async def parse_files(files: list[tuple[str, bytes]]) -> list[list[Document]]:
+    """
+    Parses the files concurrently in the process pool, off the event loop.
+    Args:
+        files (list): (filename, data) tuples.
+    Returns:
+        list: The documents of each file, in the same order.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(
+        *[loop.run_in_executor(get_executor(), parse_file, filename, data) for filename, data in files])
+    for (filename, data), (documents, elapsed) in zip(files, results):
+        print(
+            f"Parsed '{filename}' ({len(data)} bytes, {len(documents)} chunks) in {elapsed:.3f}s")
+    return [documents for documents, _ in results]
+
+
+def parse_file(filename: str, data: bytes) -> tuple[list[Document], float]:
+    start = time.perf_counter()
+    documents = load_documents(filename, data)
+    return documents, time.perf_counter() - start
+
+
+def load_documents(filename: str, data: bytes) -> list[Document]:
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=1000,
+        chunk_overlap=100,
+        length_function=len,
+    )
+
+    file_extension = os.path.splitext(filename)[1].lower()
+    if file_extension == ".csv":
+        return load_csv(filename, data)
+    elif file_extension == ".pdf":
+        reader = PdfReader(io.BytesIO(data))
+        documents = [Document(page_content=page.extract_text(), metadata={"source": filename, "page": i})
+                     for i, page in enumerate(reader.pages)]
+        return text_splitter.split_documents(documents)
+    elif file_extension == ".txt":
+        documents = [Document(page_content=data.decode(
+            "utf-8"), metadata={"source": filename})]
+        return text_splitter.split_documents(documents)
+    elif file_extension in [".xlsx", ".docx"]:
+        # unstructured はファイルパスが必要なため一時ファイルを使う
+        with tempfile.NamedTemporaryFile(mode="wb", suffix=file_extension, delete=False) as tmp_file:
+            tmp_file.write(data)
+            tmp_file_path = tmp_file.name
+        try:
+            if file_extension == ".xlsx":
+                loader = UnstructuredExcelLoader(
+                    file_path=tmp_file_path, mode="elements")
+            else:
+                loader = UnstructuredWordDocumentLoader(
+                    file_path=tmp_file_path)
+            documents = loader.load_and_split(text_splitter)
+        finally:
+            os.remove(tmp_file_path)
+        for document in documents:
+            document.metadata["source"] = filename
+        return documents
+    else:
+        raise ValueError("csv、xlsx、docx、pdf、txt 以外のファイルを解析できません。")
+
+
+def load_csv(filename: str, data: bytes) -> list[Document]:
+    # CSVLoader と同じく一行を一つのドキュメントにする
+    reader = csv.DictReader(io.StringIO(data.decode("utf-8")), delimiter=",")
+    documents = []
+    for i, row in enumerate(reader):
+        content = "\n".join(
+            f"{k.strip() if k is not None else k}: {v.strip() if isinstance(v, str) else v}" for k, v in row.items())
+        documents.append(Document(page_content=content,
+                         metadata={"source": filename, "row": i}))
+    return documents
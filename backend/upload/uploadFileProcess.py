@@ -8,6 +8,8 @@ from service.blobStorageService import BlobStorageService
 from service.formRecognizerService import FormRecognizerService
 from service.openaiService import OpenaiService
 from service.cosmosdbService import CosmosdbService
+from service.tokenUsageService import TokenUsageService
+from core.tokenusage import collect_usage
 from langchain.document_loaders import UnstructuredExcelLoader
 from langchain.document_loaders import TextLoader
 from langchain.document_loaders.csv_loader import CSVLoader
@@ -17,8 +19,9 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 class UploadFileProcess(threading.Thread):
 
-    def __init__(self, file_path, file_id, tag, folder_id):
+    def __init__(self, file_path, file_id, tag, folder_id, created_user=""):
         self.file_path = file_path
+        self.created_user = created_user
         self.file_id = file_id
         self.tag = tag
         self.folder_id = folder_id
@@ -29,9 +32,18 @@ class UploadFileProcess(threading.Thread):
             "FormRecognizerService"]
         self.openaiService: OpenaiService = current_app.config["OpenaiService"]
         self.cosmosdbService: CosmosdbService = current_app.config["CosmosdbService"]
+        self.tokenUsageService: TokenUsageService = current_app.config["TokenUsageService"]
         super().__init__()
 
     def run(self) -> None:
+        # エンベディングのトークン数はファイルをアップロードしたユーザーに計上する
+        with collect_usage(self.created_user) as usage:
+            try:
+                self.process()
+            finally:
+                self.tokenUsageService.record(usage)
+
+    def process(self) -> None:
         try:
             self.cognitiveSearchService.create_search_index()
             page_map = []
@@ -77,6 +77,46 @@ export async function retrieveChatApi(formData: FormData): Promise<Models.AskRes
     return parsedResponse;
 }
 
+// 回答を受け取った部分から onDelta に渡し、最後に回答全体を返す
+export async function retrieveChatStreamApi(formData: FormData, onDelta: (delta: string) => void): Promise<Models.AskResponse> {
+    formData.set("stream", "true");
+    const response = await fetch("/retrievechat", {
+        method: "POST",
+        body: formData
+    });
+    if (response.status > 299 || !response.ok || !response.body) {
+        const parsedResponse: Models.AskResponse = await response.json();
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let answer = "";
+    let buffer = "";
+    for (;;) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value, { stream: !done });
+        const lines = buffer.split("\n");
+        buffer = done ? "" : lines.pop() || "";
+        for (const line of lines) {
+            if (!line.trim()) {
+                continue;
+            }
+            const chunk: { delta?: string; error?: string } = JSON.parse(line);
+            if (chunk.error) {
+                throw Error(chunk.error);
+            }
+            if (chunk.delta) {
+                answer += chunk.delta;
+                onDelta(chunk.delta);
+            }
+        }
+        if (done) {
+            break;
+        }
+    }
+    return { answer: answer, thoughts: null, data_points: [] };
+}
+
 export async function gptChatApi(options: Models.GptChatRequest): Promise<Models.AskResponse> {
     const response = await fetch("/gptanswer", {
         method: "POST",
@@ -136,6 +176,16 @@ export async function getChatContent(chat_id: string, chat_type: string) {
     return <Models.ChatContent[]>(<unknown>parsedResponse);
 }
 
+export async function getChatContentDetails(chat_id: string, content_id: string) {
+    const query_params = new URLSearchParams({ chat_id: chat_id, content_id: content_id });
+    const response = await fetch("/api/chatcontent/details?" + query_params);
+    const parsedResponse: Models.ChatContentDetails = await response.json();
+    if (response.status > 299 || !response.ok) {
+        throw Error(parsedResponse.error || "Unknown error");
+    }
+    return parsedResponse;
+}
+
 export async function getchat(chat_id: string) {
     const query_params = new URLSearchParams({ chat_id: chat_id });
     const response = await fetch("/api/chat?" + query_params);
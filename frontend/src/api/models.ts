@@ -33,6 +33,8 @@ export type AskResponse = {
     answer: string;
     thoughts: string | null;
     data_points: string[];
+    // thoughts / data_points を分析パネルを開いた時に取得する会話内容の ID
+    content_id?: string;
     error?: string;
 };
 
@@ -113,12 +115,20 @@ export type ChatContentResponse = {
 };
 
 export type ChatContent = {
+    id: string;
     chat_id: string;
     index: number;
     question: string;
     answer: string;
     thoughts: string | null;
     data_points: string[];
+    details?: string;
+};
+
+export type ChatContentDetails = {
+    thoughts: string | null;
+    data_points: string[];
+    error?: string;
 };
 
 export type Authentication = {
@@ -96,7 +96,8 @@ export function Component(): JSX.Element {
                     const answer: API.AskResponse = {
                         answer: item.answer,
                         thoughts: item.thoughts,
-                        data_points: item.data_points
+                        data_points: item.data_points,
+                        content_id: item.details ? item.id : undefined
                     };
                     return [item.question, answer];
                 });
@@ -116,6 +117,28 @@ export function Component(): JSX.Element {
     }, [chat_id]);
     useEffect(() => chatMessageStreamEnd.current?.scrollIntoView({ behavior: "smooth" }), [isLoading]);
 
+    // 分析パネルを開いた時に thoughts / data_points を取得する
+    useEffect(() => {
+        const answer = answers[selectedAnswer]?.[1];
+        if (!activeAnalysisPanelTab || !answer?.content_id) {
+            return;
+        }
+        const content_id = answer.content_id;
+        API.getChatContentDetails(chat_id, content_id)
+            .then((res: API.ChatContentDetails) => {
+                setAnswers(prev =>
+                    prev.map(([question, item]): [string, API.AskResponse] =>
+                        item.content_id === content_id
+                            ? [question, { ...item, thoughts: res.thoughts, data_points: res.data_points, content_id: undefined }]
+                            : [question, item]
+                    )
+                );
+            })
+            .catch(e => {
+                setError(e);
+            });
+    }, [activeAnalysisPanelTab, selectedAnswer]);
+
     const onPromptTemplateChange = (_ev?: React.FormEvent<HTMLInputElement | HTMLTextAreaElement>, newValue?: string) => {
         setPromptTemplate(newValue || "");
     };